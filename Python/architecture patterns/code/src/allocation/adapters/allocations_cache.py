@@ -0,0 +1,74 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, List, Optional, Tuple
+
+from allocation.adapters.product_cache import CacheStats
+
+Rows = List[dict]
+
+
+class AllocationsCache:
+    """
+    Results of views.allocations by orderid, for up to ttl seconds and at
+    most max_entries orderids, least recently used dropped first.
+
+    Event handlers invalidate an orderid as soon as its allocations
+    change. Invalidating leaves a marker behind, so a reader that queried
+    before the change can't put its now stale rows back afterwards: put()
+    takes the token() the reader got before querying. Changes made by other
+    processes are only picked up when the ttl runs out.
+    """
+
+    def __init__(
+        self, max_entries: int = 10_000, ttl: float = 30.0,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.clock = clock
+        self.stats = CacheStats()
+        self._entries = OrderedDict()  # type: OrderedDict[str, Tuple[Optional[Rows], float, int]]
+        self._epoch = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def token(self) -> int:
+        with self._lock:
+            return self._epoch
+
+    def get(self, orderid: str) -> Optional[Rows]:
+        with self._lock:
+            entry = self._entries.get(orderid)
+            if entry is None or entry[0] is None:
+                self.stats.misses += 1
+                return None
+            rows, expires, _ = entry
+            if expires <= self.clock():
+                del self._entries[orderid]
+                self.stats.stale += 1
+                return None
+            self._entries.move_to_end(orderid)
+            self.stats.hits += 1
+            return rows
+
+    def put(self, orderid: str, rows: Rows, token: int):
+        with self._lock:
+            entry = self._entries.get(orderid)
+            if entry is not None and entry[0] is None and entry[2] > token:
+                return
+            self._store(orderid, rows, self.clock() + self.ttl)
+
+    def invalidate(self, orderid: str):
+        with self._lock:
+            self._epoch += 1
+            self._store(orderid, None, self.clock() + self.ttl)
+
+    def _store(self, orderid, rows, expires):
+        self._entries[orderid] = (rows, expires, self._epoch)
+        self._entries.move_to_end(orderid)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.stats.evictions += 1
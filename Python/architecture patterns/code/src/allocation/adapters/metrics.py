@@ -0,0 +1,52 @@
+import abc
+import threading
+from collections import Counter, defaultdict
+from typing import Dict, List
+
+
+class AbstractMetrics(abc.ABC):
+
+    @abc.abstractmethod
+    def increment(self, name: str, value: int = 1):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def timing(self, name: str, seconds: float):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def gauge(self, name: str, value: float):
+        raise NotImplementedError
+
+
+class NullMetrics(AbstractMetrics):
+
+    def increment(self, name, value=1):
+        pass
+
+    def timing(self, name, seconds):
+        pass
+
+    def gauge(self, name, value):
+        pass
+
+
+class InMemoryMetrics(AbstractMetrics):
+
+    def __init__(self):
+        self.counters = Counter()  # type: Counter
+        self.timings = defaultdict(list)  # type: Dict[str, List[float]]
+        self.gauges = {}  # type: Dict[str, float]
+        self._lock = threading.Lock()
+
+    def increment(self, name, value=1):
+        with self._lock:
+            self.counters[name] += value
+
+    def timing(self, name, seconds):
+        with self._lock:
+            self.timings[name].append(seconds)
+
+    def gauge(self, name, value):
+        with self._lock:
+            self.gauges[name] = value
@@ -1,8 +1,18 @@
-#pylint: disable=too-few-public-methods
+#pylint: disable=too-few-public-methods,import-outside-toplevel
 import abc
-import smtplib
+import logging
+import queue
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import Dict, Optional
 from allocation import config
 
+logger = logging.getLogger(__name__)
+
+FROM_ADDR = 'allocations@example.com'
+SUBJECT = 'allocation service notification'
+
 
 class AbstractNotifications(abc.ABC):
 
@@ -11,21 +21,165 @@ class AbstractNotifications(abc.ABC):
         raise NotImplementedError
 
 
-DEFAULT_HOST = config.get_email_host_and_port()['host']
-DEFAULT_PORT = config.get_email_host_and_port()['port']
-
+def connect(smtp_host=None, port=None):
+    import smtplib
+    settings = config.get_email_host_and_port()
+    return smtplib.SMTP(smtp_host or settings['host'], port=port or settings['port'])
 
 
 class EmailNotifications(AbstractNotifications):
+    """Connects to the SMTP server on the first send, not on construction."""
 
-    def __init__(self, smtp_host=DEFAULT_HOST, port=DEFAULT_PORT):
-        self.server = smtplib.SMTP(smtp_host, port=port)
-        self.server.noop()
+    def __init__(self, smtp_host=None, port=None):
+        self.smtp_host = smtp_host
+        self.port = port
+        self._server = None
+
+    @property
+    def server(self):
+        if self._server is None:
+            self._server = connect(self.smtp_host, self.port)
+        return self._server
 
     def send(self, destination, message):
-        msg = f'Subject: allocation service notification\n{message}'
+        msg = f'Subject: {SUBJECT}\n{message}'
         self.server.sendmail(
-            from_addr='allocations@example.com',
+            from_addr=FROM_ADDR,
             to_addrs=[destination],
             msg=msg
         )
+
+
+def digest(messages: Counter) -> str:
+    """One email for everything queued for a destination, repeats counted rather than resent."""
+    if len(messages) == 1 and sum(messages.values()) == 1:
+        return f'Subject: {SUBJECT}\n{next(iter(messages))}'
+    lines = [
+        message if count == 1 else f'{message} ({count} times)'
+        for message, count in messages.items()
+    ]
+    return f'Subject: {SUBJECT} digest\n\n' + '\n'.join(lines)
+
+
+class PooledEmailNotifications(AbstractNotifications):
+    """
+    send() only queues the message. digest_window seconds after the first
+    one, everything queued goes out from background threads over at most
+    pool_size SMTP connections, one digest per destination, so a sku that
+    keeps running out of stock doesn't hold up the bus or flood the inbox.
+    A connection that has gone away is dropped and the digest retried on a
+    new one, up to max_attempts times.
+    """
+
+    def __init__(
+        self,
+        smtp_host=None,
+        port=None,
+        pool_size: int = 2,
+        digest_window: float = 5.0,
+        max_attempts: int = 3,
+    ):
+        self.smtp_host = smtp_host
+        self.port = port
+        self.pool_size = pool_size
+        self.digest_window = digest_window
+        self.max_attempts = max_attempts
+        self._pending = {}  # type: Dict[str, Counter]
+        self._timer = None  # type: Optional[threading.Timer]
+        self._lock = threading.Lock()
+        self._idle = queue.LifoQueue()  # type: queue.LifoQueue
+        self._executor = None  # type: Optional[ThreadPoolExecutor]
+
+    def send(self, destination, message):
+        with self._lock:
+            self._pending.setdefault(destination, Counter())[message] += 1
+            if self._timer is None:
+                self._timer = threading.Timer(self.digest_window, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self):
+        """Sends everything queued so far and waits for it to go out."""
+        with self._lock:
+            pending = self._take_pending()
+            if not pending:
+                return
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    self.pool_size, thread_name_prefix='notifications',
+                )
+            futures = [
+                self._executor.submit(self._deliver, destination, messages)
+                for destination, messages in pending.items()
+            ]
+        wait(futures)
+
+    def close(self):
+        """
+        Sends everything queued from this thread, which works at
+        interpreter exit too, when the executor takes no more work.
+        """
+        with self._lock:
+            pending = self._take_pending()
+        for destination, messages in pending.items():
+            self._deliver(destination, messages)
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+        while True:
+            try:
+                server = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                server.quit()
+            except OSError:
+                self._discard(server)
+
+    def _take_pending(self) -> Dict[str, Counter]:
+        pending, self._pending = self._pending, {}
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        return pending
+
+    def _deliver(self, destination, messages: Counter):
+        import smtplib
+        msg = digest(messages)
+        for attempt in range(1, self.max_attempts + 1):
+            server = None
+            try:
+                server = self._checkout()
+                server.sendmail(from_addr=FROM_ADDR, to_addrs=[destination], msg=msg)
+            except (smtplib.SMTPResponseException, smtplib.SMTPRecipientsRefused):
+                # the server answered, so resending won't help
+                if server is not None:
+                    self._idle.put(server)
+                logger.exception('SMTP server refused notification to %s', destination)
+                return
+            except OSError:
+                if server is not None:
+                    self._discard(server)
+                if attempt == self.max_attempts:
+                    logger.exception('Could not send notification to %s', destination)
+                    return
+                logger.warning('SMTP connection lost, reconnecting (attempt %s)', attempt)
+            else:
+                self._idle.put(server)
+                return
+
+    def _checkout(self):
+        # the executor never runs more than pool_size deliveries at once,
+        # so there are never more than pool_size connections either
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return connect(self.smtp_host, self.port)
+
+    @staticmethod
+    def _discard(server):
+        try:
+            server.close()
+        except OSError:
+            pass
@@ -1,10 +1,11 @@
 import logging
 from sqlalchemy import (
-    Table, MetaData, Column, Integer, String, Date, ForeignKey,
+    Table, MetaData, Column, Integer, String, Date, DateTime, Text, ForeignKey,
     event,
 )
 from sqlalchemy.orm import mapper, relationship
 
+from allocation import config
 from allocation.domain import model
 
 logger = logging.getLogger(__name__)
@@ -16,7 +17,7 @@ order_lines = Table(
     Column('id', Integer, primary_key=True, autoincrement=True),
     Column('sku', String(255)),
     Column('qty', Integer, nullable=False),
-    Column('orderid', String(255)),
+    Column('orderid', String(255), index=True),
 )
 
 products = Table(
@@ -28,8 +29,8 @@ products = Table(
 batches = Table(
     'batches', metadata,
     Column('id', Integer, primary_key=True, autoincrement=True),
-    Column('reference', String(255)),
-    Column('sku', ForeignKey('products.sku')),
+    Column('reference', String(255), index=True),
+    Column('sku', ForeignKey('products.sku'), index=True),
     Column('_purchased_quantity', Integer, nullable=False),
     Column('eta', Date, nullable=True),
 )
@@ -38,31 +39,96 @@ allocations = Table(
     'allocations', metadata,
     Column('id', Integer, primary_key=True, autoincrement=True),
     Column('orderline_id', ForeignKey('order_lines.id')),
-    Column('batch_id', ForeignKey('batches.id')),
+    Column('batch_id', ForeignKey('batches.id'), index=True),
 )
 
 allocations_view = Table(
     'allocations_view', metadata,
-    Column('orderid', String(255)),
+    Column('orderid', String(255), index=True),
     Column('sku', String(255)),
     Column('batchref', String(255)),
 )
 
+event_outbox = Table(
+    'event_outbox', metadata,
+    Column('id', Integer, primary_key=True, autoincrement=True),
+    Column('event_type', String(255), nullable=False),
+    Column('payload', Text, nullable=False),
+    Column('sku', String(255)),
+    Column('created_at', DateTime, nullable=False),
+    Column('processed_at', DateTime, nullable=True, index=True),
+    Column('attempts', Integer, nullable=False, server_default='0'),
+    Column('next_attempt_at', DateTime, nullable=True),
+    Column('dead_lettered_at', DateTime, nullable=True),
+)
+
+event_outbox_handled = Table(
+    'event_outbox_handled', metadata,
+    Column('outbox_id', ForeignKey('event_outbox.id'), primary_key=True),
+    Column('handler', String(255), primary_key=True),
+)
 
-def start_mappers():
-    logger.info("Starting mappers")
+projection_checkpoints = Table(
+    'projection_checkpoints', metadata,
+    Column('name', String(255), primary_key=True),
+    Column('position', Integer, nullable=False),
+    Column('skipped', Text),
+)
+
+outbox = Table(
+    'outbox', metadata,
+    Column('id', Integer, primary_key=True, autoincrement=True),
+    Column('channel', String(255), nullable=False),
+    Column('message', Text, nullable=False),
+    Column('created_at', DateTime, nullable=False),
+    Column('published_at', DateTime, nullable=True, index=True),
+)
+
+
+LOADING_STRATEGIES = ('select', 'selectin', 'joined')
+
+
+def start_mappers(loading_strategy=None):
+    """
+    loading_strategy is passed as `lazy` to the batches and allocations
+    relationships: 'select' loads them one query per collection on first
+    access, 'selectin' and 'joined' load them along with their parents.
+    """
+    loading_strategy = loading_strategy or config.get_orm_loading_strategy()
+    if loading_strategy not in LOADING_STRATEGIES:
+        raise ValueError(f'Unknown loading strategy {loading_strategy}')
+    logger.info("Starting mappers with %s loading", loading_strategy)
     lines_mapper = mapper(model.OrderLine, order_lines)
     batches_mapper = mapper(model.Batch, batches, properties={
         '_allocations': relationship(
             lines_mapper,
             secondary=allocations,
             collection_class=set,
+            lazy=loading_strategy,
         )
     })
     mapper(model.Product, products, properties={
-        'batches': relationship(batches_mapper)
+        'batches': relationship(batches_mapper, lazy=loading_strategy)
     })
 
 @event.listens_for(model.Product, 'load')
 def receive_load(product, _):
     product.events = []
+    forget_batch_index(product)
+
+
+@event.listens_for(model.Product, 'refresh')
+@event.listens_for(model.Product, 'expire')
+def forget_batch_index(product, *_):
+    # the batches are about to be reloaded, so the index would be stale
+    if product is not None:
+        product._index = None
+        product._scans = 0
+
+
+@event.listens_for(model.Batch, 'load')
+@event.listens_for(model.Batch, 'expire')
+def receive_batch_load(batch, *_):
+    # expire can fire for instances that have already been garbage collected
+    if batch is not None:
+        batch._allocated_quantity = None
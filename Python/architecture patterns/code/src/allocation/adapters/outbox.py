@@ -0,0 +1,141 @@
+"""
+Durable store for events that still need handling. Rows are written in the
+same transaction as the aggregate that raised them, and each handler that
+has dealt with a row is recorded against it, so redelivering a row only
+re-runs the handlers that hadn't finished. A row whose handlers keep
+failing is retried later, after next_attempt_at, and dead-lettered once
+it has used up its attempts.
+"""
+import json
+from dataclasses import asdict
+from datetime import datetime
+from typing import Iterable, List, Set, Tuple
+from sqlalchemy import select
+from allocation.adapters import orm
+from allocation.domain import events
+
+
+def serialize(event: events.Event) -> str:
+    return json.dumps(asdict(event))
+
+
+def deserialize(event_type: str, payload: str) -> events.Event:
+    return getattr(events, event_type)(**json.loads(payload))
+
+
+def add(session, new_events: Iterable[events.Event]):
+    rows = [
+        dict(
+            event_type=type(event).__name__, payload=serialize(event),
+            sku=getattr(event, 'sku', None), created_at=datetime.utcnow(),
+        )
+        for event in new_events
+    ]
+    if rows:
+        session.execute(
+            'INSERT INTO event_outbox (event_type, payload, sku, created_at)'
+            ' VALUES (:event_type, :payload, :sku, :created_at)',
+            rows,
+        )
+
+
+def pending(session, limit: int) -> List[Tuple[int, str, str, str]]:
+    """
+    Rows due for handling, oldest first. A sku with a row waiting out its
+    backoff is left out altogether, so its later events keep their order
+    without holding up everyone else's.
+    """
+    return [tuple(row) for row in session.execute(
+        'SELECT id, event_type, payload, sku FROM event_outbox'
+        ' WHERE processed_at IS NULL AND dead_lettered_at IS NULL'
+        ' AND (next_attempt_at IS NULL OR next_attempt_at <= :now)'
+        ' AND (sku IS NULL OR sku NOT IN ('
+        '  SELECT sku FROM event_outbox'
+        '  WHERE processed_at IS NULL AND dead_lettered_at IS NULL'
+        '  AND next_attempt_at > :now AND sku IS NOT NULL'
+        ' )) ORDER BY id LIMIT :limit',
+        dict(limit=limit, now=datetime.utcnow()),
+    )]
+
+
+def since(session, position: int, limit: int) -> List[Tuple[int, str, str, datetime]]:
+    return [tuple(row) for row in session.execute(
+        select([
+            orm.event_outbox.c.id, orm.event_outbox.c.event_type,
+            orm.event_outbox.c.payload, orm.event_outbox.c.created_at,
+        ]).where(
+            orm.event_outbox.c.id > position
+        ).order_by(orm.event_outbox.c.id).limit(limit)
+    )]
+
+
+def with_ids(session, outbox_ids: List[int]) -> List[Tuple[int, str, str, datetime]]:
+    if not outbox_ids:
+        return []
+    return [tuple(row) for row in session.execute(
+        select([
+            orm.event_outbox.c.id, orm.event_outbox.c.event_type,
+            orm.event_outbox.c.payload, orm.event_outbox.c.created_at,
+        ]).where(
+            orm.event_outbox.c.id.in_(outbox_ids)
+        ).order_by(orm.event_outbox.c.id)
+    )]
+
+
+def handled(session, outbox_ids: List[int]) -> Set[Tuple[int, str]]:
+    if not outbox_ids:
+        return set()
+    return {tuple(row) for row in session.execute(
+        'SELECT outbox_id, handler FROM event_outbox_handled'
+        ' WHERE outbox_id >= :first AND outbox_id <= :last',
+        dict(first=min(outbox_ids), last=max(outbox_ids)),
+    )}
+
+
+def mark_handled(session, outbox_id: int, handler: str):
+    session.execute(
+        'INSERT INTO event_outbox_handled (outbox_id, handler)'
+        ' VALUES (:outbox_id, :handler)',
+        dict(outbox_id=outbox_id, handler=handler),
+    )
+
+
+def mark_processed(session, outbox_id: int):
+    session.execute(
+        'UPDATE event_outbox SET processed_at = :now WHERE id = :outbox_id',
+        dict(now=datetime.utcnow(), outbox_id=outbox_id),
+    )
+
+
+def mark_failed(session, outbox_id: int) -> int:
+    """Counts a failed attempt at the row and returns how many there have been."""
+    session.execute(
+        'UPDATE event_outbox SET attempts = attempts + 1 WHERE id = :outbox_id',
+        dict(outbox_id=outbox_id),
+    )
+    [[attempts]] = session.execute(
+        'SELECT attempts FROM event_outbox WHERE id = :outbox_id',
+        dict(outbox_id=outbox_id),
+    )
+    return attempts
+
+
+def retry_at(session, outbox_id: int, when: datetime):
+    session.execute(
+        'UPDATE event_outbox SET next_attempt_at = :when WHERE id = :outbox_id',
+        dict(when=when, outbox_id=outbox_id),
+    )
+
+
+def mark_dead_lettered(session, outbox_id: int):
+    session.execute(
+        'UPDATE event_outbox SET dead_lettered_at = :now WHERE id = :outbox_id',
+        dict(now=datetime.utcnow(), outbox_id=outbox_id),
+    )
+
+
+def dead_lettered(session) -> List[Tuple[int, str, str, str]]:
+    return [tuple(row) for row in session.execute(
+        'SELECT id, event_type, payload, sku FROM event_outbox'
+        ' WHERE dead_lettered_at IS NOT NULL ORDER BY id'
+    )]
@@ -0,0 +1,95 @@
+import sys
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Callable, Optional, Tuple
+
+from allocation.domain import model
+
+
+def estimate_size(product: model.Product) -> int:
+    """Rough size in bytes of a product, its batches and their order lines."""
+    size = sys.getsizeof(product) + sys.getsizeof(product.batches)
+    for batch in product.batches:
+        size += sys.getsizeof(batch) + sys.getsizeof(batch._allocations)
+        size += sum(sys.getsizeof(line) for line in batch._allocations)
+    return size
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+    stale: int = 0
+    evictions: int = 0
+
+    @property
+    def hit_ratio(self) -> float:
+        lookups = self.hits + self.misses + self.stale
+        return self.hits / lookups if lookups else 0.0
+
+
+class ProductCache:
+    """
+    Detached Product aggregates from earlier units of work, least recently
+    used first, kept under max_bytes by estimate_size.
+
+    A product is taken out of the cache by the unit of work that uses it
+    and only put back once that unit of work has committed, so no two
+    sessions ever share one. take() is given the version_number currently
+    in the database and drops the entry if it doesn't match.
+    """
+
+    def __init__(
+        self, max_bytes: int = 64 * 2 ** 20,
+        sizeof: Callable[[model.Product], int] = estimate_size,
+    ):
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.stats = CacheStats()
+        self.size = 0
+        self._entries = OrderedDict()  # type: OrderedDict[str, Tuple[model.Product, int]]
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def take(self, sku: str, version_number: int) -> Optional[model.Product]:
+        with self._lock:
+            entry = self._entries.pop(sku, None)
+            if entry is None:
+                self.stats.misses += 1
+                return None
+            product, size = entry
+            self.size -= size
+            if product.version_number != version_number:
+                self.stats.stale += 1
+                return None
+            self.stats.hits += 1
+            return product
+
+    def put(self, product: model.Product):
+        size = self.sizeof(product)
+        with self._lock:
+            old = self._entries.pop(product.sku, None)
+            if old is not None:
+                self.size -= old[1]
+            if size > self.max_bytes:
+                return
+            self._entries[product.sku] = (product, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.size -= evicted_size
+                self.stats.evictions += 1
+
+    def invalidate(self, sku: str):
+        with self._lock:
+            entry = self._entries.pop(sku, None)
+            if entry is not None:
+                self.size -= entry[1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
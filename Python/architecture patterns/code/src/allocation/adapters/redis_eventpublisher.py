@@ -1,16 +1,113 @@
+import functools
 import json
 import logging
+import threading
 from dataclasses import asdict
-import redis
+from datetime import datetime
+from typing import Callable, Iterable, List, Tuple
 
 from allocation import config
+from allocation.adapters.metrics import AbstractMetrics, NullMetrics
 from allocation.domain import events
 
 logger = logging.getLogger(__name__)
 
-r = redis.Redis(**config.get_redis_host_and_port())
+@functools.lru_cache(maxsize=None)
+def get_redis():
+    import redis  # pylint: disable=import-outside-toplevel
+    return redis.Redis(**config.get_redis_host_and_port())
 
 
 def publish(channel, event: events.Event):
     logging.info('publishing: channel=%s, event=%s', channel, event)
-    r.publish(channel, json.dumps(asdict(event)))
+    get_redis().publish(channel, json.dumps(asdict(event)))
+
+
+def messages(event: events.Event) -> List[Tuple[str, events.Event]]:
+    """(channel, event) for everything the publish handlers would send for event."""
+    if isinstance(event, events.Allocated):
+        return [('line_allocated', event)]
+    if isinstance(event, events.Reallocated):
+        return [('line_allocated', allocated) for allocated in event.allocated]
+    return []
+
+
+def add_to_outbox(session, new_events: Iterable[events.Event]):
+    """
+    Queues what publishing new_events would send in the outbox table, as
+    part of session's transaction, for an OutboxRelay to send on. Written
+    alongside the allocation itself, a message can't be lost between the
+    allocation committing and redis receiving it.
+    """
+    now = datetime.utcnow()
+    rows = [
+        dict(channel=channel, message=json.dumps(asdict(message)), created_at=now)
+        for event in new_events
+        for channel, message in messages(event)
+    ]
+    if rows:
+        logging.info('queueing %s messages', len(rows))
+        session.execute(
+            'INSERT INTO outbox (channel, message, created_at)'
+            ' VALUES (:channel, :message, :created_at)',
+            rows,
+        )
+
+
+class OutboxRelay:
+    """
+    Publishes outbox rows to redis batch_size at a time, one pipelined round
+    trip per batch, marking them published only once redis has them all.
+    A crash in between means some messages go out twice, never not at all.
+    """
+
+    def __init__(
+        self,
+        session_factory: Callable,
+        redis_client=None,
+        batch_size: int = 100,
+        flush_interval: float = 0.5,
+        metrics: AbstractMetrics = None,
+    ):
+        self.session_factory = session_factory
+        self.redis = redis_client or get_redis()
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.metrics = metrics or NullMetrics()
+
+    def flush(self) -> int:
+        session = self.session_factory()
+        try:
+            rows = list(session.execute(
+                'SELECT id, channel, message FROM outbox'
+                ' WHERE published_at IS NULL ORDER BY id LIMIT :limit',
+                dict(limit=self.batch_size),
+            ))
+            if not rows:
+                return 0
+            pipeline = self.redis.pipeline(transaction=False)
+            for _, channel, message in rows:
+                pipeline.publish(channel, message)
+            pipeline.execute()
+            now = datetime.utcnow()
+            session.execute(
+                'UPDATE outbox SET published_at = :now WHERE id = :id',
+                [dict(now=now, id=outbox_id) for outbox_id, _, _ in rows],
+            )
+            session.commit()
+        finally:
+            session.close()
+        self.metrics.increment('outbox_relay.published', len(rows))
+        return len(rows)
+
+    def run_forever(self, stop: threading.Event = None):
+        import redis  # pylint: disable=import-outside-toplevel
+        stop = stop or threading.Event()
+        while not stop.is_set():
+            try:
+                flushed = self.flush()
+            except redis.RedisError:
+                logger.exception('Could not publish outbox, will retry')
+                flushed = 0
+            if flushed < self.batch_size:
+                stop.wait(self.flush_interval)
@@ -1,6 +1,11 @@
 import abc
-from typing import Set
+import threading
+from collections import OrderedDict
+from typing import Dict, Iterable, Optional, Set
+from sqlalchemy import and_, select
+from sqlalchemy.orm import selectinload
 from allocation.adapters import orm
+from allocation.adapters.product_cache import ProductCache
 from allocation.domain import model
 
 
@@ -20,6 +25,11 @@ class AbstractRepository(abc.ABC):
             self.seen.add(product)
         return product
 
+    def get_many(self, skus: Iterable[str]) -> Dict[str, Optional[model.Product]]:
+        products = self._get_many(skus)
+        self.seen.update(p for p in products.values() if p)
+        return products
+
     def get_by_batchref(self, batchref) -> model.Product:
         product = self._get_by_batchref(batchref)
         if product:
@@ -38,22 +48,144 @@ class AbstractRepository(abc.ABC):
     def _get_by_batchref(self, batchref) -> model.Product:
         raise NotImplementedError
 
+    def _get_many(self, skus):
+        return {sku: self._get(sku) for sku in skus}
 
 
 
-class SqlAlchemyRepository(AbstractRepository):
 
-    def __init__(self, session):
+class BatchrefSkus:
+    """
+    Which sku each batch reference belongs to, for the most recently seen
+    max_size batches. A batch never moves between products, so entries only
+    go wrong if a batch is deleted; callers check what they load.
+    """
+
+    def __init__(self, max_size: int = 1_000_000):
+        self.max_size = max_size
+        self._skus = OrderedDict()  # type: OrderedDict[str, str]
+        self._lock = threading.Lock()
+
+    def get(self, batchref: str) -> Optional[str]:
+        with self._lock:
+            sku = self._skus.get(batchref)
+            if sku is not None:
+                self._skus.move_to_end(batchref)
+            return sku
+
+    def remember(self, product: model.Product):
+        with self._lock:
+            for batch in product.batches:
+                self._skus[batch.reference] = product.sku
+                self._skus.move_to_end(batch.reference)
+            while len(self._skus) > self.max_size:
+                self._skus.popitem(last=False)
+
+    def forget(self, batchref: str):
+        with self._lock:
+            self._skus.pop(batchref, None)
+
+
+DEFAULT_BATCHREF_SKUS = BatchrefSkus()
+
+
+class SqlAlchemyRepository(AbstractRepository):
+    """
+    With a cache, each get first reads just the product's version_number
+    and only loads the whole aggregate if the cache doesn't have a product
+    at that version.
+
+    get_by_batchref looks the sku up in batchref_skus, shared by every
+    repository by default, and then fetches the product by primary key.
+    Only the first lookup for a product's batches needs the join on
+    batches.reference, which then remembers all of them.
+    """
+
+    def __init__(
+        self, session, cache: ProductCache = None,
+        batchref_skus: BatchrefSkus = DEFAULT_BATCHREF_SKUS,
+    ):
         super().__init__()
         self.session = session
+        self.cache = cache
+        self.batchref_skus = batchref_skus
 
     def _add(self, product):
         self.session.add(product)
 
+    def _hydrated(self):
+        # batches and their allocations come back in one extra query each,
+        # however many batches the product has and whatever the mappers'
+        # default loading strategy is
+        return self.session.query(model.Product).options(
+            selectinload(model.Product.batches).selectinload(model.Batch._allocations)
+        )
+
     def _get(self, sku):
-        return self.session.query(model.Product).filter_by(sku=sku).first()
+        if self.cache is not None:
+            taken = self._take_from_cache(orm.products.c.sku == sku)
+            if not taken:
+                return None
+            if taken[sku] is not None:
+                return taken[sku]
+        return self._hydrated().filter_by(sku=sku).first()
 
     def _get_by_batchref(self, batchref):
-        return self.session.query(model.Product).join(model.Batch).filter(
+        sku = self.batchref_skus.get(batchref)
+        if sku is not None:
+            product = self._get(sku)
+            if product is not None and any(
+                    b.reference == batchref for b in product.batches
+            ):
+                return product
+            self.batchref_skus.forget(batchref)
+        product = self._load_by_batchref(batchref)
+        if product is not None:
+            self.batchref_skus.remember(product)
+        return product
+
+    def _load_by_batchref(self, batchref):
+        if self.cache is not None:
+            taken = self._take_from_cache(
+                orm.products.c.sku == orm.batches.c.sku,
+                orm.batches.c.reference == batchref,
+            )
+            if not taken:
+                return None
+            [cached] = taken.values()
+            if cached is not None:
+                return cached
+        return self._hydrated().join(model.Batch).filter(
             orm.batches.c.reference == batchref,
         ).first()
+
+    def _get_many(self, skus):
+        skus = list(skus)
+        found = {}
+        if self.cache is not None:
+            found.update(
+                (sku, product) for sku, product in
+                self._take_from_cache(orm.products.c.sku.in_(skus)).items()
+                if product is not None
+            )
+        missing = [sku for sku in skus if sku not in found]
+        if missing:
+            found.update(
+                (p.sku, p) for p in
+                self._hydrated().filter(orm.products.c.sku.in_(missing))
+            )
+        return {sku: found.get(sku) for sku in skus}
+
+    def _take_from_cache(self, *criteria) -> Dict[str, Optional[model.Product]]:
+        versions = self.session.execute(
+            select([orm.products.c.sku, orm.products.c.version_number]).where(
+                and_(*criteria)
+            )
+        )
+        taken = {}
+        for sku, version_number in versions:
+            product = self.cache.take(sku, version_number)
+            if product is not None:
+                self.session.add(product)
+            taken[sku] = product
+        return taken
@@ -1,30 +1,158 @@
+import asyncio
+import atexit
+import functools
 import inspect
-from typing import Callable
+from concurrent.futures import Executor
+from typing import Callable, Optional
+from allocation import config, views
 from allocation.adapters import orm, redis_eventpublisher
+from allocation.adapters.allocations_cache import AllocationsCache
+from allocation.adapters.metrics import AbstractMetrics
 from allocation.adapters.notifications import (
-    AbstractNotifications, EmailNotifications
+    AbstractNotifications, EmailNotifications, PooledEmailNotifications
 )
-from allocation.service_layer import handlers, messagebus, unit_of_work
+from allocation.adapters.product_cache import ProductCache
+from allocation.service_layer import handlers, messagebus, sku_locks, unit_of_work
 
 
 def bootstrap(
     start_orm: bool = True,
-    uow: unit_of_work.AbstractUnitOfWork = unit_of_work.SqlAlchemyUnitOfWork(),
+    uow: unit_of_work.AbstractUnitOfWork = None,
     notifications: AbstractNotifications = None,
     publish: Callable = redis_eventpublisher.publish,
+    metrics: AbstractMetrics = None,
+    retry: messagebus.RetryPolicy = None,
+    sku_lock_stripes: int = None,
+    allocations_cache: AllocationsCache = None,
 ) -> messagebus.MessageBus:
 
+    if uow is None:
+        uow = unit_of_work.SqlAlchemyUnitOfWork(
+            use_outbox=config.use_event_outbox(), product_cache=default_product_cache(),
+            metrics=metrics, publish_outbox=config.use_publish_outbox(),
+        )
+
     if notifications is None:
-        notifications = EmailNotifications()
+        notifications = default_notifications()
+
+    if retry is None:
+        retry = default_retry()
+
+    if sku_lock_stripes is None:
+        sku_lock_stripes = config.get_sku_lock_stripes()
 
     if start_orm:
         orm.start_mappers()
 
-    dependencies = {'uow': uow, 'notifications': notifications, 'publish': publish}
+    event_handlers, command_handlers = inject_handlers({
+        'uow': uow, 'notifications': notifications, 'publish': publish,
+        'allocations_cache': allocations_cache,
+    })
+    if sku_lock_stripes:
+        command_handlers = sku_locks.SkuLocking(
+            lambda batchref: views.sku_for_batch(batchref, uow),
+            sku_locks.StripedLocks(sku_lock_stripes),
+            max_stripes=config.get_sku_lock_max_stripes(),
+        ).wrap_handlers(command_handlers)
+    return messagebus.MessageBus(
+        uow=uow,
+        event_handlers=event_handlers,
+        command_handlers=command_handlers,
+        metrics=metrics,
+        retry=retry,
+    )
+
+
+def bootstrap_async(
+    start_orm: bool = True,
+    uow: unit_of_work.AbstractUnitOfWork = None,
+    notifications: AbstractNotifications = None,
+    publish: Callable = redis_eventpublisher.publish,
+    metrics: AbstractMetrics = None,
+    executor: Executor = None,
+    retry: messagebus.RetryPolicy = None,
+    allocations_cache: AllocationsCache = None,
+) -> messagebus.AsyncMessageBus:
+
+    if uow is None:
+        uow = unit_of_work.AsyncSqlAlchemyUnitOfWork(
+            use_outbox=config.use_event_outbox(), executor=executor,
+            product_cache=default_product_cache(), metrics=metrics,
+            publish_outbox=config.use_publish_outbox(),
+        )
+
+    if notifications is None:
+        notifications = default_notifications()
+
+    if retry is None:
+        retry = default_retry()
+
+    if start_orm:
+        orm.start_mappers()
+
+    event_handlers, command_handlers = inject_handlers({
+        'uow': uow, 'notifications': notifications, 'publish': publish,
+        'allocations_cache': allocations_cache,
+    })
+    return messagebus.AsyncMessageBus(
+        uow=uow,
+        event_handlers=event_handlers,
+        command_handlers=command_handlers,
+        metrics=metrics,
+        executor=executor,
+        retry=retry,
+    )
+
+
+def default_retry() -> messagebus.RetryPolicy:
+    return messagebus.RetryPolicy(**config.get_command_retry_settings())
+
+
+def default_product_cache() -> Optional[ProductCache]:
+    max_bytes = config.get_product_cache_bytes()
+    return ProductCache(max_bytes) if max_bytes else None
+
+
+def default_allocations_cache() -> Optional[AllocationsCache]:
+    # off unless sized: each process only hears about the events it handles
+    # itself, so one of several app processes, or the projector and the
+    # outbox worker, changing allocations_view leaves the others serving
+    # the rows from before the change until their ttl runs out
+    settings = config.get_allocations_cache_settings()
+    if (
+        not settings['max_entries']
+        or config.use_read_model_projector() or config.use_event_outbox()
+    ):
+        return None
+    return AllocationsCache(**settings)
+
+
+def default_notifications() -> AbstractNotifications:
+    settings = config.get_pooled_email_settings()
+    if settings['pool_size']:
+        notifications = PooledEmailNotifications(**settings)
+        # the digest timer is a daemon thread, so whatever is still queued
+        # when the process exits would otherwise never go out
+        atexit.register(notifications.close)
+        return notifications
+    return EmailNotifications()
+
+
+def inject_handlers(dependencies):
+    # with the projector running, allocations_view is its job, and with
+    # the publish outbox the unit of work queues the messages as it commits.
+    # The projector reads the event outbox, so without that it sees nothing
+    # and the handlers stay
+    skipped = ()  # type: tuple
+    if config.use_read_model_projector() and config.use_event_outbox():
+        skipped += handlers.READ_MODEL_HANDLERS
+    if config.use_publish_outbox():
+        skipped += handlers.PUBLISH_HANDLERS
     injected_event_handlers = {
         event_type: [
             inject_dependencies(handler, dependencies)
             for handler in event_handlers
+            if handler not in skipped
         ]
         for event_type, event_handlers in handlers.EVENT_HANDLERS.items()
     }
@@ -32,12 +160,7 @@ def bootstrap(
         command_type: inject_dependencies(handler, dependencies)
         for command_type, handler in handlers.COMMAND_HANDLERS.items()
     }
-
-    return messagebus.MessageBus(
-        uow=uow,
-        event_handlers=injected_event_handlers,
-        command_handlers=injected_command_handlers,
-    )
+    return injected_event_handlers, injected_command_handlers
 
 
 def inject_dependencies(handler, dependencies):
@@ -47,4 +170,10 @@ def inject_dependencies(handler, dependencies):
         for name, dependency in dependencies.items()
         if name in params
     }
-    return lambda message: handler(message, **deps)
+    if asyncio.iscoroutinefunction(handler):
+        async def injected(message):
+            return await handler(message, **deps)
+    else:
+        injected = lambda message: handler(message, **deps)
+    # keep the handler's name: the outbox worker uses it as an idempotency key
+    return functools.wraps(handler)(injected)
@@ -9,6 +9,16 @@ def get_postgres_uri():
     return f"postgresql://{user}:{password}@{host}:{port}/{db_name}"
 
 
+def get_db_pool_settings():
+    return dict(
+        pool_size=int(os.environ.get('DB_POOL_SIZE', 5)),
+        max_overflow=int(os.environ.get('DB_MAX_OVERFLOW', 10)),
+        pool_timeout=float(os.environ.get('DB_POOL_TIMEOUT', 30)),
+        pool_pre_ping=os.environ.get('DB_POOL_PRE_PING', '1') == '1',
+        pool_recycle=int(os.environ.get('DB_POOL_RECYCLE', 1800)),
+    )
+
+
 def get_api_url():
     host = os.environ.get('API_HOST', 'localhost')
     port = 5005 if host == 'localhost' else 80
@@ -24,3 +34,66 @@ def get_email_host_and_port():
     port = 11025 if host == 'localhost' else 1025
     http_port = 18025 if host == 'localhost' else 8025
     return dict(host=host, port=port, http_port=http_port)
+
+def get_pooled_email_settings():
+    return dict(
+        pool_size=int(os.environ.get('EMAIL_POOL_SIZE', 0)),
+        digest_window=float(os.environ.get('EMAIL_DIGEST_WINDOW', 5)),
+    )
+
+def use_event_outbox():
+    return os.environ.get('EVENT_OUTBOX', '0') == '1'
+
+def use_publish_outbox():
+    return os.environ.get('PUBLISH_OUTBOX', '0') == '1'
+
+def get_outbox_relay_settings():
+    return dict(
+        batch_size=int(os.environ.get('OUTBOX_BATCH_SIZE', 100)),
+        flush_interval=float(os.environ.get('OUTBOX_FLUSH_INTERVAL', 0.5)),
+    )
+
+def get_outbox_retry_settings():
+    return dict(
+        max_attempts=int(os.environ.get('OUTBOX_MAX_ATTEMPTS', 10)),
+        base_delay=float(os.environ.get('OUTBOX_RETRY_BASE_DELAY', 1)),
+        max_delay=float(os.environ.get('OUTBOX_RETRY_MAX_DELAY', 300)),
+    )
+
+def get_redis_consumer_settings():
+    return dict(
+        mode=os.environ.get('REDIS_CONSUMER_MODE', 'pubsub'),
+        batch_size=int(os.environ.get('REDIS_CONSUMER_BATCH_SIZE', 100)),
+        workers=int(os.environ.get('REDIS_CONSUMER_WORKERS', os.cpu_count() or 1)),
+        min_idle_ms=int(os.environ.get('REDIS_CONSUMER_MIN_IDLE_MS', 60_000)),
+        claim_interval=float(os.environ.get('REDIS_CONSUMER_CLAIM_INTERVAL', 30)),
+        max_deliveries=int(os.environ.get('REDIS_CONSUMER_MAX_DELIVERIES', 5)),
+    )
+
+def get_orm_loading_strategy():
+    return os.environ.get('ORM_LOADING_STRATEGY', 'selectin')
+
+def get_product_cache_bytes():
+    return int(os.environ.get('PRODUCT_CACHE_BYTES', 0))
+
+def get_command_retry_settings():
+    return dict(
+        max_attempts=int(os.environ.get('COMMAND_MAX_ATTEMPTS', 3)),
+        base_delay=float(os.environ.get('COMMAND_RETRY_BASE_DELAY', 0.01)),
+        max_delay=float(os.environ.get('COMMAND_RETRY_MAX_DELAY', 0.5)),
+    )
+
+def get_sku_lock_stripes():
+    return int(os.environ.get('SKU_LOCK_STRIPES', 0))
+
+def get_sku_lock_max_stripes():
+    return int(os.environ.get('SKU_LOCK_MAX_STRIPES', 8))
+
+def use_read_model_projector():
+    return os.environ.get('READ_MODEL_PROJECTOR', '0') == '1'
+
+def get_allocations_cache_settings():
+    return dict(
+        max_entries=int(os.environ.get('ALLOCATIONS_CACHE_SIZE', 0)),
+        ttl=float(os.environ.get('ALLOCATIONS_CACHE_TTL', 30)),
+    )
@@ -1,6 +1,6 @@
 # pylint: disable=too-few-public-methods
 from datetime import date
-from typing import Optional
+from typing import List, Optional
 from dataclasses import dataclass
 
 class Command:
@@ -12,6 +12,10 @@ class Allocate(Command):
     sku: str
     qty: int
 
+@dataclass
+class AllocateMany(Command):
+    lines: List[Allocate]
+
 @dataclass
 class CreateBatch(Command):
     ref: str
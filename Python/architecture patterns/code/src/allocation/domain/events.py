@@ -1,5 +1,6 @@
 # pylint: disable=too-few-public-methods
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+from typing import List
 
 class Event:
     pass
@@ -20,3 +21,21 @@ class Deallocated(Event):
 @dataclass
 class OutOfStock(Event):
     sku: str
+
+@dataclass
+class Reallocated(Event):
+    sku: str
+    batchref: str
+    allocated: List[Allocated] = field(default_factory=list)
+    deallocated: List[Deallocated] = field(default_factory=list)
+
+    def __post_init__(self):
+        # accept the plain dicts we get back when deserialising
+        self.allocated = [
+            e if isinstance(e, Allocated) else Allocated(**e)
+            for e in self.allocated
+        ]
+        self.deallocated = [
+            e if isinstance(e, Deallocated) else Deallocated(**e)
+            for e in self.deallocated
+        ]
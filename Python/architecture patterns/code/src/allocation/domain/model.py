@@ -1,9 +1,18 @@
 from __future__ import annotations
+import bisect
 from dataclasses import dataclass
 from datetime import date
-from typing import Optional, List, Set
+from typing import Optional, List, Set, Dict, Tuple
 from . import commands, events
 
+# recount every batch's allocations whenever the running total is read and
+# fail loudly if they disagree. Too slow for production; the tests turn it on
+DEBUG_CHECKS = False
+# building a BatchIndex costs about three sorted scans of the batches
+# (bench_allocate), whatever their number, so a freshly loaded product is
+# scanned for its first few picks and only indexed once it keeps being used
+SCANS_BEFORE_INDEXING = 3
+
 
 class Product:
 
@@ -12,31 +21,139 @@ class Product:
         self.batches = batches
         self.version_number = version_number
         self.events = []  # type: List[events.Event]
+        self._index = None  # type: Optional[BatchIndex]
+        self._scans = 0
+
+    def add_batch(self, batch: Batch):
+        self.batches.append(batch)
+        if self._index is not None:
+            self._index.add(batch)
+        self.version_number += 1
 
     def allocate(self, line: OrderLine) -> str:
-        try:
-            batch = next(
-                b for b in sorted(self.batches) if b.can_allocate(line)
-            )
-            batch.allocate(line)
-            self.version_number += 1
-            self.events.append(events.Allocated(
-                orderid=line.orderid, sku=line.sku, qty=line.qty,
-                batchref=batch.reference,
-            ))
-            return batch.reference
-        except StopIteration:
+        batch = self._first_fit(line.qty)
+        if batch is None or not batch.can_allocate(line):
             self.events.append(events.OutOfStock(line.sku))
             return None
+        batch.allocate(line)
+        self._reindex(batch)
+        self.version_number += 1
+        self.events.append(events.Allocated(
+            orderid=line.orderid, sku=line.sku, qty=line.qty,
+            batchref=batch.reference,
+        ))
+        return batch.reference
+
+    def is_allocated(self, line: OrderLine) -> bool:
+        return any(line in batch._allocations for batch in self.batches)
 
     def change_batch_quantity(self, ref: str, qty: int):
         batch = next(b for b in self.batches if b.reference == ref)
         batch._purchased_quantity = qty
-        while batch.available_quantity < 0:
-            line = batch.deallocate_one()
-            self.events.append(
-                events.Deallocated(line.orderid, line.sku, line.qty)
-            )
+        freed = batch.deallocate_excess()
+        self._reindex(batch)
+        self.version_number += 1
+        if not freed:
+            return
+        reallocated = events.Reallocated(sku=self.sku, batchref=ref)
+        for line in freed:
+            target = self._first_fit(line.qty)
+            if target is None or not target.can_allocate(line):
+                reallocated.deallocated.append(
+                    events.Deallocated(line.orderid, line.sku, line.qty)
+                )
+                continue
+            target.allocate(line)
+            self._reindex(target)
+            reallocated.allocated.append(events.Allocated(
+                orderid=line.orderid, sku=line.sku, qty=line.qty,
+                batchref=target.reference,
+            ))
+        self.events.append(reallocated)
+        if reallocated.deallocated:
+            self.events.append(events.OutOfStock(self.sku))
+
+    def _first_fit(self, qty: int) -> Optional[Batch]:
+        if self._index is None and self._scans < SCANS_BEFORE_INDEXING:
+            self._scans += 1
+            return next((b for b in sorted(self.batches) if b.available_quantity >= qty), None)
+        return self._batch_index().first_fit(qty)
+
+    def _reindex(self, batch: Batch):
+        if self._index is not None:
+            self._batch_index().update(batch)
+
+    def _batch_index(self) -> BatchIndex:
+        # batches can be appended behind our back (the ORM, or old callers
+        # using product.batches.append), so rebuild if we're out of step
+        if self._index is None or len(self._index) != len(self.batches):
+            self._index = BatchIndex(self.batches)
+        return self._index
+
+
+def _eta_key(batch: Batch) -> Tuple[bool, Optional[date]]:
+    return (batch.eta is not None, batch.eta)
+
+
+class BatchIndex:
+    """
+    Batches kept in allocation preference order (warehouse stock first,
+    then by eta), with a max-tree over their available quantities so that
+    the first batch that can take a line is found in O(log n).
+    """
+
+    def __init__(self, batches: List[Batch]):
+        self._batches = sorted(batches, key=_eta_key)
+        self._keys = [_eta_key(b) for b in self._batches]
+        self._rebuild()
+
+    def __len__(self):
+        return len(self._batches)
+
+    def _rebuild(self):
+        self._size = 1
+        while self._size < len(self._batches):
+            self._size *= 2
+        self._positions = {
+            b.reference: i for i, b in enumerate(self._batches)
+        }  # type: Dict[str, int]
+        self._tree = [float('-inf')] * (2 * self._size)
+        for i, batch in enumerate(self._batches):
+            self._tree[self._size + i] = batch.available_quantity
+        for node in range(self._size - 1, 0, -1):
+            self._tree[node] = max(self._tree[2 * node], self._tree[2 * node + 1])
+
+    def add(self, batch: Batch):
+        key = _eta_key(batch)
+        position = bisect.bisect_right(self._keys, key)
+        self._keys.insert(position, key)
+        self._batches.insert(position, batch)
+        if position == len(self._batches) - 1 and position < self._size:
+            self._positions[batch.reference] = position
+            self._set(position, batch.available_quantity)
+        else:
+            self._rebuild()
+
+    def update(self, batch: Batch):
+        self._set(self._positions[batch.reference], batch.available_quantity)
+
+    def _set(self, position: int, available: int):
+        node = self._size + position
+        self._tree[node] = available
+        node //= 2
+        while node:
+            self._tree[node] = max(self._tree[2 * node], self._tree[2 * node + 1])
+            node //= 2
+
+    def first_fit(self, qty: int) -> Optional[Batch]:
+        if not self._batches or self._tree[1] < qty:
+            return None
+        node = 1
+        while node < self._size:
+            node *= 2
+            if self._tree[node] < qty:
+                node += 1
+        return self._batches[node - self._size]
 
 @dataclass(unsafe_hash=True)
 class OrderLine:
@@ -54,6 +171,7 @@ class Batch:
         self.eta = eta
         self._purchased_quantity = qty
         self._allocations = set()  # type: Set[OrderLine]
+        self._allocated_quantity = 0  # type: Optional[int]
 
     def __repr__(self):
         return f'<Batch {self.reference}>'
@@ -74,14 +192,56 @@ class Batch:
         return self.eta > other.eta
 
     def allocate(self, line: OrderLine):
-        if self.can_allocate(line):
+        if line not in self._allocations and self.can_allocate(line):
             self._allocations.add(line)
+            if self._allocated_quantity is not None:
+                self._allocated_quantity += line.qty
+
+    def deallocate(self, line: OrderLine):
+        self._allocations.remove(line)
+        if self._allocated_quantity is not None:
+            self._allocated_quantity -= line.qty
 
     def deallocate_one(self) -> OrderLine:
-        return self._allocations.pop()
+        line = next(iter(self._allocations))
+        self.deallocate(line)
+        return line
+
+    def deallocate_excess(self) -> List[OrderLine]:
+        """
+        Frees as few lines as possible to bring the batch back within its
+        purchased quantity: the smallest line that covers what's left over
+        if there is one, otherwise the largest, and repeat.
+        """
+        excess = -self.available_quantity
+        candidates = sorted(self._allocations, key=lambda l: (l.qty, l.orderid))
+        quantities = [line.qty for line in candidates]
+        freed = []
+        while excess > 0 and candidates:
+            i = min(bisect.bisect_left(quantities, excess), len(candidates) - 1)
+            quantities.pop(i)
+            line = candidates.pop(i)
+            freed.append(line)
+            excess -= line.qty
+        for line in freed:
+            self.deallocate(line)
+        return freed
 
     @property
     def allocated_quantity(self) -> int:
+        # None means the allocations were (re)loaded from the database
+        # and the total hasn't been worked out yet
+        if self._allocated_quantity is None:
+            self._allocated_quantity = self._count_allocated_quantity()
+        elif DEBUG_CHECKS:
+            recounted = self._count_allocated_quantity()
+            assert self._allocated_quantity == recounted, (
+                f'{self!r} thinks {self._allocated_quantity} is allocated,'
+                f' but its allocations add up to {recounted}'
+            )
+        return self._allocated_quantity
+
+    def _count_allocated_quantity(self) -> int:
         return sum(line.qty for line in self._allocations)
 
     @property
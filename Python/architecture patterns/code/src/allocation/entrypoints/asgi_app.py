@@ -0,0 +1,128 @@
+"""
+ASGI twin of flask_app, serving the same routes from an AsyncMessageBus.
+Run it under any ASGI server, eg ``uvicorn allocation.entrypoints.asgi_app:app``.
+"""
+import asyncio
+import json
+from datetime import datetime
+from typing import Optional
+from sqlalchemy import exc
+from allocation.domain import commands
+from allocation.service_layer.handlers import InvalidSku
+from allocation.service_layer.messagebus import AsyncMessageBus
+from allocation.service_layer.unit_of_work import ConcurrencyError
+from allocation import bootstrap, views
+
+bus = None  # type: Optional[AsyncMessageBus]
+
+
+def get_bus() -> AsyncMessageBus:
+    global bus  # pylint: disable=global-statement
+    if bus is None:
+        bus = bootstrap.bootstrap_async()
+    return bus
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+        return
+    body = await read_body(receive)
+    method, path = scope['method'], scope['path']
+    try:
+        if method == 'POST' and path == '/add_batch':
+            status, response = await add_batch(json.loads(body))
+        elif method == 'POST' and path == '/allocate':
+            status, response = await allocate_endpoint(json.loads(body))
+        elif method == 'POST' and path == '/allocate/bulk':
+            status, response = await allocate_bulk_endpoint(json.loads(body))
+        elif method == 'GET' and path.startswith('/allocations/'):
+            status, response = await allocations_view_endpoint(
+                path[len('/allocations/'):]
+            )
+        else:
+            status, response = 404, 'not found'
+    except InvalidSku as e:
+        status, response = 400, {'message': str(e)}
+    await send_response(send, status, response)
+
+
+async def add_batch(data):
+    eta = data['eta']
+    if eta is not None:
+        eta = datetime.fromisoformat(eta).date()
+    cmd = commands.CreateBatch(data['ref'], data['sku'], data['qty'], eta)
+    await get_bus().handle(cmd)
+    return 201, 'OK'
+
+
+async def allocate_endpoint(data):
+    cmd = commands.Allocate(data['orderid'], data['sku'], data['qty'])
+    await get_bus().handle(cmd)
+    return 202, 'OK'
+
+
+async def allocate_bulk_endpoint(data):
+    cmd = commands.AllocateMany([
+        commands.Allocate(line['orderid'], line['sku'], line['qty'])
+        for line in data['lines']
+    ])
+    # lines already allocated are skipped, so the whole request can be resent
+    try:
+        failed = await get_bus().handle(cmd)
+    except ConcurrencyError:
+        return 409, {'message': 'Conflicting allocation, try again'}
+    except exc.DBAPIError:
+        return 503, {'message': 'Database unavailable, try again'}
+    if failed:
+        # lines for the other skus were allocated, so only these need resending
+        status = 400 if failed.keys() >= {line.sku for line in cmd.lines} else 202
+        return status, {'failed': failed}
+    return 202, 'OK'
+
+
+async def allocations_view_endpoint(orderid):
+    the_bus = get_bus()
+    result = await asyncio.get_event_loop().run_in_executor(
+        the_bus.executor, views.allocations, orderid, the_bus.uow,
+    )
+    if not result:
+        return 404, 'not found'
+    return 200, result
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            get_bus()
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def read_body(receive) -> bytes:
+    body = b''
+    more_body = True
+    while more_body:
+        message = await receive()
+        body += message.get('body', b'')
+        more_body = message.get('more_body', False)
+    return body
+
+
+async def send_response(send, status, response):
+    if isinstance(response, str):
+        body, content_type = response.encode(), b'text/plain; charset=utf-8'
+    else:
+        body, content_type = json.dumps(response).encode(), b'application/json'
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [
+            (b'content-type', content_type),
+            (b'content-length', str(len(body)).encode()),
+        ],
+    })
+    await send({'type': 'http.response.body', 'body': body})
@@ -1,11 +1,27 @@
+import threading
 from datetime import datetime
+from typing import Optional
 from flask import Flask, jsonify, request
+from sqlalchemy import exc
 from allocation.domain import commands
 from allocation.service_layer.handlers import InvalidSku
+from allocation.service_layer.messagebus import MessageBus
+from allocation.service_layer.unit_of_work import ConcurrencyError
 from allocation import bootstrap, views
 
 app = Flask(__name__)
-bus = bootstrap.bootstrap()
+allocations_cache = bootstrap.default_allocations_cache()
+bus = None  # type: Optional[MessageBus]
+_bus_lock = threading.Lock()
+
+
+def get_bus() -> MessageBus:
+    # bootstrapped on the first request so importing the app stays cheap
+    global bus  # pylint: disable=global-statement
+    with _bus_lock:
+        if bus is None:
+            bus = bootstrap.bootstrap(allocations_cache=allocations_cache)
+    return bus
 
 
 @app.route("/add_batch", methods=['POST'])
@@ -16,7 +32,7 @@ def add_batch():
     cmd = commands.CreateBatch(
         request.json['ref'], request.json['sku'], request.json['qty'], eta,
     )
-    bus.handle(cmd)
+    get_bus().handle(cmd)
     return 'OK', 201
 
 
@@ -26,16 +42,41 @@ def allocate_endpoint():
         cmd = commands.Allocate(
             request.json['orderid'], request.json['sku'], request.json['qty'],
         )
-        bus.handle(cmd)
+        get_bus().handle(cmd)
     except InvalidSku as e:
         return jsonify({'message': str(e)}), 400
 
     return 'OK', 202
 
 
+@app.route("/allocate/bulk", methods=['POST'])
+def allocate_bulk_endpoint():
+    cmd = commands.AllocateMany([
+        commands.Allocate(line['orderid'], line['sku'], line['qty'])
+        for line in request.json['lines']
+    ])
+    # lines already allocated are skipped, so the whole request can be resent
+    try:
+        failed = get_bus().handle(cmd)
+    except ConcurrencyError:
+        return jsonify({'message': 'Conflicting allocation, try again'}), 409
+    except exc.DBAPIError:
+        return jsonify({'message': 'Database unavailable, try again'}), 503
+    if failed:
+        # lines for the other skus were allocated, so only these need resending
+        status = 400 if failed.keys() >= {line.sku for line in cmd.lines} else 202
+        return jsonify({'failed': failed}), status
+
+    return 'OK', 202
+
+
 @app.route("/allocations/<orderid>", methods=['GET'])
 def allocations_view_endpoint(orderid):
-    result = views.allocations(orderid, bus.uow)
+    result = views.allocations(orderid, get_bus().uow, allocations_cache)
     if not result:
         return 'not found', 404
-    return jsonify(result), 200
+    response = jsonify(result)
+    response.set_etag(views.etag(result))
+    # clients may keep it, but must check the etag before reusing it
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
@@ -0,0 +1,17 @@
+import logging
+
+from allocation import bootstrap
+from allocation.service_layer.outbox_worker import OutboxWorker
+
+logger = logging.getLogger(__name__)
+
+
+def main():
+    logger.info('Outbox worker starting')
+    bus = bootstrap.bootstrap()
+    worker = OutboxWorker(bus.uow.session_factory, bus.event_handlers, metrics=bus.metrics)
+    worker.run_forever()
+
+
+if __name__ == '__main__':
+    main()
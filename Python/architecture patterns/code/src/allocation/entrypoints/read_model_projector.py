@@ -0,0 +1,20 @@
+import logging
+import sys
+
+from allocation.service_layer import unit_of_work
+from allocation.service_layer.projector import AllocationsViewProjector
+
+logger = logging.getLogger(__name__)
+
+
+def main():
+    projector = AllocationsViewProjector(unit_of_work.DEFAULT_SESSION_FACTORY)
+    if '--rebuild' in sys.argv[1:]:
+        logger.info('Rebuilding allocations_view')
+        projector.rebuild()
+    logger.info('Read model projector starting')
+    projector.run_forever()
+
+
+if __name__ == '__main__':
+    main()
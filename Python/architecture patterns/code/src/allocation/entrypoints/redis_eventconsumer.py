@@ -1,20 +1,36 @@
 import json
 import logging
+import socket
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, List, Tuple
 import redis
 
-from allocation import bootstrap, config
+from allocation import bootstrap, config, views
+from allocation.adapters import redis_eventpublisher
 from allocation.domain import commands
 
 logger = logging.getLogger(__name__)
 
-r = redis.Redis(**config.get_redis_host_and_port())
-
 
 
 def main():
+    settings = config.get_redis_consumer_settings()
+    if settings['mode'] == 'streams':
+        logger.info('Redis stream consumer starting')
+        bus = bootstrap.bootstrap()
+        consumer = StreamConsumer(
+            bus, batch_size=settings['batch_size'], workers=settings['workers'],
+            min_idle_ms=settings['min_idle_ms'], claim_interval=settings['claim_interval'],
+            max_deliveries=settings['max_deliveries'],
+        )
+        consumer.run_forever()
+        return
+
     logger.info('Redis pubsub starting')
     bus = bootstrap.bootstrap()
-    pubsub = r.pubsub(ignore_subscribe_messages=True)
+    pubsub = redis_eventpublisher.get_redis().pubsub(ignore_subscribe_messages=True)
     pubsub.subscribe('change_batch_quantity')
 
     for m in pubsub.listen():
@@ -28,5 +44,205 @@ def handle_change_batch_quantity(m, bus):
     bus.handle(cmd)
 
 
+class StreamConsumer:
+    """
+    Reads change_batch_quantity from a redis stream as part of a consumer
+    group, batch_size entries at a time. Within a batch only the last
+    quantity for each batchref is applied. Commands are handed to one of
+    `workers` single-threaded executors chosen by sku, so each product's
+    changes still happen in order while different products run in parallel.
+    Entries are acked once their command has been handled. Failures stay
+    pending in the group and are handled again: on startup recover() goes
+    through the entries this consumer was given but never acked, and every
+    claim_interval seconds claim_idle() takes over any entry that has been
+    pending for min_idle_ms, whoever it was given to.
+
+    The last entry id applied for each batchref is kept in a redis hash, so
+    a redelivered entry older than that is acked without being applied
+    again: it would undo the newer quantity. Entries that can't be decoded,
+    or name a batch that doesn't exist, are moved to dead_letter_stream
+    straight away, and ones that have failed max_deliveries times after
+    that; either way they are acked, so they stop coming back.
+    """
+
+    def __init__(
+        self,
+        bus,
+        redis_client=None,
+        stream: str = 'change_batch_quantity',
+        group: str = 'allocation',
+        consumer: str = None,
+        batch_size: int = 100,
+        block_ms: int = 1000,
+        workers: int = 1,
+        skus_for_batches: Callable[[Iterable[str]], Dict[str, str]] = None,
+        min_idle_ms: int = 60_000,
+        claim_interval: float = 30.0,
+        max_deliveries: int = 5,
+        dead_letter_stream: str = None,
+    ):
+        self.bus = bus
+        self.redis = redis_client or redis_eventpublisher.get_redis()
+        self.stream = stream
+        self.group = group
+        self.consumer = consumer or socket.gethostname()
+        self.batch_size = batch_size
+        self.block_ms = block_ms
+        self.shards = [ThreadPoolExecutor(max_workers=1) for _ in range(workers)]
+        self.skus_for_batches = skus_for_batches or (
+            lambda batchrefs: views.skus_for_batches(batchrefs, bus.uow)
+        )
+        self.min_idle_ms = min_idle_ms
+        self.claim_interval = claim_interval
+        self._next_claim = time.monotonic() + claim_interval
+        self.max_deliveries = max_deliveries
+        self.dead_letter_stream = dead_letter_stream or f'{stream}:dead-letter'
+        self.applied_key = f'{stream}:{group}:applied'
+
+    def ensure_group(self):
+        try:
+            self.redis.xgroup_create(self.stream, self.group, id='0', mkstream=True)
+        except redis.ResponseError as e:
+            if 'BUSYGROUP' not in str(e):
+                raise
+
+    def run_forever(self):
+        self.ensure_group()
+        self.recover()
+        while True:
+            self.poll()
+
+    def poll(self) -> int:
+        handled = 0
+        if time.monotonic() >= self._next_claim:
+            handled += self.claim_idle()
+            self._next_claim = time.monotonic() + self.claim_interval
+        response = self.redis.xreadgroup(
+            self.group, self.consumer, {self.stream: '>'},
+            count=self.batch_size, block=self.block_ms,
+        )
+        return handled + self._handle(self._entries(response))
+
+    def recover(self) -> int:
+        # reading from an id rather than '>' gives back our own pending entries
+        handled, last_id = 0, '0'
+        while True:
+            response = self.redis.xreadgroup(
+                self.group, self.consumer, {self.stream: last_id}, count=self.batch_size,
+            )
+            entries = self._entries(response)
+            if not entries:
+                return handled
+            handled += self._handle(entries, redelivered=True)
+            last_id = entries[-1][0]
+
+    def claim_idle(self) -> int:
+        handled, start_id = 0, '0-0'
+        while True:
+            next_id, entries = self.redis.xautoclaim(
+                self.stream, self.group, self.consumer, self.min_idle_ms,
+                start_id=start_id, count=self.batch_size,
+            )[:2]
+            # entries deleted from the stream meanwhile come back empty
+            handled += self._handle([entry for entry in entries if entry[1]], redelivered=True)
+            if next_id in (b'0-0', '0-0'):
+                return handled
+            start_id = next_id
+
+    @staticmethod
+    def _entries(response) -> List:
+        return [entry for _, stream_entries in response or [] for entry in stream_entries]
+
+    def _handle(self, entries, redelivered=False) -> int:
+        if not entries:
+            return 0
+
+        latest = {}  # type: Dict[str, commands.ChangeBatchQuantity]
+        ids_by_ref = {}  # type: Dict[str, List]
+        fields_by_id = {}
+        dead = []  # type: List[Tuple[bytes, str]]
+        for entry_id, fields in entries:
+            fields_by_id[entry_id] = fields
+            try:
+                data = json.loads(fields.get(b'data') or fields['data'])
+                cmd = commands.ChangeBatchQuantity(ref=data['batchref'], qty=data['qty'])
+            except (ValueError, KeyError, TypeError) as e:
+                dead.append((entry_id, f'undecodable: {e!r}'))
+                continue
+            latest.pop(cmd.ref, None)
+            latest[cmd.ref] = cmd
+            ids_by_ref.setdefault(cmd.ref, []).append(entry_id)
+
+        # only entries read before can be older than one already applied
+        superseded = self._superseded(ids_by_ref) if redelivered else []
+        for ref in superseded:
+            del latest[ref]
+        skus = self.skus_for_batches(latest)
+        for ref in [ref for ref in latest if ref not in skus]:
+            del latest[ref]
+            dead.extend((entry_id, 'unknown batchref') for entry_id in ids_by_ref[ref])
+
+        futures = {
+            ref: self._shard_for(skus[ref]).submit(self.bus.handle, cmd)
+            for ref, cmd in latest.items()
+        }
+        applied = {}
+        for ref, future in futures.items():
+            try:
+                future.result()
+            except Exception as e:  # pylint: disable=broad-except
+                logger.exception('Exception handling %s', latest[ref])
+                dead.extend(
+                    (entry_id, f'failed {self.max_deliveries} times: {e!r}')
+                    for entry_id in self._given_up(ids_by_ref[ref])
+                )
+                continue
+            applied[ref] = ids_by_ref[ref][-1]
+
+        for entry_id, reason in dead:
+            logger.error('Dead-lettering %s: %s', entry_id, reason)
+            self.redis.xadd(self.dead_letter_stream, dict(
+                fields_by_id[entry_id], id=entry_id, reason=reason,
+            ))
+        acked = [entry_id for ref in [*superseded, *applied] for entry_id in ids_by_ref[ref]]
+        acked += [entry_id for entry_id, _ in dead]
+        if acked:
+            with self.redis.pipeline(transaction=False) as pipe:
+                if applied:
+                    pipe.hset(self.applied_key, mapping=applied)
+                pipe.xack(self.stream, self.group, *acked)
+                pipe.execute()
+        return len(acked)
+
+    def _superseded(self, ids_by_ref: Dict[str, List]) -> List[str]:
+        refs = list(ids_by_ref)
+        applied = dict(zip(refs, self.redis.hmget(self.applied_key, refs)))
+        return [
+            ref for ref in refs
+            if applied[ref] and id_key(ids_by_ref[ref][-1]) <= id_key(applied[ref])
+        ]
+
+    def _given_up(self, entry_ids: List) -> List:
+        given_up = []
+        for entry_id in entry_ids:
+            pending = self.redis.xpending_range(
+                self.stream, self.group, min=entry_id, max=entry_id, count=1,
+            )
+            if pending and pending[0]['times_delivered'] >= self.max_deliveries:
+                given_up.append(entry_id)
+        return given_up
+
+    def _shard_for(self, key: str) -> ThreadPoolExecutor:
+        return self.shards[zlib.crc32(key.encode()) % len(self.shards)]
+
+
+def id_key(entry_id) -> Tuple[int, int]:
+    # stream ids are "<ms>-<seq>", which don't sort as strings
+    if isinstance(entry_id, bytes):
+        entry_id = entry_id.decode()
+    ms, _, seq = entry_id.partition('-')
+    return int(ms), int(seq or 0)
+
+
 if __name__ == '__main__':
     main()
@@ -0,0 +1,19 @@
+import logging
+
+from allocation import config
+from allocation.adapters.redis_eventpublisher import OutboxRelay
+from allocation.service_layer import unit_of_work
+
+logger = logging.getLogger(__name__)
+
+
+def main():
+    logger.info('Redis outbox relay starting')
+    relay = OutboxRelay(
+        unit_of_work.DEFAULT_SESSION_FACTORY, **config.get_outbox_relay_settings()
+    )
+    relay.run_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,14 @@
 #pylint: disable=unused-argument
 from __future__ import annotations
+from collections import defaultdict
 from dataclasses import asdict
-from typing import List, Dict, Callable, Type, TYPE_CHECKING
+from typing import List, Dict, Callable, Optional, Type, TYPE_CHECKING
 from allocation.domain import commands, events, model
 from allocation.domain.model import OrderLine
+from . import projector
 if TYPE_CHECKING:
     from allocation.adapters import notifications
+    from allocation.adapters.allocations_cache import AllocationsCache
     from . import unit_of_work
 
 
@@ -22,7 +25,7 @@ def add_batch(
         if product is None:
             product = model.Product(cmd.sku, batches=[])
             uow.products.add(product)
-        product.batches.append(model.Batch(
+        product.add_batch(model.Batch(
             cmd.ref, cmd.sku, cmd.qty, cmd.eta
         ))
         uow.commit()
@@ -40,6 +43,34 @@ def allocate(
         uow.commit()
 
 
+def allocate_many(
+        cmd: commands.AllocateMany, uow: unit_of_work.AbstractUnitOfWork
+) -> Dict[str, str]:
+    """
+    Commits product by product, so an invalid sku doesn't hold up the rest.
+    Returns {sku: why} for the skus whose lines weren't allocated; lines for
+    every other sku were, and their events are collected as usual. A commit
+    that fails raises, for the bus to retry the command: the products
+    committed before it already hold their lines, which are skipped.
+    """
+    lines_by_sku = defaultdict(list)  # type: Dict[str, List[OrderLine]]
+    for line in cmd.lines:
+        lines_by_sku[line.sku].append(OrderLine(line.orderid, line.sku, line.qty))
+    failed = {}  # type: Dict[str, str]
+    with uow:
+        products = uow.products.get_many(lines_by_sku)
+        for sku, lines in lines_by_sku.items():
+            product = products[sku]
+            if product is None:
+                failed[sku] = f'Invalid sku {sku}'
+                continue
+            for line in lines:
+                if not product.is_allocated(line):
+                    product.allocate(line)
+            uow.commit()
+    return failed
+
+
 def reallocate(
         event: events.Deallocated, uow: unit_of_work.AbstractUnitOfWork
 ):
@@ -72,15 +103,18 @@ def publish_allocated_event(
     publish('line_allocated', event)
 
 
+def publish_reallocated_event(
+        event: events.Reallocated, publish: Callable,
+):
+    for allocated in event.allocated:
+        publish('line_allocated', allocated)
+
+
 def add_allocation_to_read_model(
         event: events.Allocated, uow: unit_of_work.SqlAlchemyUnitOfWork,
 ):
     with uow:
-        uow.session.execute(
-            'INSERT INTO allocations_view (orderid, sku, batchref)'
-            ' VALUES (:orderid, :sku, :batchref)',
-            dict(orderid=event.orderid, sku=event.sku, batchref=event.batchref)
-        )
+        projector.apply(uow.session, [event])
         uow.commit()
 
 
@@ -88,22 +122,59 @@ def remove_allocation_from_read_model(
         event: events.Deallocated, uow: unit_of_work.SqlAlchemyUnitOfWork,
 ):
     with uow:
-        uow.session.execute(
-            'DELETE FROM allocations_view '
-            ' WHERE orderid = :orderid AND sku = :sku',
-            dict(orderid=event.orderid, sku=event.sku)
-        )
+        projector.apply(uow.session, [event])
         uow.commit()
 
 
+def update_read_model_for_reallocation(
+        event: events.Reallocated, uow: unit_of_work.SqlAlchemyUnitOfWork,
+):
+    with uow:
+        projector.apply(uow.session, [event])
+        uow.commit()
+
+
+def invalidate_cached_allocations(
+        event: events.Event, allocations_cache: Optional[AllocationsCache],
+):
+    if allocations_cache is None:
+        return
+    if isinstance(event, events.Reallocated):
+        changed = event.allocated + event.deallocated  # type: List[events.Event]
+    else:
+        changed = [event]
+    for e in changed:
+        allocations_cache.invalidate(e.orderid)
+
+
+PUBLISH_HANDLERS = (publish_allocated_event, publish_reallocated_event)
+
+READ_MODEL_HANDLERS = (
+    add_allocation_to_read_model,
+    remove_allocation_from_read_model,
+    update_read_model_for_reallocation,
+)
+
+
 EVENT_HANDLERS = {
-    events.Allocated: [publish_allocated_event, add_allocation_to_read_model],
-    events.Deallocated: [remove_allocation_from_read_model, reallocate],
+    events.Allocated: [
+        publish_allocated_event, add_allocation_to_read_model,
+        invalidate_cached_allocations,
+    ],
+    events.Deallocated: [
+        remove_allocation_from_read_model, invalidate_cached_allocations,
+        reallocate,
+    ],
+    events.Reallocated: [
+        publish_reallocated_event, update_read_model_for_reallocation,
+        invalidate_cached_allocations,
+    ],
     events.OutOfStock: [send_out_of_stock_notification],
 }  # type: Dict[Type[events.Event], List[Callable]]
 
 COMMAND_HANDLERS = {
     commands.Allocate: allocate,
+    commands.AllocateMany: allocate_many,
     commands.CreateBatch: add_batch,
     commands.ChangeBatchQuantity: change_batch_quantity,
 }  # type: Dict[Type[commands.Command], Callable]
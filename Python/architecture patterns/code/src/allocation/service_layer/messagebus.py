@@ -1,17 +1,62 @@
-# pylint: disable=broad-except, attribute-defined-outside-init
+# pylint: disable=broad-except
 from __future__ import annotations
+import asyncio
+import contextvars
+import functools
 import logging
-from typing import Callable, Dict, List, Union, Type, TYPE_CHECKING
+import random
+import time
+from collections import deque
+from concurrent.futures import Executor
+from dataclasses import dataclass
+from typing import Any, Callable, Deque, Dict, List, Tuple, Union, Type
+from allocation.adapters.metrics import AbstractMetrics, NullMetrics
 from allocation.domain import commands, events
-
-if TYPE_CHECKING:
-    from . import unit_of_work
+from . import unit_of_work
 
 logger = logging.getLogger(__name__)
 
 Message = Union[commands.Command, events.Event]
 
 
+@dataclass(frozen=True)
+class RetryPolicy:
+    """
+    How often to re-run a command whose unit of work lost a race on the
+    same product. Waits are "full jitter": a random time up to an
+    exponentially growing cap, so retrying callers don't collide again.
+    """
+    max_attempts: int = 3
+    base_delay: float = 0.01
+    max_delay: float = 0.5
+    retry_on: Tuple[Type[Exception], ...] = (unit_of_work.ConcurrencyError,)
+
+    def delay(self, attempt: int) -> float:
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+
+NO_RETRY = RetryPolicy(max_attempts=1)
+
+
+def dispatch_table(
+    handle_event: Callable, handle_command: Callable,
+    event_handlers: Dict[Type[events.Event], List[Callable]],
+    command_handlers: Dict[Type[commands.Command], Callable],
+) -> Dict[type, Callable]:
+    table = {}  # type: Dict[type, Callable]
+    for event_type, handlers in event_handlers.items():
+        table[event_type] = functools.partial(
+            handle_event, handlers=handlers,
+            metric=f'messagebus.{event_type.__name__}',
+        )
+    for command_type, handler in command_handlers.items():
+        table[command_type] = functools.partial(
+            handle_command, handler=handler,
+            metric=f'messagebus.{command_type.__name__}',
+        )
+    return table
+
+
 class MessageBus:
 
     def __init__(
@@ -19,40 +64,198 @@ class MessageBus:
         uow: unit_of_work.AbstractUnitOfWork,
         event_handlers: Dict[Type[events.Event], List[Callable]],
         command_handlers: Dict[Type[commands.Command], Callable],
+        metrics: AbstractMetrics = None,
+        retry: RetryPolicy = NO_RETRY,
     ):
         self.uow = uow
         self.event_handlers = event_handlers
         self.command_handlers = command_handlers
+        self.metrics = metrics or NullMetrics()
+        self.retry = retry
+        self._dispatch = dispatch_table(
+            self.handle_event, self.handle_command,
+            event_handlers, command_handlers,
+        )
 
-    def handle(self, message: Message):
-        self.queue = [message]
-        while self.queue:
-            message = self.queue.pop(0)
-            if isinstance(message, events.Event):
-                self.handle_event(message)
-            elif isinstance(message, commands.Command):
-                self.handle_command(message)
-            else:
-                raise Exception(f'{message} was not an Event or Command')
+    def handle(self, message: Message) -> Any:
+        """Returns whatever the handler for message, if a command, returned."""
+        queue = deque()  # type: Deque[Message]
+        try:
+            return self._dispatch_message(message, queue)
+        finally:
+            # even if the command failed, what it did commit happened
+            while queue:
+                self._dispatch_message(queue.popleft(), queue)
 
+    def _dispatch_message(self, message: Message, queue: Deque[Message]) -> Any:
+        dispatch = self._dispatch.get(type(message))
+        if dispatch is None:
+            raise Exception(f'{message} was not an Event or Command we handle')
+        return dispatch(message, queue)
 
-    def handle_event(self, event: events.Event):
-        for handler in self.event_handlers[type(event)]:
+
+    def handle_event(
+        self, event: events.Event, queue: Deque[Message],
+        handlers: List[Callable], metric: str,
+    ):
+        started = time.perf_counter()
+        failed = False
+        for handler in handlers:
             try:
                 logger.debug('handling event %s with handler %s', event, handler)
                 handler(event)
-                self.queue.extend(self.uow.collect_new_events())
             except Exception:
                 logger.exception('Exception handling event %s', event)
+                self.metrics.increment(f'{metric}.failed')
+                failed = True
                 continue
+            finally:
+                queue.extend(self.uow.collect_new_events())
+        if not failed:
+            self.metrics.increment(f'{metric}.handled')
+        self.metrics.timing(metric, time.perf_counter() - started)
+
+
+    def handle_command(
+        self, command: commands.Command, queue: Deque[Message],
+        handler: Callable, metric: str,
+    ):
+        logger.debug('handling command %s', command)
+        started = time.perf_counter()
+        try:
+            for attempt in range(1, self.retry.max_attempts + 1):
+                try:
+                    result = handler(command)
+                    break
+                except self.retry.retry_on:
+                    if attempt == self.retry.max_attempts:
+                        raise
+                    logger.info('retrying command %s, attempt %s', command, attempt)
+                    self.metrics.increment(f'{metric}.retried')
+                    time.sleep(self.retry.delay(attempt))
+                finally:
+                    # what a failed attempt committed before failing stays
+                    queue.extend(self.uow.collect_new_events())
+        except Exception:
+            logger.exception('Exception handling command %s', command)
+            self.metrics.increment(f'{metric}.failed')
+            raise
+        finally:
+            self.metrics.timing(metric, time.perf_counter() - started)
+        self.metrics.increment(f'{metric}.handled')
+        return result
+
+
+
+class AsyncMessageBus:
+    """
+    Same handlers, same dispatch rules as MessageBus, but awaitable:
+    coroutine handlers are awaited, plain ones run on an executor thread,
+    and the handlers for a single event run concurrently.
+    """
 
+    def __init__(
+        self,
+        uow: unit_of_work.AbstractUnitOfWork,
+        event_handlers: Dict[Type[events.Event], List[Callable]],
+        command_handlers: Dict[Type[commands.Command], Callable],
+        metrics: AbstractMetrics = None,
+        executor: Executor = None,
+        retry: RetryPolicy = NO_RETRY,
+    ):
+        self.uow = uow
+        self.event_handlers = event_handlers
+        self.command_handlers = command_handlers
+        self.metrics = metrics or NullMetrics()
+        self.executor = executor
+        self.retry = retry
+        self._dispatch = dispatch_table(
+            self.handle_event, self.handle_command,
+            event_handlers, command_handlers,
+        )
+
+    async def handle(self, message: Message) -> Any:
+        """Returns whatever the handler for message, if a command, returned."""
+        queue = deque()  # type: Deque[Message]
+        try:
+            return await self._dispatch_message(message, queue)
+        finally:
+            # even if the command failed, what it did commit happened
+            while queue:
+                await self._dispatch_message(queue.popleft(), queue)
 
-    def handle_command(self, command: commands.Command):
+    async def _dispatch_message(self, message: Message, queue: Deque[Message]) -> Any:
+        dispatch = self._dispatch.get(type(message))
+        if dispatch is None:
+            raise Exception(f'{message} was not an Event or Command we handle')
+        return await dispatch(message, queue)
+
+
+    async def handle_event(
+        self, event: events.Event, queue: Deque[Message],
+        handlers: List[Callable], metric: str,
+    ):
+        logger.debug('handling event %s with handlers %s', event, handlers)
+        started = time.perf_counter()
+        results = await asyncio.gather(
+            *(self._run(handler, event, queue) for handler in handlers),
+            return_exceptions=True,
+        )
+        failures = [result for result in results if isinstance(result, Exception)]
+        for failure in failures:
+            logger.error(
+                'Exception handling event %s', event, exc_info=failure,
+            )
+            self.metrics.increment(f'{metric}.failed')
+        if not failures:
+            self.metrics.increment(f'{metric}.handled')
+        self.metrics.timing(metric, time.perf_counter() - started)
+
+
+    async def handle_command(
+        self, command: commands.Command, queue: Deque[Message],
+        handler: Callable, metric: str,
+    ):
         logger.debug('handling command %s', command)
+        started = time.perf_counter()
         try:
-            handler = self.command_handlers[type(command)]
-            handler(command)
-            self.queue.extend(self.uow.collect_new_events())
+            for attempt in range(1, self.retry.max_attempts + 1):
+                try:
+                    result = await self._run(handler, command, queue)
+                    break
+                except self.retry.retry_on:
+                    if attempt == self.retry.max_attempts:
+                        raise
+                    logger.info('retrying command %s, attempt %s', command, attempt)
+                    self.metrics.increment(f'{metric}.retried')
+                    await asyncio.sleep(self.retry.delay(attempt))
         except Exception:
             logger.exception('Exception handling command %s', command)
+            self.metrics.increment(f'{metric}.failed')
             raise
+        finally:
+            self.metrics.timing(metric, time.perf_counter() - started)
+        self.metrics.increment(f'{metric}.handled')
+        return result
+
+
+    async def _run(self, handler: Callable, message: Message, queue: Deque[Message]) -> Any:
+        """Runs handler, adding the events of what it committed to queue, even if it fails."""
+        if asyncio.iscoroutinefunction(handler):
+            try:
+                return await handler(message)
+            finally:
+                queue.extend(self.uow.collect_new_events())
+        # the handler enters the uow on the executor thread, so collect its
+        # events there too, inside the same copy of the context
+        context = contextvars.copy_context()
+        return await asyncio.get_event_loop().run_in_executor(
+            self.executor,
+            functools.partial(context.run, self._run_sync, handler, message, queue),
+        )
+
+    def _run_sync(self, handler: Callable, message: Message, queue: Deque[Message]) -> Any:
+        try:
+            return handler(message)
+        finally:
+            queue.extend(self.uow.collect_new_events())
@@ -0,0 +1,125 @@
+# pylint: disable=broad-except
+from __future__ import annotations
+import logging
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Set, Tuple, Type
+from allocation import config
+from allocation.adapters import outbox
+from allocation.adapters.metrics import AbstractMetrics, NullMetrics
+from allocation.domain import events
+from allocation.service_layer import messagebus
+
+logger = logging.getLogger(__name__)
+
+
+def handler_key(handler: Callable) -> str:
+    return f'{handler.__module__}.{handler.__qualname__}'
+
+
+class OutboxWorker:
+    """
+    Drains the event_outbox table and runs EVENT_HANDLERS on a thread pool.
+
+    Delivery is at-least-once: a handler that fails (or a worker that dies)
+    leaves its row pending and it is retried on a later drain, after a
+    backoff from retry, until retry.max_attempts is used up and the row is
+    dead-lettered. Handlers that already succeeded for a row are recorded
+    under handler_key and are not run again, and the ones writing the read
+    model are idempotent, so one that succeeded without being recorded
+    can safely run twice. Rows are partitioned by sku and each partition
+    is handled in id order, so events about one product never overtake
+    each other; a failure holds back the rest of that product's events
+    until it is retried or dead-lettered, but not anyone else's.
+    """
+
+    def __init__(
+        self,
+        session_factory: Callable,
+        event_handlers: Dict[Type[events.Event], List[Callable]],
+        batch_size: int = 100,
+        max_workers: int = 4,
+        metrics: AbstractMetrics = None,
+        retry: messagebus.RetryPolicy = None,
+    ):
+        self.session_factory = session_factory
+        self.event_handlers = event_handlers
+        self.batch_size = batch_size
+        self.metrics = metrics or NullMetrics()
+        self.retry = retry or messagebus.RetryPolicy(**config.get_outbox_retry_settings())
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def drain(self) -> int:
+        session = self.session_factory()
+        try:
+            rows = outbox.pending(session, self.batch_size)
+            done = outbox.handled(session, [row[0] for row in rows])
+        finally:
+            session.close()
+
+        partitions = defaultdict(list)  # type: Dict[str, List[Tuple[int, str, str, str]]]
+        for row in rows:
+            partitions[row[3]].append(row)
+        futures = [
+            self.executor.submit(self._handle_partition, partition, done)
+            for partition in partitions.values()
+        ]
+        return sum(future.result() for future in futures)
+
+    def run_forever(self, poll_interval: float = 1.0, stop: threading.Event = None):
+        stop = stop or threading.Event()
+        while not stop.is_set():
+            if not self.drain():
+                stop.wait(poll_interval)
+
+    def _handle_partition(self, rows, done: Set[Tuple[int, str]]) -> int:
+        processed = 0
+        for outbox_id, event_type, payload, _ in rows:
+            if not self._handle(outbox_id, event_type, payload, done):
+                break
+            processed += 1
+        return processed
+
+    def _handle(self, outbox_id, event_type, payload, done) -> bool:
+        event = outbox.deserialize(event_type, payload)
+        for handler in self.event_handlers.get(type(event), []):
+            key = handler_key(handler)
+            if (outbox_id, key) in done:
+                continue
+            try:
+                logger.debug('handling event %s with handler %s', event, handler)
+                handler(event)
+            except Exception:
+                logger.exception('Exception handling event %s', event)
+                self.metrics.increment(f'outbox.{event_type}.failed')
+                self._failed(outbox_id, event_type)
+                return False
+            self._record(outbox.mark_handled, outbox_id, key)
+        self._record(outbox.mark_processed, outbox_id)
+        self.metrics.increment(f'outbox.{event_type}.handled')
+        return True
+
+    def _failed(self, outbox_id, event_type):
+        session = self.session_factory()
+        try:
+            attempts = outbox.mark_failed(session, outbox_id)
+            if attempts >= self.retry.max_attempts:
+                logger.error('Giving up on outbox row %s after %s attempts', outbox_id, attempts)
+                outbox.mark_dead_lettered(session, outbox_id)
+                self.metrics.increment(f'outbox.{event_type}.dead_lettered')
+            else:
+                delay = timedelta(seconds=self.retry.delay(attempts))
+                outbox.retry_at(session, outbox_id, datetime.utcnow() + delay)
+            session.commit()
+        finally:
+            session.close()
+
+    def _record(self, mark: Callable, *args):
+        session = self.session_factory()
+        try:
+            mark(session, *args)
+            session.commit()
+        finally:
+            session.close()
@@ -0,0 +1,235 @@
+from __future__ import annotations
+import itertools
+import json
+import logging
+import threading
+from datetime import datetime, timedelta
+from typing import Callable, Dict, Iterable, List, Tuple
+from sqlalchemy import text
+from allocation.adapters import outbox
+from allocation.domain import events
+
+logger = logging.getLogger(__name__)
+
+# the outbox worker delivers at least once, so an Allocated seen twice
+# must not add a second row
+INSERT = (
+    'INSERT INTO allocations_view (orderid, sku, batchref)'
+    ' SELECT :orderid, :sku, :batchref WHERE NOT EXISTS ('
+    ' SELECT 1 FROM allocations_view WHERE orderid = :orderid AND sku = :sku)'
+)
+UPDATE = (
+    'UPDATE allocations_view SET batchref = :batchref'
+    ' WHERE orderid = :orderid AND sku = :sku'
+)
+DELETE = (
+    'DELETE FROM allocations_view'
+    ' WHERE orderid = :orderid AND sku = :sku'
+)
+REBUILD_QUERY = (
+    'SELECT order_lines.orderid, order_lines.sku, batches.reference'
+    ' FROM allocations'
+    ' JOIN batches ON allocations.batch_id = batches.id'
+    ' JOIN order_lines ON allocations.orderline_id = order_lines.id'
+    ' ORDER BY allocations.id'
+)
+
+
+def statements_for(event: events.Event) -> List[Tuple[str, dict]]:
+    if isinstance(event, events.Allocated):
+        return [(INSERT, dict(orderid=event.orderid, sku=event.sku, batchref=event.batchref))]
+    if isinstance(event, events.Deallocated):
+        return [(DELETE, dict(orderid=event.orderid, sku=event.sku))]
+    if isinstance(event, events.Reallocated):
+        return [
+            (UPDATE, dict(orderid=e.orderid, sku=e.sku, batchref=e.batchref))
+            for e in event.allocated
+        ] + [
+            (DELETE, dict(orderid=e.orderid, sku=e.sku))
+            for e in event.deallocated
+        ]
+    return []
+
+
+def apply(session, projected: Iterable[events.Event]):
+    """Writes the events to allocations_view, one executemany per run of alike statements."""
+    statements = itertools.chain.from_iterable(statements_for(e) for e in projected)
+    for statement, run in itertools.groupby(statements, key=lambda s: s[0]):
+        session.execute(statement, [params for _, params in run])
+
+
+class AllocationsViewProjector:
+    """
+    Keeps allocations_view up to date from the event_outbox table, so the
+    app can run with EVENT_OUTBOX and leave the read model to this instead
+    of a unit of work per event.
+
+    Events are buffered and each flush writes them, together with the id
+    of the last one as this projection's checkpoint, in one transaction.
+    Outbox ids are handed out before commit, so a gap in them may just be
+    a transaction that hasn't committed yet: catch_up waits gap_timeout
+    for it before skipping past. Skipped ids are kept with the checkpoint,
+    so a gap only holds the projection up once, and a row that commits
+    after its gap was passed is still projected, as long as that happens
+    within skipped_ttl.
+    """
+
+    def __init__(
+        self,
+        session_factory: Callable,
+        name: str = 'allocations_view',
+        batch_size: int = 500,
+        gap_timeout: float = 5.0,
+        skipped_ttl: float = 300.0,
+    ):
+        self.session_factory = session_factory
+        self.name = name
+        self.batch_size = batch_size
+        self.gap_timeout = timedelta(seconds=gap_timeout)
+        self.skipped_ttl = timedelta(seconds=skipped_ttl)
+        self._buffer = []  # type: List[events.Event]
+        self._position = None
+        self._skipped = {}  # type: Dict[int, datetime]
+        self._skipped_changed = False
+        self._lock = threading.Lock()
+
+    def checkpoint(self) -> int:
+        session = self.session_factory()
+        try:
+            return self._read_checkpoint(session)[0]
+        finally:
+            session.close()
+
+    def project(self, event: events.Event, position: int):
+        with self._lock:
+            self._buffer.append(event)
+            self._position = position
+            full = len(self._buffer) >= self.batch_size
+        if full:
+            self.flush()
+
+    def flush(self) -> int:
+        with self._lock:
+            buffered, self._buffer = self._buffer, []
+            position = self._position
+            if not buffered and not self._skipped_changed:
+                return 0
+            session = self.session_factory()
+            try:
+                apply(session, buffered)
+                self._write_checkpoint(session, position, self._skipped)
+                session.commit()
+                self._skipped_changed = False
+            except Exception:
+                self._buffer = buffered + self._buffer
+                raise
+            finally:
+                session.close()
+        return len(buffered)
+
+    def catch_up(self) -> int:
+        """
+        Projects outbox rows after the checkpoint and returns how many it
+        got through. Events the view doesn't care about still move the
+        checkpoint along.
+        """
+        session = self.session_factory()
+        try:
+            position, skipped = self._read_checkpoint(session)
+            late = outbox.with_ids(session, list(skipped))
+            rows = outbox.since(session, position, self.batch_size)
+        finally:
+            session.close()
+        with self._lock:
+            self._position = position
+            self._skipped = skipped
+        projected = 0
+        for outbox_id, event_type, payload, _ in late:
+            del skipped[outbox_id]
+            self._skipped_changed = True
+            self.project(outbox.deserialize(event_type, payload), position)
+            projected += 1
+        now = datetime.utcnow()
+        for outbox_id, event_type, payload, created_at in rows:
+            if outbox_id != position + 1:
+                if created_at > now - self.gap_timeout:
+                    break
+                skipped.update(dict.fromkeys(range(position + 1, outbox_id), now))
+                self._skipped_changed = True
+            self.project(outbox.deserialize(event_type, payload), outbox_id)
+            position = outbox_id
+            projected += 1
+        expired = [i for i, skipped_at in skipped.items() if skipped_at <= now - self.skipped_ttl]
+        for outbox_id in expired:
+            logger.warning('%s gave up waiting for event_outbox row %s', self.name, outbox_id)
+            del skipped[outbox_id]
+            self._skipped_changed = True
+        self.flush()
+        return projected
+
+    def run_forever(self, poll_interval: float = 1.0, stop: threading.Event = None):
+        stop = stop or threading.Event()
+        while not stop.is_set():
+            if not self.catch_up():
+                stop.wait(poll_interval)
+
+    def rebuild(self, chunk_size: int = 10_000) -> int:
+        """
+        Replaces allocations_view with rows computed from the write tables,
+        streamed chunk_size at a time, and moves the checkpoint to the end
+        of the outbox, all in one transaction.
+        """
+        session = self.session_factory()
+        rebuilt = 0
+        try:
+            [[position]] = session.execute('SELECT coalesce(max(id), 0) FROM event_outbox')
+            session.execute('DELETE FROM allocations_view')
+            connection = session.connection()
+            result = connection.execution_options(stream_results=True).execute(
+                text(REBUILD_QUERY)
+            )
+            while True:
+                chunk = result.fetchmany(chunk_size)
+                if not chunk:
+                    break
+                connection.execute(text(INSERT), [
+                    dict(orderid=orderid, sku=sku, batchref=batchref)
+                    for orderid, sku, batchref in chunk
+                ])
+                rebuilt += len(chunk)
+            self._write_checkpoint(session, position, {})
+            session.commit()
+        finally:
+            session.close()
+        logger.info('rebuilt %s with %s rows', self.name, rebuilt)
+        return rebuilt
+
+    def _read_checkpoint(self, session) -> Tuple[int, Dict[int, datetime]]:
+        [(position, skipped)] = list(session.execute(
+            'SELECT position, skipped FROM projection_checkpoints WHERE name = :name',
+            dict(name=self.name),
+        )) or [(0, None)]
+        return position, {
+            int(outbox_id): datetime.fromisoformat(skipped_at)
+            for outbox_id, skipped_at in json.loads(skipped or '{}').items()
+        }
+
+    def _write_checkpoint(self, session, position: int, skipped: Dict[int, datetime]):
+        params = dict(
+            name=self.name, position=position,
+            skipped=json.dumps({
+                str(outbox_id): skipped_at.isoformat()
+                for outbox_id, skipped_at in sorted(skipped.items())
+            }),
+        )
+        updated = session.execute(
+            'UPDATE projection_checkpoints SET position = :position, skipped = :skipped'
+            ' WHERE name = :name',
+            params,
+        )
+        if not updated.rowcount:
+            session.execute(
+                'INSERT INTO projection_checkpoints (name, position, skipped)'
+                ' VALUES (:name, :position, :skipped)',
+                params,
+            )
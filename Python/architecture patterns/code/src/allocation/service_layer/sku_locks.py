@@ -0,0 +1,85 @@
+from __future__ import annotations
+import contextlib
+import functools
+import threading
+import zlib
+from typing import Callable, Dict, Iterable, List, Optional, Set, Type
+from allocation.domain import commands
+
+
+class StripedLocks:
+    """
+    A fixed pool of locks that skus hash onto. Several skus can share a
+    lock, which only costs some parallelism; locks are always taken in
+    stripe order, so callers holding several never deadlock.
+    """
+
+    def __init__(self, stripes: int = 64):
+        self._locks = [threading.Lock() for _ in range(stripes)]
+
+    def stripes_for(self, skus: Iterable[str]) -> List[int]:
+        return sorted({zlib.crc32(sku.encode()) % len(self._locks) for sku in skus})
+
+    @contextlib.contextmanager
+    def holding(self, skus: Iterable[str]):
+        with contextlib.ExitStack() as stack:
+            for stripe in self.stripes_for(skus):
+                stack.enter_context(self._locks[stripe])
+            yield
+
+
+class SkuLocking:
+    """
+    Wraps command handlers so commands for the same sku run one at a time
+    within this process, queueing on a lock instead of racing each other
+    on the products row and failing at commit. The lock is held only while
+    the handler loads and commits the product: the bus dispatches the
+    events it raised, and sleeps before a retry, with the lock released.
+
+    A command that would need more than max_stripes stripes (a big
+    AllocateMany, say) takes none and relies on the version check and the
+    retry policy instead, so one bulk command can't stall most of the pool.
+    Commands with no sku of their own run unlocked too.
+    """
+
+    def __init__(
+        self,
+        sku_for_batch: Callable[[str], Optional[str]],
+        locks: StripedLocks = None,
+        max_stripes: int = 8,
+    ):
+        self.sku_for_batch = sku_for_batch
+        self.locks = locks or StripedLocks()
+        self.max_stripes = max_stripes
+        self._skus_for = {
+            commands.Allocate: lambda cmd: {cmd.sku},
+            commands.CreateBatch: lambda cmd: {cmd.sku},
+            commands.AllocateMany: lambda cmd: {line.sku for line in cmd.lines},
+            commands.ChangeBatchQuantity: self._skus_for_batch,
+        }  # type: Dict[Type, Callable[..., Set[str]]]
+
+    def wrap_handlers(
+        self, command_handlers: Dict[Type[commands.Command], Callable],
+    ) -> Dict[Type[commands.Command], Callable]:
+        return {
+            command_type: self.wrap(command_type, handler)
+            for command_type, handler in command_handlers.items()
+        }
+
+    def wrap(self, command_type: Type[commands.Command], handler: Callable) -> Callable:
+        skus_for = self._skus_for.get(command_type)
+        if skus_for is None:
+            return handler
+
+        @functools.wraps(handler)
+        def locked(cmd):
+            skus = skus_for(cmd)
+            if len(self.locks.stripes_for(skus)) > self.max_stripes:
+                return handler(cmd)
+            with self.locks.holding(skus):
+                return handler(cmd)
+        return locked
+
+    def _skus_for_batch(self, cmd: commands.ChangeBatchQuantity) -> Set[str]:
+        sku = self.sku_for_batch(cmd.ref)
+        return {sku} if sku else set()
@@ -1,32 +1,68 @@
-# pylint: disable=attribute-defined-outside-init
 from __future__ import annotations
 import abc
-from sqlalchemy import create_engine
+import asyncio
+import contextvars
+import functools
+import threading
+import time
+from concurrent.futures import Executor
+from typing import Any, Callable, List, Optional
+from sqlalchemy import create_engine, exc
+from sqlalchemy.engine import Engine
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.orm.session import Session
+from sqlalchemy.pool import Pool
 
 
 from allocation import config
-from allocation.adapters import repository
+from allocation.adapters import outbox, redis_eventpublisher, repository
+from allocation.adapters.metrics import AbstractMetrics
+from allocation.adapters.product_cache import ProductCache
+from allocation.domain import events, model
+
+
+class ConcurrencyError(Exception):
+    """Another transaction changed the same rows first; safe to retry."""
+
+
+def is_concurrency_error(error: exc.DBAPIError) -> bool:
+    # 40001 serialization_failure, 40P01 deadlock_detected
+    if getattr(error.orig, 'pgcode', None) in ('40001', '40P01'):
+        return True
+    return 'database is locked' in str(error.orig)
 
 
 class AbstractUnitOfWork(abc.ABC):
     products: repository.AbstractRepository
+    # events of the changes committed so far, until the bus collects them
+    committed_events: List[events.Event]
 
     def __enter__(self) -> AbstractUnitOfWork:
         return self
 
     def __exit__(self, *args):
         self.rollback()
+        self._discard_uncommitted_events()
 
     def commit(self):
         self._commit()
+        self.committed_events.extend(self._take_product_events())
 
     def collect_new_events(self):
+        committed = self.committed_events
+        while committed:
+            yield committed.pop(0)
+
+    def _take_product_events(self):
         for product in self.products.seen:
             while product.events:
                 yield product.events.pop(0)
 
+    def _discard_uncommitted_events(self):
+        # whatever wasn't committed never happened
+        for product in self.products.seen:
+            product.events.clear()
+
     @abc.abstractmethod
     def _commit(self):
         raise NotImplementedError
@@ -37,27 +73,238 @@ class AbstractUnitOfWork(abc.ABC):
 
 
 
-DEFAULT_SESSION_FACTORY = sessionmaker(bind=create_engine(
-    config.get_postgres_uri(),
-    isolation_level="REPEATABLE READ",
-))
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def get_engine() -> Engine:
+    global _engine  # pylint: disable=global-statement
+    with _engine_lock:
+        if _engine is None:
+            _engine = create_engine(
+                config.get_postgres_uri(),
+                isolation_level="REPEATABLE READ",
+                **config.get_db_pool_settings(),
+            )
+    return _engine
+
+
+class LazySessionFactory:
+    """A sessionmaker for get_engine() that doesn't create the engine until it's first called."""
+
+    def __init__(self):
+        self._sessionmaker = None
+
+    def __call__(self, **kwargs) -> Session:
+        if self._sessionmaker is None:
+            self._sessionmaker = sessionmaker(bind=get_engine())
+        return self._sessionmaker(**kwargs)
+
+
+DEFAULT_SESSION_FACTORY = LazySessionFactory()
+
+
+def record_pool_status(pool: Pool, metrics: AbstractMetrics):
+    # only QueuePool keeps counts; SQLite's pools don't
+    for name in ('checkedout', 'overflow', 'size'):
+        count = getattr(pool, name, None)
+        if count is not None:
+            metrics.gauge(f'db.pool.{name}', count())
+
+COMMITTED, ROLLED_BACK = 'committed', 'rolled back'
+
 
 class SqlAlchemyUnitOfWork(AbstractUnitOfWork):
+    """
+    One instance is shared by the whole app, so the session and repository
+    live in context variables: every thread (or asyncio task) that enters
+    the unit of work gets its own, and they never see each other's.
+
+    With use_outbox, new events are written to the event_outbox table as
+    part of the commit instead of being handed back to the message bus;
+    an OutboxWorker handles them later.
+
+    With publish_outbox, the messages the publish handlers would send for
+    new events are written to the outbox table as part of the commit, for
+    an OutboxRelay to send on; the bus then leaves those handlers out.
 
-    def __init__(self, session_factory=DEFAULT_SESSION_FACTORY):
+    With a product_cache, products that were committed untouched since are
+    detached on exit and kept for later units of work. Sessions then don't
+    expire on commit, so the cached copies stay readable.
+
+    With metrics, entering checks a connection out of the pool straight
+    away rather than on the first query, timing the wait as db.checkout and
+    reporting the pool's counts as db.pool.* gauges.
+    """
+
+    def __init__(
+        self, session_factory=DEFAULT_SESSION_FACTORY, use_outbox=False,
+        product_cache: ProductCache = None, metrics: AbstractMetrics = None,
+        publish_outbox=False,
+    ):
         self.session_factory = session_factory
+        self.use_outbox = use_outbox
+        self.product_cache = product_cache
+        self.metrics = metrics
+        self.publish_outbox = publish_outbox
+        self._session = contextvars.ContextVar(
+            f'uow-session-{id(self)}', default=None,
+        )  # type: contextvars.ContextVar[Optional[Session]]
+        self._products = contextvars.ContextVar(
+            f'uow-products-{id(self)}', default=None,
+        )  # type: contextvars.ContextVar[Optional[repository.AbstractRepository]]
+        # None, COMMITTED or ROLLED_BACK, in a one-item list rather than set
+        # directly: AsyncSqlAlchemyUnitOfWork commits in a copy of the
+        # context, where setting the variable itself would be lost
+        self._outcome = contextvars.ContextVar(
+            f'uow-outcome-{id(self)}', default=None,
+        )  # type: contextvars.ContextVar[Optional[List[Optional[str]]]]
+        self._committed_events = contextvars.ContextVar(
+            f'uow-committed-events-{id(self)}', default=None,
+        )  # type: contextvars.ContextVar[Optional[List[events.Event]]]
+
+    @property
+    def session(self) -> Session:
+        return self._session.get()
+
+    @property  # type: ignore
+    def products(self) -> repository.AbstractRepository:
+        return self._products.get()
+
+    @property  # type: ignore
+    def committed_events(self) -> List[events.Event]:
+        return self._committed_events.get()
 
     def __enter__(self):
-        self.session = self.session_factory()  # type: Session
-        self.products = repository.SqlAlchemyRepository(self.session)
+        self._start(self.session_factory())
+        self._checkout()
         return super().__enter__()
 
     def __exit__(self, *args):
+        cacheable = self._detach_cacheable()
         super().__exit__(*args)
         self.session.close()
+        for product in cacheable:
+            self.product_cache.put(product)
+
+    def _start(self, session: Session):
+        if self.product_cache is not None:
+            session.expire_on_commit = False
+        self._session.set(session)
+        self._products.set(
+            repository.SqlAlchemyRepository(session, cache=self.product_cache)
+        )
+        self._outcome.set([None])
+        self._committed_events.set([])
+
+    def _checkout(self):
+        if self.metrics is None:
+            return
+        started = time.perf_counter()
+        connection = self.session.connection()
+        self.metrics.timing('db.checkout', time.perf_counter() - started)
+        record_pool_status(connection.engine.pool, self.metrics)
 
     def _commit(self):
-        self.session.commit()
+        if self.publish_outbox:
+            # left on the products: the bus still has to collect them
+            redis_eventpublisher.add_to_outbox(self.session, [
+                event for product in self.products.seen for event in product.events
+            ])
+        if self.use_outbox:
+            outbox.add(self.session, self._take_product_events())
+        if self.product_cache is None:
+            self._commit_session()
+        else:
+            # read before committing: a failed flush leaves them unloadable
+            skus = {product.sku for product in self.products.seen}
+            try:
+                self._commit_session()
+            except Exception:
+                for sku in skus:
+                    self.product_cache.invalidate(sku)
+                # the session has to be rolled back now, expiring the rest
+                self._outcome.get()[0] = ROLLED_BACK
+                raise
+        outcome = self._outcome.get()
+        if outcome[0] is None:
+            outcome[0] = COMMITTED
+
+    def _commit_session(self):
+        try:
+            self.session.commit()
+        except exc.DBAPIError as e:
+            if is_concurrency_error(e):
+                raise ConcurrencyError(str(e)) from e
+            raise
+
+    def _detach_cacheable(self) -> List[model.Product]:
+        session = self.session
+        if (
+            self.product_cache is None or self._outcome.get()[0] != COMMITTED
+            or session.new or session.dirty or session.deleted
+        ):
+            return []
+        seen = self.products.seen
+        cacheable = [p for p in seen if isinstance(p, model.Product)]
+        for product in cacheable:
+            # anything still on it wasn't committed; dropped now rather than
+            # on exit, when another unit of work may have taken the product
+            # out of the cache
+            product.events.clear()
+            seen.discard(product)
+        # before the rollback in __exit__, which would expire them
+        session.expunge_all()
+        return cacheable
 
     def rollback(self):
         self.session.rollback()
+        # everything loaded so far is expired now, so nothing can be cached,
+        # even if the unit of work goes on to commit something else
+        self._outcome.get()[0] = ROLLED_BACK
+
+
+class AsyncSqlAlchemyUnitOfWork(SqlAlchemyUnitOfWork):
+    """
+    The SQLAlchemy we're on (1.3) has no asyncio engine, so the ordinary
+    session does its blocking work on an executor thread instead. Sync
+    handlers use this exactly like a SqlAlchemyUnitOfWork (the async bus
+    runs them on the executor); async ones do::
+
+        async with uow:
+            product = await uow.run_sync(uow.products.get, sku)
+            ...
+            await uow.run_sync(uow.commit)
+    """
+
+    def __init__(
+        self, session_factory=DEFAULT_SESSION_FACTORY, use_outbox=False,
+        executor: Executor = None, product_cache: ProductCache = None,
+        metrics: AbstractMetrics = None, publish_outbox=False,
+    ):
+        super().__init__(session_factory, use_outbox, product_cache, metrics, publish_outbox)
+        self.executor = executor
+
+    async def run_sync(self, fn: Callable, *args) -> Any:
+        # the copy carries our session across to the executor thread
+        context = contextvars.copy_context()
+        return await asyncio.get_event_loop().run_in_executor(
+            self.executor, functools.partial(context.run, fn, *args),
+        )
+
+    async def __aenter__(self) -> AsyncSqlAlchemyUnitOfWork:
+        session = await self.run_sync(self.session_factory)  # type: Session
+        self._start(session)
+        await self.run_sync(self._checkout)
+        return self
+
+    async def __aexit__(self, *args):
+        await self.run_sync(self._rollback_and_close)
+
+    def _rollback_and_close(self):
+        cacheable = self._detach_cacheable()
+        self.rollback()
+        self._discard_uncommitted_events()
+        self.session.close()
+        for product in cacheable:
+            self.product_cache.put(product)
@@ -1,9 +1,53 @@
+import hashlib
+import json
+from typing import Dict, Iterable, List
+from sqlalchemy import bindparam, text
+from allocation.adapters.allocations_cache import AllocationsCache
 from allocation.service_layer import unit_of_work
 
-def allocations(orderid: str, uow: unit_of_work.SqlAlchemyUnitOfWork):
+def allocations(
+        orderid: str, uow: unit_of_work.SqlAlchemyUnitOfWork,
+        cache: AllocationsCache = None,
+):
+    if cache is not None:
+        cached = cache.get(orderid)
+        if cached is not None:
+            return cached
+        token = cache.token()
     with uow:
         results = list(uow.session.execute(
             'SELECT sku, batchref FROM allocations_view WHERE orderid = :orderid',
             dict(orderid=orderid)
         ))
-    return [dict(r) for r in results]
+    rows = [dict(r) for r in results]
+    if cache is not None:
+        cache.put(orderid, rows, token)
+    return rows
+
+
+def etag(rows: List[dict]) -> str:
+    return hashlib.sha1(json.dumps(rows, sort_keys=True).encode()).hexdigest()
+
+
+def sku_for_batch(batchref: str, uow: unit_of_work.SqlAlchemyUnitOfWork):
+    with uow:
+        [row] = list(uow.session.execute(
+            'SELECT sku FROM batches WHERE reference = :batchref',
+            dict(batchref=batchref)
+        )) or [None]
+    return row and row[0]
+
+
+def skus_for_batches(
+        batchrefs: Iterable[str], uow: unit_of_work.SqlAlchemyUnitOfWork,
+) -> Dict[str, str]:
+    batchrefs = list(batchrefs)
+    if not batchrefs:
+        return {}
+    with uow:
+        rows = uow.session.execute(
+            text('SELECT reference, sku FROM batches WHERE reference IN :batchrefs')
+            .bindparams(bindparam('batchrefs', expanding=True)),
+            dict(batchrefs=batchrefs),
+        )
+        return dict(list(rows))
@@ -0,0 +1,79 @@
+"""
+Compares batch selection in Product.allocate when it always does a sorted
+scan, always uses the BatchIndex, and does what it does by default (scan
+the first SCANS_BEFORE_INDEXING picks, then index). All three go through
+the same Product.allocate, events and all, and differ only in how the batch
+is picked.
+
+"fresh" loads the product again before every line, as a unit of work per
+Allocate command does, so the index has to be built each time; "reused"
+keeps one product for every line, as a bulk allocation or the product
+cache does.
+
+    python -m tests.benchmarks.bench_allocate
+"""
+import time
+from datetime import date, timedelta
+from allocation.domain import model
+from allocation.domain.model import Batch, OrderLine, Product
+
+SIZES = [10, 100, 1_000, 100_000]
+LINES_PER_RUN = 1_000
+SLOW_LINES_PER_RUN = 20
+
+
+class ScanningProduct(Product):
+
+    def _first_fit(self, qty):
+        return next((b for b in sorted(self.batches) if b.available_quantity >= qty), None)
+
+
+class IndexedProduct(Product):
+
+    def _first_fit(self, qty):
+        return self._batch_index().first_fit(qty)
+
+
+def make_product(n_batches, product_class=Product):
+    start = date(2011, 1, 1)
+    batches = [
+        Batch(f'batch-{i}', 'BENCH-SKU', 10, eta=start + timedelta(days=i))
+        for i in reversed(range(n_batches))
+    ]
+    return product_class('BENCH-SKU', batches)
+
+
+def reload(product):
+    # what the ORM's load event does to a product read from the database
+    model.Product.__init__(product, product.sku, product.batches, product.version_number)
+
+
+def time_per_line(product_class, n_batches, n_lines, fresh):
+    product = make_product(n_batches, product_class)
+    # every line fills a batch, so each allocation has to look further along
+    lines = [OrderLine(f'order-{i}', 'BENCH-SKU', 10) for i in range(n_lines)]
+    started = time.perf_counter()
+    for line in lines:
+        if fresh:
+            reload(product)
+        product.allocate(line)
+    return (time.perf_counter() - started) / n_lines
+
+
+def main():
+    setups = [('scan', ScanningProduct), ('index', IndexedProduct), ('default', Product)]
+    print(f"{'batches':>10}" + ''.join(
+        f' {f"{name}, {mode} (us)":>20}'
+        for mode in ('fresh', 'reused') for name, _ in setups
+    ))
+    for size in SIZES:
+        n_lines = min(size, LINES_PER_RUN if size <= 1_000 else SLOW_LINES_PER_RUN)
+        timings = [
+            time_per_line(product_class, size, n_lines, fresh)
+            for fresh in (True, False) for _, product_class in setups
+        ]
+        print(f'{size:>10}' + ''.join(f' {t * 1e6:>20.1f}' for t in timings))
+
+
+if __name__ == '__main__':
+    main()
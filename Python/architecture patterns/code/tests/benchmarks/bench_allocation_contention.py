@@ -0,0 +1,80 @@
+"""
+Successful allocations per second on a single hot sku as concurrency
+grows, with and without retrying commands that lose the version_number race.
+Needs the database from docker-compose (make up), or pass another URI:
+
+    python -m tests.benchmarks.bench_allocation_contention [database uri]
+"""
+import logging
+import sys
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from allocation import bootstrap, config
+from allocation.adapters import orm
+from allocation.adapters.notifications import AbstractNotifications
+from allocation.domain import commands
+from allocation.service_layer import messagebus, unit_of_work
+
+CONCURRENCY = [1, 2, 4, 8, 16]
+SECONDS_PER_RUN = 3
+POLICIES = [
+    ('no retry', messagebus.NO_RETRY),
+    ('retry', messagebus.RetryPolicy(max_attempts=10)),
+]
+
+
+class NoNotifications(AbstractNotifications):
+
+    def send(self, destination, message):
+        pass
+
+
+def make_engine(uri):
+    if uri.startswith('sqlite'):
+        return create_engine(uri, connect_args={'check_same_thread': False, 'timeout': 0})
+    return create_engine(uri, isolation_level='REPEATABLE READ', pool_size=max(CONCURRENCY))
+
+
+def run(bus, threads):
+    sku = f'contended-{uuid.uuid4().hex[:8]}'
+    bus.handle(commands.CreateBatch(f'batch-{sku}', sku, 10 ** 9, None))
+    deadline = time.perf_counter() + SECONDS_PER_RUN
+    succeeded, failed = [0] * threads, [0] * threads
+
+    def allocate_until_deadline(worker):
+        while time.perf_counter() < deadline:
+            try:
+                bus.handle(commands.Allocate(uuid.uuid4().hex, sku, 1))
+                succeeded[worker] += 1
+            except Exception:  # pylint: disable=broad-except
+                failed[worker] += 1
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        list(executor.map(allocate_until_deadline, range(threads)))
+    return sum(succeeded) / SECONDS_PER_RUN, sum(failed) / SECONDS_PER_RUN
+
+
+def main():
+    uri = sys.argv[1] if len(sys.argv) > 1 else config.get_postgres_uri()
+    engine = make_engine(uri)
+    orm.metadata.create_all(engine)
+    orm.start_mappers()
+    # every lost race is logged by the bus; only the totals matter here
+    logging.getLogger('allocation').setLevel(logging.CRITICAL)
+    uow = unit_of_work.SqlAlchemyUnitOfWork(sessionmaker(bind=engine))
+    print(f"{'threads':>8} {'policy':>9} {'ok/s':>9} {'failed/s':>9}")
+    for threads in CONCURRENCY:
+        for name, policy in POLICIES:
+            bus = bootstrap.bootstrap(
+                start_orm=False, uow=uow, notifications=NoNotifications(),
+                publish=lambda *args: None, retry=policy,
+            )
+            ok, failed = run(bus, threads)
+            print(f'{threads:>8} {name:>9} {ok:>9.1f} {failed:>9.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+"""
+Times SqlAlchemyRepository.get_by_batchref against a SQLite file holding a
+million batches, without the batches.reference index, with it, and with
+the batchref->sku cache turning the lookup into a primary key fetch.
+
+    python -m tests.benchmarks.bench_batchref_lookup [number of batches]
+"""
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from allocation.adapters import orm, repository
+
+N_BATCHES = 1_000_000
+BATCHES_PER_PRODUCT = 10
+LOOKUPS = 1_000
+UNINDEXED_LOOKUPS = 10
+CHUNK = 50_000
+
+
+def populate(engine, n_batches):
+    n_products = n_batches // BATCHES_PER_PRODUCT
+    with engine.begin() as conn:
+        for start in range(0, n_products, CHUNK):
+            conn.execute(orm.products.insert(), [
+                dict(sku=f'sku-{i}', version_number=1)
+                for i in range(start, min(start + CHUNK, n_products))
+            ])
+        for start in range(0, n_batches, CHUNK):
+            conn.execute(orm.batches.insert(), [
+                dict(
+                    reference=f'batch-{i}', sku=f'sku-{i // BATCHES_PER_PRODUCT}',
+                    _purchased_quantity=100, eta=None,
+                )
+                for i in range(start, min(start + CHUNK, n_batches))
+            ])
+
+
+def reference_index():
+    [index] = [i for i in orm.batches.indexes if list(i.columns) == [orm.batches.c.reference]]
+    return index
+
+
+def time_per_lookup(session_factory, batchrefs, batchref_skus):
+    session = session_factory()
+    started = time.perf_counter()
+    for batchref in batchrefs:
+        repo = repository.SqlAlchemyRepository(session, batchref_skus=batchref_skus)
+        assert repo.get_by_batchref(batchref) is not None
+        session.expunge_all()
+    session.close()
+    return (time.perf_counter() - started) / len(batchrefs)
+
+
+def main():
+    n_batches = int(sys.argv[1]) if len(sys.argv) > 1 else N_BATCHES
+    orm.start_mappers()
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = create_engine(f'sqlite:///{Path(tmp) / "bench.sqlite"}')
+        orm.metadata.create_all(engine)
+        started = time.perf_counter()
+        populate(engine, n_batches)
+        print(f'inserted {n_batches} batches in {time.perf_counter() - started:.1f}s')
+        session_factory = sessionmaker(bind=engine)
+        batchrefs = [f'batch-{random.randrange(n_batches)}' for _ in range(LOOKUPS)]
+
+        reference_index().drop(engine)
+        unindexed = time_per_lookup(
+            session_factory, batchrefs[:UNINDEXED_LOOKUPS],
+            repository.BatchrefSkus(max_size=0),
+        )
+        reference_index().create(engine)
+        indexed = time_per_lookup(
+            session_factory, batchrefs, repository.BatchrefSkus(max_size=0),
+        )
+        batchref_skus = repository.BatchrefSkus()
+        time_per_lookup(session_factory, batchrefs, batchref_skus)  # warm up
+        cached = time_per_lookup(session_factory, batchrefs, batchref_skus)
+
+    print(f"{'lookup':>24} {'per call (us)':>14}")
+    for name, seconds in [
+        ('unindexed join', unindexed),
+        ('indexed join', indexed),
+        ('batchref->sku cache', cached),
+    ]:
+        print(f'{name:>24} {seconds * 1e6:>14.1f}')
+
+
+if __name__ == '__main__':
+    main()
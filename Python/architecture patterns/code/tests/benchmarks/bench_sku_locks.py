@@ -0,0 +1,74 @@
+"""
+N threads allocating against a handful of hot skus, through the plain
+bus, the plain bus with retries, and with SkuLocking around its command
+handlers.
+Needs the database from docker-compose (make up), or pass another URI:
+
+    python -m tests.benchmarks.bench_sku_locks [database uri]
+"""
+import itertools
+import logging
+import sys
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy.orm import sessionmaker
+from allocation import bootstrap, config
+from allocation.adapters import orm
+from allocation.domain import commands
+from allocation.service_layer import messagebus, unit_of_work
+from .bench_allocation_contention import NoNotifications, make_engine
+
+CONCURRENCY = [4, 16, 32]
+HOT_SKUS = 4
+SECONDS_PER_RUN = 3
+SETUPS = [
+    ('plain', messagebus.NO_RETRY, 0),
+    ('retry', messagebus.RetryPolicy(max_attempts=10), 0),
+    ('striped', messagebus.NO_RETRY, 64),
+]
+
+
+def run(bus, threads):
+    prefix = uuid.uuid4().hex[:8]
+    skus = [f'hot-{prefix}-{i}' for i in range(HOT_SKUS)]
+    for sku in skus:
+        bus.handle(commands.CreateBatch(f'batch-{sku}', sku, 10 ** 9, None))
+    deadline = time.perf_counter() + SECONDS_PER_RUN
+    succeeded, failed = [0] * threads, [0] * threads
+
+    def allocate_until_deadline(worker):
+        for sku in itertools.cycle(skus[worker % HOT_SKUS:] + skus[:worker % HOT_SKUS]):
+            if time.perf_counter() >= deadline:
+                return
+            try:
+                bus.handle(commands.Allocate(uuid.uuid4().hex, sku, 1))
+                succeeded[worker] += 1
+            except Exception:  # pylint: disable=broad-except
+                failed[worker] += 1
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        list(executor.map(allocate_until_deadline, range(threads)))
+    return sum(succeeded) / SECONDS_PER_RUN, sum(failed) / SECONDS_PER_RUN
+
+
+def main():
+    uri = sys.argv[1] if len(sys.argv) > 1 else config.get_postgres_uri()
+    engine = make_engine(uri)
+    orm.metadata.create_all(engine)
+    orm.start_mappers()
+    logging.getLogger('allocation').setLevel(logging.CRITICAL)
+    uow = unit_of_work.SqlAlchemyUnitOfWork(sessionmaker(bind=engine))
+    print(f"{'threads':>8} {'bus':>9} {'ok/s':>9} {'failed/s':>9}")
+    for threads in CONCURRENCY:
+        for name, retry, stripes in SETUPS:
+            bus = bootstrap.bootstrap(
+                start_orm=False, uow=uow, notifications=NoNotifications(),
+                publish=lambda *args: None, retry=retry, sku_lock_stripes=stripes,
+            )
+            ok, failed = run(bus, threads)
+            print(f'{threads:>8} {name:>9} {ok:>9.1f} {failed:>9.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -12,10 +12,13 @@ from sqlalchemy.orm import sessionmaker, clear_mappers
 from tenacity import retry, stop_after_delay
 
 from allocation.adapters.orm import metadata, start_mappers
+from allocation.domain import model
 from allocation import config
 
 pytest.register_assert_rewrite('tests.e2e.api_client')
 
+model.DEBUG_CHECKS = True
+
 @pytest.fixture
 def in_memory_sqlite_db():
     engine = create_engine('sqlite:///:memory:')
@@ -26,6 +29,16 @@ def in_memory_sqlite_db():
 def sqlite_session_factory(in_memory_sqlite_db):
     yield sessionmaker(bind=in_memory_sqlite_db)
 
+@pytest.fixture
+def sqlite_file_session_factory(tmp_path):
+    # a file rather than :memory: so that every thread sees the same database
+    engine = create_engine(
+        f'sqlite:///{tmp_path / "allocation.sqlite"}',
+        connect_args={'check_same_thread': False, 'timeout': 30},
+    )
+    metadata.create_all(engine)
+    yield sessionmaker(bind=engine)
+
 @pytest.fixture
 def mappers():
     start_mappers()
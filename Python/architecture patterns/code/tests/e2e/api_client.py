@@ -20,6 +20,17 @@ def post_to_allocate(orderid, sku, qty, expect_success=True):
         assert r.status_code == 202
     return r
 
-def get_allocation(orderid):
+def post_to_allocate_bulk(lines, expect_success=True):
     url = config.get_api_url()
-    return requests.get(f'{url}/allocations/{orderid}')
+    r = requests.post(f'{url}/allocate/bulk', json={'lines': [
+        {'orderid': orderid, 'sku': sku, 'qty': qty}
+        for orderid, sku, qty in lines
+    ]})
+    if expect_success:
+        assert r.status_code == 202
+    return r
+
+def get_allocation(orderid, etag=None):
+    url = config.get_api_url()
+    headers = {'If-None-Match': etag} if etag else {}
+    return requests.get(f'{url}/allocations/{orderid}', headers=headers)
@@ -36,3 +36,62 @@ def test_unhappy_path_returns_400_and_error_message():
 
     r = api_client.get_allocation(orderid)
     assert r.status_code == 404
+
+
+@pytest.mark.usefixtures('postgres_db')
+@pytest.mark.usefixtures('restart_api')
+def test_bulk_allocation_allocates_every_line():
+    order1, order2 = random_orderid(1), random_orderid(2)
+    sku, othersku = random_sku(), random_sku('other')
+    batch, otherbatch = random_batchref(1), random_batchref(2)
+    api_client.post_to_add_batch(batch, sku, 100, None)
+    api_client.post_to_add_batch(otherbatch, othersku, 100, None)
+
+    api_client.post_to_allocate_bulk([
+        (order1, sku, 3), (order1, othersku, 4), (order2, sku, 5),
+    ])
+
+    assert api_client.get_allocation(order1).json() == [
+        {'sku': sku, 'batchref': batch},
+        {'sku': othersku, 'batchref': otherbatch},
+    ]
+    assert api_client.get_allocation(order2).json() == [
+        {'sku': sku, 'batchref': batch},
+    ]
+
+
+@pytest.mark.usefixtures('postgres_db')
+@pytest.mark.usefixtures('restart_api')
+def test_bulk_allocation_reports_the_skus_it_could_not_allocate():
+    orderid = random_orderid()
+    sku, unknown_sku = random_sku(), random_sku('unknown')
+    batch = random_batchref()
+    api_client.post_to_add_batch(batch, sku, 100, None)
+
+    r = api_client.post_to_allocate_bulk([(orderid, sku, 3), (orderid, unknown_sku, 4)])
+
+    assert r.json() == {'failed': {unknown_sku: f'Invalid sku {unknown_sku}'}}
+    assert api_client.get_allocation(orderid).json() == [
+        {'sku': sku, 'batchref': batch},
+    ]
+
+
+@pytest.mark.usefixtures('postgres_db')
+@pytest.mark.usefixtures('restart_api')
+def test_allocations_are_not_resent_while_unchanged():
+    orderid = random_orderid()
+    sku, othersku = random_sku(), random_sku('other')
+    batch, otherbatch = random_batchref(1), random_batchref(2)
+    api_client.post_to_add_batch(batch, sku, 100, None)
+    api_client.post_to_add_batch(otherbatch, othersku, 100, None)
+    api_client.post_to_allocate(orderid, sku, qty=3)
+
+    r = api_client.get_allocation(orderid)
+    etag = r.headers['ETag']
+    r = api_client.get_allocation(orderid, etag=etag)
+    assert r.status_code == 304
+
+    api_client.post_to_allocate(orderid, othersku, qty=3)
+    r = api_client.get_allocation(orderid, etag=etag)
+    assert r.status_code == 200
+    assert len(r.json()) == 2
@@ -0,0 +1,146 @@
+class FakeRedis:
+    """Just enough of redis.Redis for the publishers and consumers."""
+
+    def __init__(self):
+        self.published = []
+        self.round_trips = 0
+        self.streams = {}
+        self.groups = {}
+        self.hashes = {}
+        self.now_ms = 0  # the fake's clock, for idle times
+
+    def publish(self, channel, message):
+        self.round_trips += 1
+        self.published.append((channel, message))
+        return 0
+
+    def pipeline(self, transaction=True):  # pylint: disable=unused-argument
+        return FakePipeline(self)
+
+    def xadd(self, name, fields):
+        entries = self.streams.setdefault(name, [])
+        entry_id = '{}-0'.format(len(entries) + 1).encode()
+        entries.append((entry_id, {encode(k): encode(v) for k, v in fields.items()}))
+        return entry_id
+
+    def xgroup_create(self, name, groupname, id='$', mkstream=False):  # pylint: disable=redefined-builtin,unused-argument
+        self.streams.setdefault(name, [])
+        self.groups.setdefault(
+            (name, groupname),
+            dict(delivered=0, pending=set(), owners={}, delivered_at={}, deliveries={}),
+        )
+        return True
+
+    def xreadgroup(self, groupname, consumername, streams, count=None, block=None):  # pylint: disable=unused-argument
+        self.round_trips += 1
+        response = []
+        for name, last_id in streams.items():
+            group = self.groups[(name, groupname)]
+            if last_id == '>':
+                start = group['delivered']
+                entries = self.streams[name][start:start + count if count else None]
+                group['delivered'] += len(entries)
+            else:
+                # an id means "my pending entries after it"
+                entries = [
+                    entry for entry in self.streams[name]
+                    if entry[0] in group['pending']
+                    and group['owners'][entry[0]] == consumername
+                    and entry_number(entry[0]) > entry_number(last_id)
+                ][:count]
+            self._deliver(group, consumername, entries)
+            if entries:
+                response.append([name.encode(), entries])
+        return response
+
+    def xautoclaim(self, name, groupname, consumername, min_idle_time, start_id='0-0', count=None):
+        self.round_trips += 1
+        group = self.groups[(name, groupname)]
+        idle = [
+            entry for entry in self.streams[name]
+            if entry[0] in group['pending']
+            and entry_number(entry[0]) >= entry_number(start_id)
+            and self.now_ms - group['delivered_at'][entry[0]] >= min_idle_time
+        ]
+        claimed, rest = idle[:count], idle[count:] if count else []
+        self._deliver(group, consumername, claimed)
+        return [rest[0][0] if rest else b'0-0', claimed, []]
+
+    def _deliver(self, group, consumername, entries):
+        for entry_id, _ in entries:
+            group['pending'].add(entry_id)
+            group['owners'][entry_id] = consumername
+            group['delivered_at'][entry_id] = self.now_ms
+            group['deliveries'][entry_id] = group['deliveries'].get(entry_id, 0) + 1
+
+    def xack(self, name, groupname, *ids):
+        self.round_trips += 1
+        pending = self.groups[(name, groupname)]['pending']
+        acked = pending.intersection(ids)
+        pending.difference_update(acked)
+        return len(acked)
+
+    def xpending_range(self, name, groupname, min, max, count):  # pylint: disable=redefined-builtin
+        self.round_trips += 1
+        group = self.groups[(name, groupname)]
+        return [
+            dict(
+                message_id=entry_id, consumer=group['owners'][entry_id].encode(),
+                time_since_delivered=self.now_ms - group['delivered_at'][entry_id],
+                times_delivered=group['deliveries'][entry_id],
+            )
+            for entry_id, _ in self.streams[name]
+            if entry_id in group['pending']
+            and entry_number(min) <= entry_number(entry_id) <= entry_number(max)
+        ][:count]
+
+    def hset(self, name, mapping):
+        self.round_trips += 1
+        self.hashes.setdefault(name, {}).update(
+            {encode(k): encode(v) for k, v in mapping.items()}
+        )
+        return len(mapping)
+
+    def hmget(self, name, keys):
+        self.round_trips += 1
+        values = self.hashes.get(name, {})
+        return [values.get(encode(key)) for key in keys]
+
+
+def encode(value):
+    return value if isinstance(value, bytes) else str(value).encode()
+
+
+def entry_number(entry_id):
+    if isinstance(entry_id, bytes):
+        entry_id = entry_id.decode()
+    return int(entry_id.split('-')[0])
+
+
+class FakePipeline:
+
+    def __init__(self, redis):
+        self.redis = redis
+        self.commands = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.commands = []
+
+    def __getattr__(self, name):
+        # queues any of FakeRedis's commands, to be run by execute()
+        method = getattr(self.redis, name)
+        def queue(*args, **kwargs):
+            self.commands.append((method, args, kwargs))
+            return self
+        return queue
+
+    def execute(self):
+        # one round trip for all of them
+        round_trips = self.redis.round_trips + 1
+        results = [method(*args, **kwargs) for method, args, kwargs in self.commands]
+        self.redis.round_trips = round_trips
+        self.commands = []
+        return results
@@ -0,0 +1,98 @@
+import socket
+import socketserver
+import threading
+import time
+
+
+class FakeSmtpServer:
+    """Just enough of an SMTP server, on localhost, to receive what the notifications send."""
+
+    def __init__(self):
+        self.messages = []
+        self.connections = 0
+        self._sockets = set()
+        self._lock = threading.Lock()
+        self._server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), self._handler())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, kwargs=dict(poll_interval=0.05), daemon=True,
+        )
+
+    @property
+    def host(self):
+        return self._server.server_address[0]
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.drop_connections()
+        self._server.shutdown()
+        self._server.server_close()
+
+    def drop_connections(self):
+        """Hangs up on every client, the way a restarting mail server would."""
+        with self._lock:
+            sockets, self._sockets = self._sockets, set()
+        for sock in sockets:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def wait_for(self, count, timeout=2.0):
+        deadline = time.monotonic() + timeout
+        while len(self.messages) < count and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return self.messages
+
+    def _handler(self):
+        server = self
+
+        class Handler(socketserver.StreamRequestHandler):
+
+            def handle(self):
+                with server._lock:  # pylint: disable=protected-access
+                    server.connections += 1
+                    server._sockets.add(self.request)  # pylint: disable=protected-access
+                self.reply('220 fake smtp ready')
+                mail_from, rcpt_to = None, []
+                for line in self.rfile:
+                    command = line.decode().strip()
+                    verb = command[:4].upper()
+                    if verb in ('EHLO', 'HELO', 'NOOP', 'RSET'):
+                        self.reply('250 OK')
+                    elif verb == 'MAIL':
+                        mail_from, rcpt_to = command.split(':', 1)[1].strip(' <>'), []
+                        self.reply('250 OK')
+                    elif verb == 'RCPT':
+                        rcpt_to.append(command.split(':', 1)[1].strip(' <>'))
+                        self.reply('250 OK')
+                    elif verb == 'DATA':
+                        self.reply('354 go ahead')
+                        server.messages.append((mail_from, rcpt_to, self.read_data()))
+                        self.reply('250 OK')
+                    elif verb == 'QUIT':
+                        self.reply('221 bye')
+                        return
+                    else:
+                        self.reply('500 what?')
+
+            def read_data(self):
+                lines = []
+                for line in self.rfile:
+                    line = line.decode().rstrip('\r\n')
+                    if line == '.':
+                        break
+                    lines.append(line[1:] if line.startswith('..') else line)
+                return '\n'.join(lines)
+
+            def reply(self, text):
+                self.wfile.write(f'{text}\r\n'.encode())
+
+        return Handler
@@ -0,0 +1,86 @@
+# pylint: disable=redefined-outer-name
+import asyncio
+import json
+from unittest import mock
+import pytest
+from sqlalchemy.orm import clear_mappers
+from allocation import bootstrap
+from allocation.entrypoints import asgi_app
+from allocation.service_layer import unit_of_work
+
+
+@pytest.fixture
+def asgi_bus(sqlite_file_session_factory):
+    asgi_app.bus = bootstrap.bootstrap_async(
+        start_orm=True,
+        uow=unit_of_work.AsyncSqlAlchemyUnitOfWork(sqlite_file_session_factory),
+        notifications=mock.Mock(),
+        publish=lambda *args: None,
+    )
+    yield asgi_app.bus
+    asgi_app.bus = None
+    clear_mappers()
+
+
+def request(method, path, data=None):
+    body = json.dumps(data).encode() if data is not None else b''
+    received = [{'type': 'http.request', 'body': body, 'more_body': False}]
+    sent = []
+
+    async def receive():
+        return received.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {'type': 'http', 'method': method, 'path': path}
+    asyncio.run(asgi_app.app(scope, receive, send))
+    start, body = sent
+    return start['status'], body['body']
+
+
+@pytest.mark.usefixtures('asgi_bus')
+def test_happy_path_returns_202_and_batch_is_allocated():
+    status, _ = request('POST', '/add_batch', {
+        'ref': 'laterbatch', 'sku': 'ASGI-LAMP', 'qty': 100, 'eta': '2011-01-02',
+    })
+    assert status == 201
+    request('POST', '/add_batch', {
+        'ref': 'earlybatch', 'sku': 'ASGI-LAMP', 'qty': 100, 'eta': '2011-01-01',
+    })
+
+    status, _ = request('POST', '/allocate', {
+        'orderid': 'order1', 'sku': 'ASGI-LAMP', 'qty': 3,
+    })
+    assert status == 202
+
+    status, body = request('GET', '/allocations/order1')
+    assert status == 200
+    assert json.loads(body) == [{'sku': 'ASGI-LAMP', 'batchref': 'earlybatch'}]
+
+
+@pytest.mark.usefixtures('asgi_bus')
+def test_unhappy_path_returns_400_and_error_message():
+    status, body = request('POST', '/allocate', {
+        'orderid': 'order1', 'sku': 'NO-SUCH-LAMP', 'qty': 3,
+    })
+    assert status == 400
+    assert json.loads(body) == {'message': 'Invalid sku NO-SUCH-LAMP'}
+
+    status, _ = request('GET', '/allocations/order1')
+    assert status == 404
+
+
+@pytest.mark.usefixtures('asgi_bus')
+def test_bulk_allocation_answers_409_when_it_keeps_conflicting(monkeypatch):
+    request('POST', '/add_batch', {'ref': 'b1', 'sku': 'ASGI-CHAIR', 'qty': 100, 'eta': None})
+    def conflict(self):
+        raise unit_of_work.ConcurrencyError('ASGI-CHAIR changed meanwhile')
+    monkeypatch.setattr(unit_of_work.SqlAlchemyUnitOfWork, '_commit_session', conflict)
+
+    status, body = request('POST', '/allocate/bulk', {'lines': [
+        {'orderid': 'order1', 'sku': 'ASGI-CHAIR', 'qty': 3},
+    ]})
+
+    assert status == 409
+    assert 'changed meanwhile' not in json.loads(body)['message']
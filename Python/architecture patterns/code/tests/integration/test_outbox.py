@@ -0,0 +1,165 @@
+# pylint: disable=redefined-outer-name
+from unittest import mock
+import pytest
+from allocation import bootstrap, views
+from allocation.adapters import outbox
+from allocation.domain import commands, events
+from allocation.service_layer import messagebus, unit_of_work
+from allocation.service_layer.outbox_worker import OutboxWorker
+
+pytestmark = pytest.mark.usefixtures('mappers')
+
+NO_WAIT = messagebus.RetryPolicy(max_attempts=3, base_delay=0, max_delay=0)
+
+
+@pytest.fixture
+def published():
+    return []
+
+
+@pytest.fixture
+def outbox_bus(sqlite_file_session_factory, published):
+    return bootstrap.bootstrap(
+        start_orm=False,
+        uow=unit_of_work.SqlAlchemyUnitOfWork(
+            sqlite_file_session_factory, use_outbox=True,
+        ),
+        notifications=mock.Mock(),
+        publish=lambda _, event: published.append(event),
+    )
+
+
+def test_events_are_stored_instead_of_handled(
+        outbox_bus, sqlite_file_session_factory, published
+):
+    outbox_bus.handle(commands.CreateBatch('b1', 'QUIET-FAN', 100, None))
+    outbox_bus.handle(commands.Allocate('o1', 'QUIET-FAN', 10))
+
+    assert published == []
+    [(_, event_type, payload, sku)] = outbox.pending(sqlite_file_session_factory(), 10)
+    assert outbox.deserialize(event_type, payload) == events.Allocated(
+        orderid='o1', sku='QUIET-FAN', qty=10, batchref='b1',
+    )
+    assert sku == 'QUIET-FAN'
+
+
+def test_worker_runs_the_handlers_and_marks_rows_processed(
+        outbox_bus, sqlite_file_session_factory, published
+):
+    outbox_bus.handle(commands.CreateBatch('b1', 'LOUD-FAN', 100, None))
+    outbox_bus.handle(commands.Allocate('o1', 'LOUD-FAN', 10))
+    worker = OutboxWorker(sqlite_file_session_factory, outbox_bus.event_handlers)
+
+    assert worker.drain() == 1
+
+    assert [e.orderid for e in published] == ['o1']
+    assert views.allocations('o1', outbox_bus.uow) == [
+        {'sku': 'LOUD-FAN', 'batchref': 'b1'},
+    ]
+    assert outbox.pending(sqlite_file_session_factory(), 10) == []
+    assert worker.drain() == 0
+
+
+def test_failed_handlers_are_retried_without_rerunning_the_others(
+        outbox_bus, sqlite_file_session_factory
+):
+    outbox_bus.handle(commands.CreateBatch('b1', 'FLAKY-FAN', 100, None))
+    outbox_bus.handle(commands.Allocate('o1', 'FLAKY-FAN', 10))
+    calls = []
+
+    def reliable(event):
+        calls.append(('reliable', event.orderid))
+
+    def flaky(event):
+        calls.append(('flaky', event.orderid))
+        if len(calls) == 2:
+            raise Exception('redis went away')
+
+    worker = OutboxWorker(
+        sqlite_file_session_factory, {events.Allocated: [reliable, flaky]},
+        retry=NO_WAIT,
+    )
+
+    assert worker.drain() == 0
+    assert len(outbox.pending(sqlite_file_session_factory(), 10)) == 1
+    assert worker.drain() == 1
+    assert calls == [('reliable', 'o1'), ('flaky', 'o1'), ('flaky', 'o1')]
+
+
+def test_a_failing_product_waits_out_its_backoff_without_holding_up_others(
+        sqlite_file_session_factory
+):
+    session = sqlite_file_session_factory()
+    outbox.add(session, [
+        events.Allocated('o1', 'BROKEN-FAN', 10, 'b1'),
+        events.Allocated('o2', 'BROKEN-FAN', 10, 'b1'),
+        events.Allocated('o3', 'WORKING-FAN', 10, 'b2'),
+    ])
+    session.commit()
+    handled = []
+
+    def handler(event):
+        if event.sku == 'BROKEN-FAN':
+            raise Exception('redis went away')
+        handled.append(event.orderid)
+
+    worker = OutboxWorker(
+        sqlite_file_session_factory, {events.Allocated: [handler]}, batch_size=1,
+        retry=messagebus.RetryPolicy(max_attempts=3, base_delay=60, max_delay=60),
+    )
+
+    assert worker.drain() == 0
+    assert worker.drain() == 1
+    assert handled == ['o3']
+    assert outbox.pending(sqlite_file_session_factory(), 10) == []
+
+
+def test_rows_that_keep_failing_are_dead_lettered(sqlite_file_session_factory):
+    session = sqlite_file_session_factory()
+    outbox.add(session, [
+        events.Allocated('o1', 'BROKEN-FAN', 10, 'b1'),
+        events.Allocated('o2', 'BROKEN-FAN', 10, 'b1'),
+    ])
+    session.commit()
+    handled = []
+
+    def handler(event):
+        if event.orderid == 'o1':
+            raise Exception('cannot handle this one')
+        handled.append(event.orderid)
+
+    worker = OutboxWorker(
+        sqlite_file_session_factory, {events.Allocated: [handler]}, retry=NO_WAIT,
+    )
+
+    assert [worker.drain() for _ in range(4)] == [0, 0, 0, 1]
+    assert handled == ['o2']
+    [(_, _, payload, _)] = outbox.dead_lettered(sqlite_file_session_factory())
+    assert 'o1' in payload
+
+
+def test_read_model_handlers_can_see_an_event_twice(
+        outbox_bus, sqlite_file_session_factory
+):
+    outbox_bus.handle(commands.CreateBatch('b1', 'TWICE-FAN', 100, None))
+    outbox_bus.handle(commands.Allocate('o1', 'TWICE-FAN', 10))
+    [(_, event_type, payload, _)] = outbox.pending(sqlite_file_session_factory(), 10)
+    event = outbox.deserialize(event_type, payload)
+
+    for handler in outbox_bus.event_handlers[events.Allocated]:
+        handler(event)
+    worker = OutboxWorker(sqlite_file_session_factory, outbox_bus.event_handlers)
+    assert worker.drain() == 1
+
+    assert views.allocations('o1', outbox_bus.uow) == [
+        {'sku': 'TWICE-FAN', 'batchref': 'b1'},
+    ]
+
+
+def test_reallocated_events_survive_the_round_trip():
+    event = events.Reallocated(
+        sku='sku1', batchref='b1',
+        allocated=[events.Allocated('o1', 'sku1', 10, 'b2')],
+        deallocated=[events.Deallocated('o2', 'sku1', 5)],
+    )
+    assert outbox.deserialize('Reallocated', outbox.serialize(event)) == event
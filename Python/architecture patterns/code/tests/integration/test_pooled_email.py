@@ -0,0 +1,99 @@
+#pylint: disable=redefined-outer-name
+import os
+import subprocess
+import sys
+from collections import Counter
+from pathlib import Path
+import pytest
+from allocation.adapters.notifications import PooledEmailNotifications, digest
+from ..fake_smtp import FakeSmtpServer
+
+SRC = Path(__file__).parents[2] / 'src'
+
+
+@pytest.fixture
+def smtp_server():
+    server = FakeSmtpServer().start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def notifications(smtp_server):
+    notifications = PooledEmailNotifications(
+        smtp_server.host, smtp_server.port, pool_size=2, digest_window=60,
+    )
+    yield notifications
+    notifications.close()
+
+
+def test_repeated_alerts_for_a_destination_go_out_as_one_digest(notifications, smtp_server):
+    for _ in range(3):
+        notifications.send('stock@made.com', 'Out of stock for LAMP')
+    notifications.send('stock@made.com', 'Out of stock for CHAIR')
+    notifications.send('buyers@made.com', 'Out of stock for LAMP')
+
+    notifications.flush()
+
+    received = {tuple(to): data for _, to, data in smtp_server.messages}
+    assert len(smtp_server.messages) == 2
+    assert 'Out of stock for LAMP (3 times)' in received[('stock@made.com',)]
+    assert 'Out of stock for CHAIR' in received[('stock@made.com',)]
+    assert 'Out of stock for LAMP' in received[('buyers@made.com',)]
+
+
+def test_queued_alerts_are_sent_once_the_window_closes(smtp_server):
+    notifications = PooledEmailNotifications(
+        smtp_server.host, smtp_server.port, digest_window=0.05,
+    )
+    notifications.send('stock@made.com', 'Out of stock for LAMP')
+    notifications.send('stock@made.com', 'Out of stock for LAMP')
+
+    messages = smtp_server.wait_for(1)
+
+    assert len(messages) == 1
+    assert 'Out of stock for LAMP (2 times)' in messages[0][2]
+    notifications.close()
+
+
+def test_connections_are_reused_between_flushes(notifications, smtp_server):
+    for sku in ('LAMP', 'CHAIR', 'TABLE'):
+        notifications.send('stock@made.com', f'Out of stock for {sku}')
+        notifications.flush()
+
+    assert len(smtp_server.messages) == 3
+    assert smtp_server.connections == 1
+
+
+def test_reconnects_when_the_server_hangs_up(notifications, smtp_server):
+    notifications.send('stock@made.com', 'Out of stock for LAMP')
+    notifications.flush()
+    smtp_server.drop_connections()
+
+    notifications.send('stock@made.com', 'Out of stock for CHAIR')
+    notifications.flush()
+
+    assert len(smtp_server.messages) == 2
+    assert smtp_server.connections == 2
+
+
+def test_a_single_alert_is_sent_as_is():
+    assert digest(Counter({'Out of stock for LAMP': 1})) == (
+        'Subject: allocation service notification\nOut of stock for LAMP'
+    )
+
+
+def test_the_app_sends_what_is_still_queued_when_it_exits(smtp_server):
+    script = (
+        'from allocation import bootstrap, config\n'
+        'config.get_email_host_and_port = lambda: dict(\n'
+        f'    host={smtp_server.host!r}, port={smtp_server.port}, http_port=0)\n'
+        'bootstrap.default_notifications().send("stock@made.com", "Out of stock for LAMP")\n'
+    )
+    env = dict(os.environ, PYTHONPATH=str(SRC), EMAIL_POOL_SIZE='1', EMAIL_DIGEST_WINDOW='60')
+
+    subprocess.run([sys.executable, '-c', script], env=env, check=True, timeout=10)
+
+    [(_, to, data)] = smtp_server.messages
+    assert to == ['stock@made.com']
+    assert 'Out of stock for LAMP' in data
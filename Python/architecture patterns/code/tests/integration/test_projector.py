@@ -0,0 +1,187 @@
+# pylint: disable=redefined-outer-name
+from datetime import datetime, timedelta
+from unittest import mock
+import pytest
+from sqlalchemy.orm import clear_mappers
+from allocation import bootstrap
+from allocation.adapters import outbox
+from allocation.domain import commands, events
+from allocation.service_layer import unit_of_work
+from allocation.service_layer.projector import AllocationsViewProjector
+
+
+def view_rows(session_factory):
+    session = session_factory()
+    try:
+        return sorted(tuple(row) for row in session.execute(
+            'SELECT orderid, sku, batchref FROM allocations_view'
+        ))
+    finally:
+        session.close()
+
+
+def add_to_outbox(session_factory, *new_events):
+    session = session_factory()
+    outbox.add(session, new_events)
+    session.commit()
+    session.close()
+
+
+def test_flush_writes_buffered_events_and_checkpoint(sqlite_session_factory):
+    projector = AllocationsViewProjector(sqlite_session_factory)
+    projector.project(events.Allocated('o1', 'LAMP', 10, 'b1'), 1)
+    projector.project(events.Allocated('o2', 'LAMP', 10, 'b1'), 2)
+    assert view_rows(sqlite_session_factory) == []
+
+    assert projector.flush() == 2
+
+    assert view_rows(sqlite_session_factory) == [('o1', 'LAMP', 'b1'), ('o2', 'LAMP', 'b1')]
+    assert projector.checkpoint() == 2
+
+
+def test_flushes_when_the_buffer_is_full(sqlite_session_factory):
+    projector = AllocationsViewProjector(sqlite_session_factory, batch_size=2)
+    projector.project(events.Allocated('o1', 'LAMP', 10, 'b1'), 1)
+    projector.project(events.Allocated('o2', 'LAMP', 10, 'b1'), 2)
+    projector.project(events.Allocated('o3', 'LAMP', 10, 'b1'), 3)
+
+    assert len(view_rows(sqlite_session_factory)) == 2
+    assert projector.checkpoint() == 2
+
+
+def test_applies_reallocations_in_order(sqlite_session_factory):
+    projector = AllocationsViewProjector(sqlite_session_factory)
+    projector.project(events.Allocated('o1', 'LAMP', 10, 'b1'), 1)
+    projector.project(events.Allocated('o2', 'LAMP', 10, 'b1'), 2)
+    projector.project(events.Reallocated(
+        'LAMP', 'b1',
+        allocated=[events.Allocated('o1', 'LAMP', 10, 'b2')],
+        deallocated=[events.Deallocated('o2', 'LAMP', 10)],
+    ), 3)
+    projector.flush()
+
+    assert view_rows(sqlite_session_factory) == [('o1', 'LAMP', 'b2')]
+
+
+def test_catch_up_projects_outbox_rows_after_the_checkpoint(sqlite_session_factory):
+    add_to_outbox(
+        sqlite_session_factory,
+        events.Allocated('o1', 'LAMP', 10, 'b1'),
+        events.OutOfStock('LAMP'),
+        events.Allocated('o2', 'LAMP', 10, 'b1'),
+    )
+    projector = AllocationsViewProjector(sqlite_session_factory)
+
+    assert projector.catch_up() == 3
+    assert projector.catch_up() == 0
+    assert view_rows(sqlite_session_factory) == [('o1', 'LAMP', 'b1'), ('o2', 'LAMP', 'b1')]
+    assert projector.checkpoint() == 3
+
+
+def test_catch_up_waits_for_recent_gaps(sqlite_session_factory):
+    add_to_outbox(sqlite_session_factory, events.Allocated('o1', 'LAMP', 10, 'b1'))
+    session = sqlite_session_factory()
+    session.execute(
+        'INSERT INTO event_outbox (id, event_type, payload, sku, created_at)'
+        ' VALUES (3, :event_type, :payload, :sku, :created_at)',
+        dict(
+            event_type='Allocated', sku='LAMP', created_at=datetime.utcnow(),
+            payload=outbox.serialize(events.Allocated('o3', 'LAMP', 10, 'b1')),
+        ),
+    )
+    session.commit()
+    projector = AllocationsViewProjector(sqlite_session_factory, gap_timeout=60)
+
+    assert projector.catch_up() == 1
+    assert projector.checkpoint() == 1
+
+    session.execute(
+        'UPDATE event_outbox SET created_at = :created_at WHERE id = 3',
+        dict(created_at=datetime.utcnow() - timedelta(minutes=5)),
+    )
+    session.commit()
+    assert projector.catch_up() == 1
+    assert projector.checkpoint() == 3
+
+
+def insert_outbox_row(session, outbox_id, event, created_at):
+    session.execute(
+        'INSERT INTO event_outbox (id, event_type, payload, sku, created_at)'
+        ' VALUES (:id, :event_type, :payload, :sku, :created_at)',
+        dict(
+            id=outbox_id, event_type=type(event).__name__, sku=event.sku,
+            created_at=created_at, payload=outbox.serialize(event),
+        ),
+    )
+    session.commit()
+
+
+def test_catch_up_projects_rows_that_commit_after_their_gap_was_skipped(
+        sqlite_session_factory
+):
+    add_to_outbox(sqlite_session_factory, events.Allocated('o1', 'LAMP', 10, 'b1'))
+    session = sqlite_session_factory()
+    long_ago = datetime.utcnow() - timedelta(minutes=5)
+    insert_outbox_row(session, 4, events.Allocated('o4', 'LAMP', 10, 'b1'), long_ago)
+    projector = AllocationsViewProjector(sqlite_session_factory, gap_timeout=60)
+
+    assert projector.catch_up() == 2
+    assert projector.checkpoint() == 4
+
+    insert_outbox_row(session, 3, events.Allocated('o3', 'LAMP', 10, 'b1'), long_ago)
+    fresh = AllocationsViewProjector(sqlite_session_factory, gap_timeout=60)
+    assert fresh.catch_up() == 1
+    assert fresh.catch_up() == 0
+    assert view_rows(sqlite_session_factory) == [
+        ('o1', 'LAMP', 'b1'), ('o3', 'LAMP', 'b1'), ('o4', 'LAMP', 'b1'),
+    ]
+    assert fresh.checkpoint() == 4
+
+
+def test_catch_up_stops_looking_for_skipped_rows_after_skipped_ttl(sqlite_session_factory):
+    session = sqlite_session_factory()
+    long_ago = datetime.utcnow() - timedelta(minutes=5)
+    insert_outbox_row(session, 2, events.Allocated('o2', 'LAMP', 10, 'b1'), long_ago)
+    projector = AllocationsViewProjector(sqlite_session_factory, gap_timeout=60, skipped_ttl=0)
+
+    assert projector.catch_up() == 1
+
+    insert_outbox_row(session, 1, events.Allocated('o1', 'LAMP', 10, 'b1'), long_ago)
+    assert projector.catch_up() == 0
+    assert view_rows(sqlite_session_factory) == [('o2', 'LAMP', 'b1')]
+
+
+@pytest.fixture
+def sqlite_bus(sqlite_session_factory):
+    bus = bootstrap.bootstrap(
+        start_orm=True,
+        uow=unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory),
+        notifications=mock.Mock(),
+        publish=lambda *args: None,
+    )
+    yield bus
+    clear_mappers()
+
+
+def test_rebuild_recomputes_the_view_from_the_write_tables(
+        sqlite_bus, sqlite_session_factory
+):
+    sqlite_bus.handle(commands.CreateBatch('b1', 'LAMP', 20, None))
+    sqlite_bus.handle(commands.CreateBatch('b2', 'RUG', 20, None))
+    for orderid, sku in [('o1', 'LAMP'), ('o2', 'LAMP'), ('o3', 'RUG')]:
+        sqlite_bus.handle(commands.Allocate(orderid, sku, 5))
+    add_to_outbox(sqlite_session_factory, events.Allocated('o4', 'RUG', 1, 'b2'))
+    session = sqlite_session_factory()
+    session.execute("DELETE FROM allocations_view WHERE orderid = 'o2'")
+    session.execute(
+        "INSERT INTO allocations_view (orderid, sku, batchref) VALUES ('bogus', 'RUG', 'b9')"
+    )
+    session.commit()
+    projector = AllocationsViewProjector(sqlite_session_factory)
+
+    assert projector.rebuild(chunk_size=2) == 3
+
+    assert view_rows(sqlite_session_factory) == [
+        ('o1', 'LAMP', 'b1'), ('o2', 'LAMP', 'b1'), ('o3', 'RUG', 'b2'),
+    ]
+    assert projector.checkpoint() == 1
@@ -0,0 +1,124 @@
+# pylint: disable=redefined-outer-name
+import json
+from unittest import mock
+import pytest
+from allocation import bootstrap
+from allocation.adapters.redis_eventpublisher import OutboxRelay, add_to_outbox
+from allocation.domain import commands, events, model
+from allocation.service_layer import unit_of_work
+from ..fake_redis import FakeRedis
+
+
+def allocated(orderid):
+    return events.Allocated(orderid=orderid, sku='sku1', qty=1, batchref='b1')
+
+
+def queue(session_factory, *new_events):
+    session = session_factory()
+    add_to_outbox(session, new_events)
+    session.commit()
+    session.close()
+
+
+def queued(session_factory):
+    return [
+        (channel, json.loads(message)) for channel, message in
+        session_factory().execute('SELECT channel, message FROM outbox ORDER BY id')
+    ]
+
+
+@pytest.fixture
+def published():
+    return []
+
+
+@pytest.fixture
+def publish_outbox_bus(sqlite_file_session_factory, published, mappers, monkeypatch):
+    # pylint: disable=unused-argument
+    monkeypatch.setenv('PUBLISH_OUTBOX', '1')
+    return bootstrap.bootstrap(
+        start_orm=False,
+        uow=unit_of_work.SqlAlchemyUnitOfWork(
+            sqlite_file_session_factory, publish_outbox=True,
+        ),
+        notifications=mock.Mock(),
+        publish=lambda _, event: published.append(event),
+    )
+
+
+def test_allocations_queue_their_messages_in_the_same_transaction(
+        publish_outbox_bus, sqlite_file_session_factory, published
+):
+    publish_outbox_bus.handle(commands.CreateBatch('b1', 'QUIET-FAN', 100, None))
+    publish_outbox_bus.handle(commands.Allocate('o1', 'QUIET-FAN', 10))
+
+    assert published == []
+    assert queued(sqlite_file_session_factory) == [('line_allocated', dict(
+        orderid='o1', sku='QUIET-FAN', qty=10, batchref='b1',
+    ))]
+
+
+def test_nothing_is_queued_when_the_allocation_rolls_back(sqlite_file_session_factory, mappers):
+    # pylint: disable=unused-argument
+    uow = unit_of_work.SqlAlchemyUnitOfWork(sqlite_file_session_factory, publish_outbox=True)
+    bus = bootstrap.bootstrap(start_orm=False, uow=uow, notifications=mock.Mock())
+    bus.handle(commands.CreateBatch('b1', 'LOUD-FAN', 100, None))
+
+    with pytest.raises(Exception):
+        with uow:
+            uow.products.get('LOUD-FAN').allocate(model.OrderLine('o1', 'LOUD-FAN', 10))
+            uow.products.add(model.Product('LOUD-FAN', []))  # fails the commit
+            uow.commit()
+
+    assert queued(sqlite_file_session_factory) == []
+
+
+def test_committing_twice_queues_each_message_once(sqlite_file_session_factory, mappers):
+    # pylint: disable=unused-argument
+    uow = unit_of_work.SqlAlchemyUnitOfWork(sqlite_file_session_factory, publish_outbox=True)
+    bus = bootstrap.bootstrap(start_orm=False, uow=uow, notifications=mock.Mock())
+    bus.handle(commands.CreateBatch('b1', 'LOUD-FAN', 100, None))
+
+    with uow:
+        uow.products.get('LOUD-FAN').allocate(model.OrderLine('o1', 'LOUD-FAN', 10))
+        uow.commit()
+        uow.products.get('LOUD-FAN').allocate(model.OrderLine('o2', 'LOUD-FAN', 10))
+        uow.commit()
+
+    assert [message['orderid'] for _, message in queued(sqlite_file_session_factory)] == [
+        'o1', 'o2',
+    ]
+
+
+def test_relay_publishes_in_pipelined_batches(sqlite_file_session_factory):
+    queue(sqlite_file_session_factory, *[allocated(f'o{i}') for i in range(5)])
+    redis = FakeRedis()
+    relay = OutboxRelay(sqlite_file_session_factory, redis, batch_size=2)
+
+    assert [relay.flush() for _ in range(4)] == [2, 2, 1, 0]
+
+    assert redis.round_trips == 3
+    assert [json.loads(m)['orderid'] for _, m in redis.published] == [
+        'o0', 'o1', 'o2', 'o3', 'o4',
+    ]
+
+
+def test_relay_leaves_messages_queued_if_redis_fails(sqlite_file_session_factory):
+    queue(sqlite_file_session_factory, allocated('o1'))
+
+    class BrokenPipeline:
+
+        def publish(self, *_):
+            pass
+
+        def execute(self):
+            raise ConnectionError('redis went away')
+
+    broken = FakeRedis()
+    broken.pipeline = lambda transaction=True: BrokenPipeline()
+    with pytest.raises(ConnectionError):
+        OutboxRelay(sqlite_file_session_factory, broken).flush()
+
+    redis = FakeRedis()
+    assert OutboxRelay(sqlite_file_session_factory, redis).flush() == 1
+    assert len(redis.published) == 1
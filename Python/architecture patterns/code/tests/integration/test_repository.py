@@ -1,6 +1,8 @@
 import pytest
+from sqlalchemy import event, inspect
 from allocation.adapters import repository
-from allocation.domain import model
+from allocation.domain import commands, model
+from allocation.service_layer import handlers, unit_of_work
 
 pytestmark = pytest.mark.usefixtures('mappers')
 
@@ -17,3 +19,134 @@ def test_get_by_batchref(sqlite_session_factory):
     repo.add(p2)
     assert repo.get_by_batchref('b2') == p1
     assert repo.get_by_batchref('b3') == p2
+
+
+def test_get_by_batchref_remembers_skus(sqlite_session_factory):
+    session = sqlite_session_factory()
+    batchref_skus = repository.BatchrefSkus()
+    repo = repository.SqlAlchemyRepository(session, batchref_skus=batchref_skus)
+    repo.add(model.Product('sku1', [
+        model.Batch('b1', 'sku1', 100, eta=None),
+        model.Batch('b2', 'sku1', 100, eta=None),
+    ]))
+    session.commit()
+
+    repo = repository.SqlAlchemyRepository(
+        sqlite_session_factory(), batchref_skus=batchref_skus
+    )
+    assert repo.get_by_batchref('b1').sku == 'sku1'
+    assert batchref_skus.get('b1') == 'sku1'
+    assert batchref_skus.get('b2') == 'sku1'
+
+
+def test_get_by_batchref_ignores_remembered_skus_that_are_wrong(
+        sqlite_session_factory
+):
+    session = sqlite_session_factory()
+    batchref_skus = repository.BatchrefSkus()
+    repo = repository.SqlAlchemyRepository(session, batchref_skus=batchref_skus)
+    repo.add(model.Product('sku1', [model.Batch('b1', 'sku1', 100, eta=None)]))
+    repo.add(model.Product('sku2', [model.Batch('b2', 'sku2', 100, eta=None)]))
+    session.commit()
+    batchref_skus.remember(model.Product('sku1', [model.Batch('b2', 'sku1', 1, eta=None)]))
+
+    assert repo.get_by_batchref('b2').sku == 'sku2'
+    assert batchref_skus.get('b2') == 'sku2'
+
+
+def test_batchref_skus_drops_least_recently_used():
+    batchref_skus = repository.BatchrefSkus(max_size=2)
+    batchref_skus.remember(model.Product('sku1', [model.Batch('b1', 'sku1', 1, eta=None)]))
+    batchref_skus.remember(model.Product('sku2', [model.Batch('b2', 'sku2', 1, eta=None)]))
+    batchref_skus.get('b1')
+    batchref_skus.remember(model.Product('sku3', [model.Batch('b3', 'sku3', 1, eta=None)]))
+
+    assert batchref_skus.get('b2') is None
+    assert batchref_skus.get('b1') == 'sku1'
+
+
+def test_lookup_columns_are_indexed(in_memory_sqlite_db):
+    indexed = {
+        (table, column)
+        for table in ('batches', 'order_lines', 'allocations', 'allocations_view')
+        for index in inspect(in_memory_sqlite_db).get_indexes(table)
+        for column in index['column_names']
+    }
+    assert {
+        ('batches', 'reference'),
+        ('batches', 'sku'),
+        ('order_lines', 'orderid'),
+        ('allocations', 'batch_id'),
+        ('allocations_view', 'orderid'),
+    } <= indexed
+
+
+def test_loaded_batches_know_their_allocated_quantity(sqlite_session_factory):
+    session = sqlite_session_factory()
+    repo = repository.SqlAlchemyRepository(session)
+    batch = model.Batch(ref='b1', sku='sku1', qty=100, eta=None)
+    product = model.Product(sku='sku1', batches=[batch])
+    product.allocate(model.OrderLine('o1', 'sku1', 10))
+    product.allocate(model.OrderLine('o2', 'sku1', 15))
+    repo.add(product)
+    session.commit()
+
+    repo = repository.SqlAlchemyRepository(sqlite_session_factory())
+    [batch] = repo.get('sku1').batches
+    assert batch.allocated_quantity == 25
+    batch.deallocate_one()
+    assert batch.available_quantity in (85, 90)
+
+
+def test_get_many(sqlite_session_factory):
+    session = sqlite_session_factory()
+    repo = repository.SqlAlchemyRepository(session)
+    repo.add(model.Product('sku1', [model.Batch('b1', 'sku1', 100, eta=None)]))
+    repo.add(model.Product('sku2', [model.Batch('b2', 'sku2', 100, eta=None)]))
+    session.commit()
+
+    repo = repository.SqlAlchemyRepository(sqlite_session_factory())
+    products = repo.get_many(['sku1', 'sku2', 'nonexistent'])
+    assert products['sku1'].batches[0].reference == 'b1'
+    assert products['sku2'].batches[0].reference == 'b2'
+    assert products['nonexistent'] is None
+    assert repo.seen == {products['sku1'], products['sku2']}
+
+
+def count_statements_per_allocate(session_factory, number_of_batches):
+    session = session_factory()
+    batches = [
+        model.Batch(f'b{i}', 'sku1', 100, eta=None)
+        for i in range(number_of_batches)
+    ]
+    product = model.Product('sku1', batches)
+    for i in range(number_of_batches * 3):
+        product.allocate(model.OrderLine(f'o{i}', 'sku1', 10))
+    session.add(product)
+    session.commit()
+
+    statements = []
+    engine = session_factory.kw['bind']
+    def before_cursor_execute(conn, cursor, statement, *_):  # pylint: disable=unused-argument
+        statements.append(statement)
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        handlers.allocate(
+            commands.Allocate('new-order', 'sku1', 10),
+            unit_of_work.SqlAlchemyUnitOfWork(session_factory),
+        )
+    finally:
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+    return statements
+
+
+@pytest.mark.parametrize('number_of_batches', [1, 20])
+def test_allocate_issues_a_fixed_number_of_statements(
+        sqlite_session_factory, number_of_batches
+):
+    statements = count_statements_per_allocate(sqlite_session_factory, number_of_batches)
+    selects = [s for s in statements if s.lstrip().upper().startswith('SELECT')]
+    # product, its batches and their allocations
+    assert len(selects) == 3
+    # the new order line, its allocation and the product version bump
+    assert len(statements) == 6
@@ -1,12 +1,21 @@
 # pylint: disable=broad-except, too-many-arguments
+import asyncio
 import threading
 import time
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 from typing import List
 from unittest.mock import Mock
 import pytest
-from allocation.domain import model
-from allocation.service_layer import unit_of_work
+from sqlalchemy import create_engine, exc
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
+from allocation import bootstrap, views
+from allocation.adapters.metrics import InMemoryMetrics
+from allocation.adapters.orm import metadata
+from allocation.adapters.product_cache import ProductCache
+from allocation.domain import commands, model
+from allocation.service_layer import messagebus, unit_of_work
 from ..random_refs import random_sku, random_batchref, random_orderid
 
 pytestmark = pytest.mark.usefixtures('mappers')
@@ -130,3 +139,317 @@ def test_concurrent_updates_to_version_are_not_allowed(postgres_session_factory)
     assert len(orders) == 1
     with unit_of_work.SqlAlchemyUnitOfWork(postgres_session_factory) as uow:
         uow.session.execute('select 1')
+
+
+def test_concurrent_allocations_to_one_sku_never_overallocate(postgres_session_factory):
+    sku = random_sku('hot')
+    batches = [random_batchref(1), random_batchref(2)]
+    session = postgres_session_factory()
+    insert_batch(session, batches[0], sku, 50, eta=None, product_version=1)
+    session.execute(
+        'INSERT INTO batches (reference, sku, _purchased_quantity, eta)'
+        ' VALUES (:ref, :sku, 50, NULL)',
+        dict(ref=batches[1], sku=sku),
+    )
+    session.commit()
+    bus = bootstrap.bootstrap(
+        start_orm=False,
+        uow=unit_of_work.SqlAlchemyUnitOfWork(postgres_session_factory),
+        notifications=Mock(),
+        publish=lambda *args: None,
+        retry=messagebus.RetryPolicy(max_attempts=100, base_delay=0.001, max_delay=0.05),
+    )
+    gave_up = []  # type: List[Exception]
+
+    def allocate(i):
+        try:
+            bus.handle(commands.Allocate(random_orderid(str(i)), sku, 1))
+        except unit_of_work.ConcurrencyError as e:
+            gave_up.append(e)
+
+    # twice as many orders as there is stock, all racing for the same row
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        list(executor.map(allocate, range(200)))
+
+    allocated = {ref: qty for ref, qty in session.execute(
+        'SELECT batches.reference, sum(order_lines.qty) FROM allocations'
+        ' JOIN batches ON allocations.batch_id = batches.id'
+        ' JOIN order_lines ON allocations.orderline_id = order_lines.id'
+        ' WHERE batches.sku = :sku GROUP BY batches.reference',
+        dict(sku=sku),
+    )}
+    assert all(allocated.get(ref, 0) <= 50 for ref in batches)
+    [[version]] = session.execute(
+        'SELECT version_number FROM products WHERE sku = :sku', dict(sku=sku),
+    )
+    # every allocation that committed saw the one before it
+    assert version == 1 + sum(allocated.values())
+    assert sum(allocated.values()) == 100 or gave_up
+
+
+@pytest.mark.parametrize('product_cache', [None, ProductCache()])
+def test_concurrent_requests_on_one_bus_do_not_share_sessions(
+        sqlite_file_session_factory, product_cache
+):
+    bus = bootstrap.bootstrap(
+        start_orm=False,
+        uow=unit_of_work.SqlAlchemyUnitOfWork(
+            sqlite_file_session_factory, product_cache=product_cache,
+        ),
+        notifications=Mock(),
+        publish=lambda *args: None,
+    )
+    skus = [random_sku(str(i)) for i in range(200)]
+    for sku in skus:
+        bus.handle(commands.CreateBatch(f'batch-{sku}', sku, 10, None))
+
+    def allocate_and_read_back(sku):
+        bus.handle(commands.Allocate(f'order-{sku}', sku, 1))
+        return views.allocations(f'order-{sku}', bus.uow)
+
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        results = list(executor.map(allocate_and_read_back, skus))
+
+    for sku, result in zip(skus, results):
+        assert result == [{'sku': sku, 'batchref': f'batch-{sku}'}]
+    session = sqlite_file_session_factory()
+    [[count]] = session.execute('SELECT count(*) FROM allocations')
+    assert count == len(skus)
+
+
+def test_async_uow_can_retrieve_a_batch_and_allocate_to_it(
+        sqlite_file_session_factory
+):
+    session = sqlite_file_session_factory()
+    insert_batch(session, 'batch1', 'ASYNC-WORKBENCH', 100, None)
+    session.commit()
+
+    async def allocate():
+        uow = unit_of_work.AsyncSqlAlchemyUnitOfWork(sqlite_file_session_factory)
+        async with uow:
+            product = await uow.run_sync(uow.products.get, 'ASYNC-WORKBENCH')
+            product.allocate(model.OrderLine('o1', 'ASYNC-WORKBENCH', 10))
+            await uow.run_sync(uow.commit)
+
+    asyncio.run(allocate())
+
+    batchref = get_allocated_batch_ref(session, 'o1', 'ASYNC-WORKBENCH')
+    assert batchref == 'batch1'
+
+
+def test_async_uow_rolls_back_uncommitted_work(sqlite_file_session_factory):
+    async def insert_without_committing():
+        uow = unit_of_work.AsyncSqlAlchemyUnitOfWork(sqlite_file_session_factory)
+        async with uow:
+            await uow.run_sync(
+                insert_batch, uow.session, 'batch1', 'MEDIUM-PLINTH', 100, None,
+            )
+
+    asyncio.run(insert_without_committing())
+
+    new_session = sqlite_file_session_factory()
+    rows = list(new_session.execute('SELECT * FROM "batches"'))
+    assert rows == []
+
+
+def allocate_through(uow, orderid, sku):
+    with uow:
+        product = uow.products.get(sku=sku)
+        product.allocate(model.OrderLine(orderid, sku, 10))
+        uow.commit()
+    return list(uow.collect_new_events())
+
+
+def test_product_cache_serves_committed_products(sqlite_session_factory):
+    session = sqlite_session_factory()
+    insert_batch(session, 'batch1', 'HIPSTER-WORKBENCH', 100, None)
+    session.commit()
+    cache = ProductCache()
+    uow = unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory, product_cache=cache)
+
+    allocate_through(uow, 'o1', 'HIPSTER-WORKBENCH')
+    events = allocate_through(uow, 'o2', 'HIPSTER-WORKBENCH')
+
+    assert cache.stats.misses == 1
+    assert cache.stats.hits == 1
+    assert [e.orderid for e in events] == ['o2']
+    assert get_allocated_batch_ref(session, 'o2', 'HIPSTER-WORKBENCH') == 'batch1'
+    [[allocated]] = session.execute(
+        'SELECT count(*) FROM allocations JOIN batches AS b ON batch_id = b.id'
+        " WHERE b.reference = 'batch1'"
+    )
+    assert allocated == 2
+
+
+def test_async_uow_serves_committed_products_from_the_cache(sqlite_file_session_factory):
+    session = sqlite_file_session_factory()
+    insert_batch(session, 'batch1', 'ASYNC-BENCH', 100, None)
+    session.commit()
+    cache = ProductCache()
+    uow = unit_of_work.AsyncSqlAlchemyUnitOfWork(sqlite_file_session_factory, product_cache=cache)
+
+    async def allocate(orderid):
+        async with uow:
+            product = await uow.run_sync(uow.products.get, 'ASYNC-BENCH')
+            product.allocate(model.OrderLine(orderid, 'ASYNC-BENCH', 10))
+            await uow.run_sync(uow.commit)
+
+    for orderid in ('o1', 'o2', 'o3'):
+        asyncio.run(allocate(orderid))
+
+    assert (cache.stats.misses, cache.stats.hits) == (1, 2)
+    assert len(cache) == 1
+    assert get_allocated_batch_ref(session, 'o3', 'ASYNC-BENCH') == 'batch1'
+
+
+def test_product_cache_reloads_products_changed_elsewhere(sqlite_session_factory):
+    session = sqlite_session_factory()
+    insert_batch(session, 'batch1', 'HIPSTER-WORKBENCH', 100, None)
+    session.commit()
+    cache = ProductCache()
+    uow = unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory, product_cache=cache)
+    allocate_through(uow, 'o1', 'HIPSTER-WORKBENCH')
+
+    session.execute(
+        "UPDATE batches SET _purchased_quantity = 15 WHERE reference = 'batch1'"
+    )
+    session.execute(
+        "UPDATE products SET version_number = version_number + 1"
+        " WHERE sku = 'HIPSTER-WORKBENCH'"
+    )
+    session.commit()
+    with uow:
+        [batch] = uow.products.get(sku='HIPSTER-WORKBENCH').batches
+        assert batch.available_quantity == 5
+
+    assert cache.stats.stale == 1
+
+
+def test_product_cache_does_not_keep_uncommitted_products(sqlite_session_factory):
+    session = sqlite_session_factory()
+    insert_batch(session, 'batch1', 'HIPSTER-WORKBENCH', 100, None)
+    session.commit()
+    cache = ProductCache()
+    uow = unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory, product_cache=cache)
+
+    with uow:
+        product = uow.products.get(sku='HIPSTER-WORKBENCH')
+        product.allocate(model.OrderLine('o1', 'HIPSTER-WORKBENCH', 10))
+
+    assert len(cache) == 0
+
+
+def test_product_cache_is_invalidated_when_commit_fails(sqlite_session_factory):
+    session = sqlite_session_factory()
+    insert_batch(session, 'batch1', 'HIPSTER-WORKBENCH', 100, None)
+    session.commit()
+    cache = ProductCache()
+    uow = unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory, product_cache=cache)
+    allocate_through(uow, 'o1', 'HIPSTER-WORKBENCH')
+
+    with pytest.raises(Exception):
+        with uow:
+            product = uow.products.get(sku='HIPSTER-WORKBENCH')
+            product.allocate(model.OrderLine('o2', 'HIPSTER-WORKBENCH', 10))
+            # as if another unit of work had put its copy back meanwhile
+            cache.put(model.Product('HIPSTER-WORKBENCH', [], product.version_number))
+            uow.products.add(model.Product('HIPSTER-WORKBENCH', []))
+            uow.commit()
+
+    assert len(cache) == 0
+
+
+def test_allocate_many_commits_product_by_product(sqlite_session_factory):
+    session = sqlite_session_factory()
+    for ref, sku in (('b1', 'LOW-STOOL'), ('b2', 'HIGH-STOOL'), ('b3', 'BAR-STOOL')):
+        insert_batch(session, ref, sku, 100, None)
+    session.execute(
+        "CREATE TRIGGER no_room BEFORE INSERT ON allocations"
+        " WHEN NEW.batch_id = (SELECT id FROM batches WHERE reference = 'b2')"
+        " BEGIN SELECT RAISE(ABORT, 'no room in b2'); END"
+    )
+    session.commit()
+    published = []
+    bus = bootstrap.bootstrap(
+        start_orm=False,
+        uow=unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory, product_cache=ProductCache()),
+        notifications=Mock(),
+        publish=lambda _, event: published.append(event),
+    )
+
+    cmd = commands.AllocateMany([
+        commands.Allocate('o1', 'LOW-STOOL', 10),
+        commands.Allocate('o2', 'HIGH-STOOL', 10),
+        commands.Allocate('o3', 'BAR-STOOL', 10),
+    ])
+
+    with pytest.raises(exc.DBAPIError):
+        bus.handle(cmd)
+    bus.handle(commands.Allocate('o4', 'BAR-STOOL', 10))
+
+    assert sorted(e.orderid for e in published) == ['o1', 'o4']
+    session = sqlite_session_factory()
+    assert get_allocated_batch_ref(session, 'o1', 'LOW-STOOL') == 'b1'
+    assert get_allocated_batch_ref(session, 'o4', 'BAR-STOOL') == 'b3'
+    assert list(session.execute("SELECT orderid FROM order_lines WHERE sku = 'HIGH-STOOL'")) == []
+
+    session.execute('DROP TRIGGER no_room')
+    session.commit()
+    assert bus.handle(cmd) == {}
+
+    assert sorted(e.orderid for e in published) == ['o1', 'o2', 'o3', 'o4']
+    assert list(session.execute("SELECT COUNT(*) FROM order_lines WHERE orderid = 'o1'")) == [(1,)]
+
+
+def test_lock_conflicts_raise_concurrency_error(tmp_path):
+    engine = create_engine(
+        f'sqlite:///{tmp_path / "locked.sqlite"}', connect_args={'timeout': 0},
+    )
+    metadata.create_all(engine)
+    session_factory = sessionmaker(bind=engine)
+    session = session_factory()
+    insert_batch(session, 'batch1', 'HIPSTER-WORKBENCH', 100, None)
+    session.commit()
+
+    blocker = session_factory()
+    blocker.execute("UPDATE products SET version_number = 2")
+    try:
+        with pytest.raises(unit_of_work.ConcurrencyError):
+            allocate_through(
+                unit_of_work.SqlAlchemyUnitOfWork(session_factory),
+                'o1', 'HIPSTER-WORKBENCH',
+            )
+    finally:
+        blocker.rollback()
+
+
+def test_uow_reports_checkout_time_and_pool_counts(tmp_path):
+    engine = create_engine(
+        f'sqlite:///{tmp_path / "pooled.sqlite"}', poolclass=QueuePool, pool_size=2,
+    )
+    metadata.create_all(engine)
+    fake_metrics = InMemoryMetrics()
+    uow = unit_of_work.SqlAlchemyUnitOfWork(sessionmaker(bind=engine), metrics=fake_metrics)
+
+    with uow:
+        assert fake_metrics.gauges['db.pool.checkedout'] == 1
+    with uow:
+        pass
+
+    assert len(fake_metrics.timings['db.checkout']) == 2
+    assert fake_metrics.gauges['db.pool.size'] == 2
+
+
+def test_default_session_factory_creates_the_engine_on_first_use(monkeypatch):
+    engines = []
+    def get_engine():
+        engines.append(create_engine('sqlite://'))
+        return engines[-1]
+    monkeypatch.setattr(unit_of_work, 'get_engine', get_engine)
+    factory = unit_of_work.LazySessionFactory()
+    assert engines == []
+
+    factory()
+    factory()
+
+    assert len(engines) == 1
@@ -4,6 +4,7 @@ from sqlalchemy.orm import clear_mappers
 from unittest import mock
 import pytest
 from allocation import bootstrap, views
+from allocation.adapters.allocations_cache import AllocationsCache
 from allocation.domain import commands
 from allocation.service_layer import unit_of_work
 
@@ -11,12 +12,18 @@ today = date.today()
 
 
 @pytest.fixture
-def sqlite_bus(sqlite_session_factory):
+def allocations_cache():
+    return AllocationsCache()
+
+
+@pytest.fixture
+def sqlite_bus(sqlite_session_factory, allocations_cache):
     bus = bootstrap.bootstrap(
         start_orm=True,
         uow=unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory),
         notifications=mock.Mock(),
         publish=lambda *args: None,
+        allocations_cache=allocations_cache,
     )
     yield bus
     clear_mappers()
@@ -46,3 +53,37 @@ def test_deallocation(sqlite_bus):
     assert views.allocations('o1', sqlite_bus.uow) == [
         {'sku': 'sku1', 'batchref': 'b2'},
     ]
+
+
+def test_sku_for_batch(sqlite_bus):
+    sqlite_bus.handle(commands.CreateBatch('b1', 'sku1', 50, None))
+
+    assert views.sku_for_batch('b1', sqlite_bus.uow) == 'sku1'
+    assert views.sku_for_batch('nonexistent', sqlite_bus.uow) is None
+    assert views.skus_for_batches(['b1', 'nonexistent'], sqlite_bus.uow) == {'b1': 'sku1'}
+    assert views.skus_for_batches([], sqlite_bus.uow) == {}
+
+
+def test_cached_allocations_are_invalidated_by_events(sqlite_bus, allocations_cache):
+    sqlite_bus.handle(commands.CreateBatch('b1', 'sku1', 50, None))
+    sqlite_bus.handle(commands.CreateBatch('b2', 'sku1', 50, today))
+    sqlite_bus.handle(commands.Allocate('o1', 'sku1', 40))
+    assert views.allocations('o1', sqlite_bus.uow, allocations_cache) == [
+        {'sku': 'sku1', 'batchref': 'b1'},
+    ]
+    assert views.allocations('o1', sqlite_bus.uow, allocations_cache) == [
+        {'sku': 'sku1', 'batchref': 'b1'},
+    ]
+    assert allocations_cache.stats.hits == 1
+
+    sqlite_bus.handle(commands.ChangeBatchQuantity('b1', 10))
+
+    assert views.allocations('o1', sqlite_bus.uow, allocations_cache) == [
+        {'sku': 'sku1', 'batchref': 'b2'},
+    ]
+
+
+def test_etag_changes_with_the_allocations():
+    rows = [{'sku': 'sku1', 'batchref': 'b1'}]
+    assert views.etag(rows) == views.etag([dict(rows[0])])
+    assert views.etag(rows) != views.etag([{'sku': 'sku1', 'batchref': 'b2'}])
@@ -0,0 +1,81 @@
+import pytest
+from allocation import bootstrap
+from allocation.adapters.allocations_cache import AllocationsCache
+
+ROWS = [{'sku': 'LAMP', 'batchref': 'b1'}]
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_returns_rows_until_the_ttl_runs_out():
+    clock = FakeClock()
+    cache = AllocationsCache(ttl=10, clock=clock)
+    cache.put('o1', ROWS, cache.token())
+
+    clock.now = 9
+    assert cache.get('o1') == ROWS
+    clock.now = 10
+    assert cache.get('o1') is None
+    assert cache.stats.hits == 1
+    assert cache.stats.stale == 1
+
+
+def test_invalidated_orders_are_missed():
+    cache = AllocationsCache()
+    cache.put('o1', ROWS, cache.token())
+
+    cache.invalidate('o1')
+
+    assert cache.get('o1') is None
+
+
+def test_rows_read_before_an_invalidation_are_not_cached():
+    cache = AllocationsCache()
+    token = cache.token()
+    cache.invalidate('o1')  # while the reader was querying
+
+    cache.put('o1', ROWS, token)
+
+    assert cache.get('o1') is None
+    cache.put('o1', ROWS, cache.token())
+    assert cache.get('o1') == ROWS
+
+
+def test_evicts_least_recently_used():
+    cache = AllocationsCache(max_entries=2)
+    cache.put('o1', ROWS, cache.token())
+    cache.put('o2', ROWS, cache.token())
+    cache.get('o1')
+    cache.put('o3', ROWS, cache.token())
+
+    assert cache.get('o2') is None
+    assert cache.get('o1') == ROWS
+    assert cache.stats.evictions == 1
+
+
+def test_is_off_by_default(monkeypatch):
+    monkeypatch.delenv('ALLOCATIONS_CACHE_SIZE', raising=False)
+    assert bootstrap.default_allocations_cache() is None
+
+
+def test_is_on_once_sized(monkeypatch):
+    monkeypatch.delenv('READ_MODEL_PROJECTOR', raising=False)
+    monkeypatch.delenv('EVENT_OUTBOX', raising=False)
+    monkeypatch.setenv('ALLOCATIONS_CACHE_SIZE', '100')
+    assert isinstance(bootstrap.default_allocations_cache(), AllocationsCache)
+
+
+@pytest.mark.parametrize('mode', ['READ_MODEL_PROJECTOR', 'EVENT_OUTBOX'])
+def test_is_off_when_the_read_model_is_updated_elsewhere(monkeypatch, mode):
+    monkeypatch.delenv('READ_MODEL_PROJECTOR', raising=False)
+    monkeypatch.delenv('EVENT_OUTBOX', raising=False)
+    monkeypatch.setenv('ALLOCATIONS_CACHE_SIZE', '100')
+    monkeypatch.setenv(mode, '1')
+    assert bootstrap.default_allocations_cache() is None
@@ -1,4 +1,5 @@
 from datetime import date
+import pytest
 from allocation.domain.model import Batch, OrderLine
 
 
@@ -39,3 +40,16 @@ def test_allocation_is_idempotent():
     batch.allocate(line)
     batch.allocate(line)
     assert batch.available_quantity == 18
+
+def test_deallocating_returns_the_quantity():
+    batch, line = make_batch_and_line("DECORATIVE-TRINKET", 20, 2)
+    batch.allocate(line)
+    assert batch.deallocate_one() == line
+    assert batch.allocated_quantity == 0
+    assert batch.available_quantity == 20
+
+def test_debug_checks_catch_allocations_changed_behind_our_back():
+    batch, line = make_batch_and_line("SHIFTY-TABLE", 20, 2)
+    batch._allocations.add(line)
+    with pytest.raises(AssertionError):
+        batch.available_quantity  # pylint: disable=pointless-statement
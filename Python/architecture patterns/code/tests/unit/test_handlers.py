@@ -1,13 +1,14 @@
 # pylint: disable=no-self-use
 from __future__ import annotations
+import asyncio
 from collections import defaultdict
 from datetime import date
 from typing import Dict, List
 import pytest
 from allocation import bootstrap
-from allocation.domain import commands
-from allocation.service_layer import handlers
-from allocation.adapters import notifications, repository
+from allocation.domain import commands, events
+from allocation.service_layer import handlers, messagebus
+from allocation.adapters import metrics, notifications, repository
 from allocation.service_layer import unit_of_work
 
 
@@ -30,10 +31,22 @@ class FakeRepository(repository.AbstractRepository):
         ), None)
 
 
+class FakeSession:
+    # just enough for the read model handlers
+
+    def __init__(self):
+        self.executed = []
+
+    def execute(self, statement, params=None):
+        self.executed.append((statement, params))
+
+
 class FakeUnitOfWork(unit_of_work.AbstractUnitOfWork):
 
     def __init__(self):
         self.products = FakeRepository([])
+        self.session = FakeSession()
+        self.committed_events = []
         self.committed = False
 
     def _commit(self):
@@ -119,6 +132,113 @@ class TestAllocate:
 
 
 
+class TestAllocateMany:
+
+    def test_allocates_lines_for_several_products(self):
+        bus = bootstrap_test_app()
+        bus.handle(commands.CreateBatch("b1", "SHINY-KETTLE", 100, None))
+        bus.handle(commands.CreateBatch("b2", "DULL-KETTLE", 100, None))
+        bus.handle(commands.AllocateMany([
+            commands.Allocate("o1", "SHINY-KETTLE", 10),
+            commands.Allocate("o2", "DULL-KETTLE", 20),
+            commands.Allocate("o3", "SHINY-KETTLE", 30),
+        ]))
+        [shiny] = bus.uow.products.get("SHINY-KETTLE").batches
+        [dull] = bus.uow.products.get("DULL-KETTLE").batches
+        assert shiny.available_quantity == 60
+        assert dull.available_quantity == 80
+        assert bus.uow.committed
+
+
+    def test_publishes_an_event_per_line(self):
+        published = []
+        bus = bootstrap.bootstrap(
+            start_orm=False,
+            uow=FakeUnitOfWork(),
+            notifications=FakeNotifications(),
+            publish=lambda _, event: published.append(event),
+        )
+        bus.handle(commands.CreateBatch("b1", "TALL-STOOL", 100, None))
+        bus.handle(commands.AllocateMany([
+            commands.Allocate("o1", "TALL-STOOL", 10),
+            commands.Allocate("o2", "TALL-STOOL", 20),
+        ]))
+        assert [e.orderid for e in published] == ["o1", "o2"]
+
+
+    def test_reports_invalid_skus_and_still_allocates_the_rest(self):
+        bus = bootstrap_test_app()
+        bus.handle(commands.CreateBatch("b1", "REAL-SOFA", 100, None))
+
+        failed = bus.handle(commands.AllocateMany([
+            commands.Allocate("o1", "REAL-SOFA", 10),
+            commands.Allocate("o2", "FAKE-SOFA", 10),
+        ]))
+
+        assert failed == {"FAKE-SOFA": "Invalid sku FAKE-SOFA"}
+        [batch] = bus.uow.products.get("REAL-SOFA").batches
+        assert batch.available_quantity == 90
+
+
+    def test_a_conflict_is_retried_without_allocating_committed_lines_twice(self):
+        published = []
+        uow = FakeUnitOfWork()
+        bus = bootstrap.bootstrap(
+            start_orm=False,
+            uow=uow,
+            notifications=FakeNotifications(),
+            publish=lambda _, event: published.append(event),
+        )
+        bus.handle(commands.CreateBatch("b1", "LOW-STOOL", 100, None))
+        bus.handle(commands.CreateBatch("b2", "HIGH-STOOL", 100, None))
+        conflicts = ["HIGH-STOOL changed meanwhile"]
+
+        def commit():
+            high = next((p for p in uow.products.seen if p.sku == "HIGH-STOOL"), None)
+            if conflicts and high and high.events:
+                # undone, as the rollback of a real unit of work would
+                high.batches[0].deallocate_one()
+                raise unit_of_work.ConcurrencyError(conflicts.pop())
+        uow._commit = commit  # pylint: disable=protected-access
+        failed = bus.handle(commands.AllocateMany([
+            commands.Allocate("o1", "LOW-STOOL", 10),
+            commands.Allocate("o2", "HIGH-STOOL", 10),
+        ]))
+
+        assert failed == {}
+        assert sorted(e.orderid for e in published) == ["o1", "o2"]
+        [batch] = bus.uow.products.get("LOW-STOOL").batches
+        assert batch.available_quantity == 90
+
+
+    def test_a_failed_commit_raises_after_publishing_what_was_committed(self):
+        published = []
+        uow = FakeUnitOfWork()
+        bus = bootstrap.bootstrap(
+            start_orm=False,
+            uow=uow,
+            notifications=FakeNotifications(),
+            publish=lambda _, event: published.append(event),
+        )
+        bus.handle(commands.CreateBatch("b1", "LOW-STOOL", 100, None))
+        bus.handle(commands.CreateBatch("b2", "HIGH-STOOL", 100, None))
+
+        def commit():
+            high = next((p for p in uow.products.seen if p.sku == "HIGH-STOOL"), None)
+            if high and high.events:
+                high.batches[0].deallocate_one()
+                raise unit_of_work.ConcurrencyError("HIGH-STOOL changed meanwhile")
+        uow._commit = commit  # pylint: disable=protected-access
+        with pytest.raises(unit_of_work.ConcurrencyError):
+            bus.handle(commands.AllocateMany([
+                commands.Allocate("o1", "LOW-STOOL", 10),
+                commands.Allocate("o2", "HIGH-STOOL", 10),
+            ]))
+
+        assert [e.orderid for e in published] == ["o1"]
+
+
+
 class TestChangeBatchQuantity:
 
     def test_changes_available_quantity(self):
@@ -151,3 +271,229 @@ class TestChangeBatchQuantity:
         assert batch1.available_quantity == 5
         # and 20 will be reallocated to the next batch
         assert batch2.available_quantity == 30
+
+
+
+class TestMessageBusMetrics:
+
+    def test_counts_and_times_each_message_type(self):
+        fake_metrics = metrics.InMemoryMetrics()
+        bus = bootstrap.bootstrap(
+            start_orm=False,
+            uow=FakeUnitOfWork(),
+            notifications=FakeNotifications(),
+            publish=lambda *args: None,
+            metrics=fake_metrics,
+        )
+        bus.handle(commands.CreateBatch("b1", "QUIET-CLOCK", 100, None))
+        bus.handle(commands.Allocate("o1", "QUIET-CLOCK", 10))
+        bus.handle(commands.Allocate("o2", "QUIET-CLOCK", 10))
+
+        assert fake_metrics.counters['messagebus.CreateBatch.handled'] == 1
+        assert fake_metrics.counters['messagebus.Allocate.handled'] == 2
+        assert fake_metrics.counters['messagebus.Allocated.handled'] == 2
+        assert len(fake_metrics.timings['messagebus.Allocate']) == 2
+
+
+    def test_counts_failed_commands(self):
+        fake_metrics = metrics.InMemoryMetrics()
+        bus = bootstrap.bootstrap(
+            start_orm=False,
+            uow=FakeUnitOfWork(),
+            notifications=FakeNotifications(),
+            publish=lambda *args: None,
+            metrics=fake_metrics,
+        )
+        with pytest.raises(handlers.InvalidSku):
+            bus.handle(commands.Allocate("o1", "MISSING-CLOCK", 10))
+
+        assert fake_metrics.counters['messagebus.Allocate.failed'] == 1
+        assert fake_metrics.counters['messagebus.Allocate.handled'] == 0
+
+
+    def test_counts_events_with_a_failed_handler_as_failed_not_handled(self):
+        fake_metrics = metrics.InMemoryMetrics()
+
+        def broken(event):
+            raise Exception('no luck')
+
+        bus = messagebus.MessageBus(
+            uow=FakeUnitOfWork(),
+            event_handlers={events.OutOfStock: [lambda event: None, broken]},
+            command_handlers={},
+            metrics=fake_metrics,
+        )
+        bus.handle(events.OutOfStock("QUIET-CLOCK"))
+
+        assert fake_metrics.counters['messagebus.OutOfStock.failed'] == 1
+        assert fake_metrics.counters['messagebus.OutOfStock.handled'] == 0
+        assert len(fake_metrics.timings['messagebus.OutOfStock']) == 1
+
+
+    def test_rejects_messages_it_has_no_handler_for(self):
+        bus = bootstrap_test_app()
+        with pytest.raises(Exception, match="was not an Event or Command"):
+            bus.handle("not a message")
+
+
+
+class TestAsyncMessageBus:
+
+    def test_handles_commands_and_their_events(self):
+        published = []
+        bus = bootstrap.bootstrap_async(
+            start_orm=False,
+            uow=FakeUnitOfWork(),
+            notifications=FakeNotifications(),
+            publish=lambda _, event: published.append(event),
+        )
+        asyncio.run(bus.handle(commands.CreateBatch("b1", "SWIFT-DESK", 100, None)))
+        asyncio.run(bus.handle(commands.Allocate("o1", "SWIFT-DESK", 10)))
+
+        [batch] = bus.uow.products.get("SWIFT-DESK").batches
+        assert batch.available_quantity == 90
+        assert [e.orderid for e in published] == ["o1"]
+
+
+    def test_runs_handlers_for_one_event_concurrently(self):
+        async def run():
+            first_started, second_started = asyncio.Event(), asyncio.Event()
+
+            async def first(_):
+                first_started.set()
+                await second_started.wait()
+
+            async def second(_):
+                second_started.set()
+                await first_started.wait()
+
+            bus = messagebus.AsyncMessageBus(
+                uow=FakeUnitOfWork(),
+                event_handlers={events.OutOfStock: [first, second]},
+                command_handlers={},
+            )
+            # run one after the other, each would wait forever for the other
+            await asyncio.wait_for(bus.handle(events.OutOfStock("SLOW-SKU")), 1)
+
+        asyncio.run(run())
+
+
+    def test_counts_events_with_a_failed_handler_as_failed_not_handled(self):
+        fake_metrics = metrics.InMemoryMetrics()
+
+        async def broken(_):
+            raise Exception('no luck')
+
+        bus = messagebus.AsyncMessageBus(
+            uow=FakeUnitOfWork(),
+            event_handlers={events.OutOfStock: [broken]},
+            command_handlers={},
+            metrics=fake_metrics,
+        )
+        asyncio.run(bus.handle(events.OutOfStock("SLOW-SKU")))
+
+        assert fake_metrics.counters['messagebus.OutOfStock.failed'] == 1
+        assert fake_metrics.counters['messagebus.OutOfStock.handled'] == 0
+
+
+    def test_bootstraps_its_own_unit_of_work(self):
+        bus = bootstrap.bootstrap_async(
+            start_orm=False,
+            notifications=FakeNotifications(),
+            publish=lambda *args: None,
+        )
+        assert isinstance(bus.uow, unit_of_work.AsyncSqlAlchemyUnitOfWork)
+
+
+    def test_raises_command_errors(self):
+        bus = bootstrap.bootstrap_async(
+            start_orm=False,
+            uow=FakeUnitOfWork(),
+            notifications=FakeNotifications(),
+            publish=lambda *args: None,
+        )
+        with pytest.raises(handlers.InvalidSku):
+            asyncio.run(bus.handle(commands.Allocate("o1", "NO-SUCH-SKU", 10)))
+
+
+class FlakyHandler:
+
+    def __init__(self, failures):
+        self.failures = failures
+        self.calls = 0
+
+    def __call__(self, cmd):
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise unit_of_work.ConcurrencyError('could not serialize access')
+
+
+def bus_with_retry(handler, fake_metrics, max_attempts=3):
+    return messagebus.MessageBus(
+        uow=FakeUnitOfWork(),
+        event_handlers={},
+        command_handlers={commands.Allocate: handler},
+        metrics=fake_metrics,
+        retry=messagebus.RetryPolicy(max_attempts=max_attempts, base_delay=0),
+    )
+
+
+class TestCommandRetries:
+
+    def test_retries_commands_that_lost_a_race(self):
+        fake_metrics = metrics.InMemoryMetrics()
+        handler = FlakyHandler(failures=2)
+        bus = bus_with_retry(handler, fake_metrics)
+
+        bus.handle(commands.Allocate("o1", "RACY-LAMP", 10))
+
+        assert handler.calls == 3
+        assert fake_metrics.counters['messagebus.Allocate.retried'] == 2
+        assert fake_metrics.counters['messagebus.Allocate.handled'] == 1
+
+
+    def test_gives_up_after_max_attempts(self):
+        fake_metrics = metrics.InMemoryMetrics()
+        handler = FlakyHandler(failures=5)
+        bus = bus_with_retry(handler, fake_metrics)
+
+        with pytest.raises(unit_of_work.ConcurrencyError):
+            bus.handle(commands.Allocate("o1", "RACY-LAMP", 10))
+
+        assert handler.calls == 3
+        assert fake_metrics.counters['messagebus.Allocate.failed'] == 1
+
+
+    def test_does_not_retry_other_errors(self):
+        bus = bootstrap_test_app()
+        with pytest.raises(handlers.InvalidSku):
+            bus.handle(commands.Allocate("o1", "MISSING-LAMP", 10))
+
+
+    def test_backoff_is_jittered_and_capped(self):
+        policy = messagebus.RetryPolicy(base_delay=0.1, max_delay=0.3)
+        delays = [policy.delay(attempt) for attempt in range(1, 10) for _ in range(20)]
+        assert all(0 <= d <= 0.3 for d in delays)
+        assert len(set(delays)) > 1
+
+
+class TestInjectHandlers:
+
+    @staticmethod
+    def allocated_handlers(monkeypatch, **env):
+        for name in ('READ_MODEL_PROJECTOR', 'EVENT_OUTBOX', 'PUBLISH_OUTBOX'):
+            monkeypatch.delenv(name, raising=False)
+        for name, value in env.items():
+            monkeypatch.setenv(name, value)
+        event_handlers, _ = bootstrap.inject_handlers({})
+        return len(event_handlers[events.Allocated])
+
+    def test_keeps_the_read_model_handlers_without_the_event_outbox(self, monkeypatch):
+        every = len(handlers.EVENT_HANDLERS[events.Allocated])
+        assert self.allocated_handlers(monkeypatch, READ_MODEL_PROJECTOR='1') == every
+
+    def test_leaves_the_read_model_to_the_projector_reading_the_event_outbox(self, monkeypatch):
+        every = len(handlers.EVENT_HANDLERS[events.Allocated])
+        assert self.allocated_handlers(
+            monkeypatch, READ_MODEL_PROJECTOR='1', EVENT_OUTBOX='1',
+        ) == every - 1
@@ -1,5 +1,6 @@
 from datetime import date, timedelta
 from allocation.domain import events
+from allocation.domain import model
 from allocation.domain.model import Product, OrderLine, Batch
 
 
@@ -69,3 +70,122 @@ def test_increments_version_number():
     product.version_number = 7
     product.allocate(line)
     assert product.version_number == 8
+
+
+def test_skips_batches_without_enough_stock():
+    earliest = Batch("speedy-batch", "FANCY-TRAY", 5, eta=today)
+    medium = Batch("normal-batch", "FANCY-TRAY", 100, eta=tomorrow)
+    product = Product(sku="FANCY-TRAY", batches=[earliest, medium])
+
+    assert product.allocate(OrderLine("order1", "FANCY-TRAY", 10)) == "normal-batch"
+    assert product.allocate(OrderLine("order2", "FANCY-TRAY", 5)) == "speedy-batch"
+    assert product.allocate(OrderLine("order3", "FANCY-TRAY", 5)) == "normal-batch"
+
+
+def test_allocates_to_batches_added_after_first_allocation():
+    shipment_batch = Batch("shipment-batch", "TIDY-SHELF", 100, eta=tomorrow)
+    product = Product(sku="TIDY-SHELF", batches=[shipment_batch])
+    product.allocate(OrderLine("order1", "TIDY-SHELF", 10))
+
+    product.add_batch(Batch("in-stock-batch", "TIDY-SHELF", 100, eta=None))
+    product.add_batch(Batch("late-batch", "TIDY-SHELF", 100, eta=later))
+
+    assert product.allocate(OrderLine("order2", "TIDY-SHELF", 10)) == "in-stock-batch"
+    assert product.allocate(OrderLine("order3", "TIDY-SHELF", 150)) is None
+
+
+def test_allocates_to_batches_appended_directly():
+    product = Product(sku="ODD-VASE", batches=[Batch("b1", "ODD-VASE", 10, eta=today)])
+    product.allocate(OrderLine("order1", "ODD-VASE", 10))
+
+    product.batches.append(Batch("b2", "ODD-VASE", 10, eta=tomorrow))
+
+    assert product.allocate(OrderLine("order2", "ODD-VASE", 10)) == "b2"
+
+
+def test_picks_the_same_batches_before_and_after_indexing():
+    batches = [
+        Batch(f"batch{i}", "LONG-BENCH", 10, eta=today + timedelta(days=i))
+        for i in reversed(range(2 * model.SCANS_BEFORE_INDEXING))
+    ]
+    product = Product(sku="LONG-BENCH", batches=batches)
+
+    refs = [
+        product.allocate(OrderLine(f"order{i}", "LONG-BENCH", 10))
+        for i in range(2 * model.SCANS_BEFORE_INDEXING)
+    ]
+
+    assert refs == [f"batch{i}" for i in range(2 * model.SCANS_BEFORE_INDEXING)]
+
+
+def test_only_indexes_products_that_keep_being_allocated_from():
+    product = Product(sku="BUSY-BENCH", batches=[Batch("b1", "BUSY-BENCH", 100, eta=None)])
+    for i in range(model.SCANS_BEFORE_INDEXING):
+        product.allocate(OrderLine(f"order{i}", "BUSY-BENCH", 1))
+    assert product._index is None  # pylint: disable=protected-access
+
+    product.allocate(OrderLine("one-more", "BUSY-BENCH", 1))
+
+    assert product._index is not None  # pylint: disable=protected-access
+
+
+def test_allocates_to_batch_after_its_quantity_is_raised():
+    batch = Batch("b1", "BIG-RUG", 10, eta=None)
+    product = Product(sku="BIG-RUG", batches=[batch])
+    product.allocate(OrderLine("order1", "BIG-RUG", 10))
+    assert product.allocate(OrderLine("order2", "BIG-RUG", 10)) is None
+
+    product.change_batch_quantity("b1", 20)
+
+    assert product.allocate(OrderLine("order3", "BIG-RUG", 10)) == "b1"
+
+
+def test_reducing_batch_quantity_reallocates_lines_to_other_batches():
+    batch1 = Batch("batch1", "SLEEK-CHAIR", 50, eta=None)
+    batch2 = Batch("batch2", "SLEEK-CHAIR", 50, eta=tomorrow)
+    product = Product(sku="SLEEK-CHAIR", batches=[batch1, batch2])
+    product.allocate(OrderLine("order1", "SLEEK-CHAIR", 20))
+    product.allocate(OrderLine("order2", "SLEEK-CHAIR", 20))
+    product.events.clear()
+
+    product.change_batch_quantity("batch1", 25)
+
+    assert batch1.available_quantity == 5
+    assert batch2.available_quantity == 30
+    [event] = product.events
+    assert isinstance(event, events.Reallocated)
+    assert event.batchref == "batch1"
+    [allocated] = event.allocated
+    assert allocated.batchref == "batch2"
+    assert event.deallocated == []
+
+
+def test_reducing_batch_quantity_frees_as_few_lines_as_possible():
+    batch1 = Batch("batch1", "LONG-BENCH", 100, eta=None)
+    batch2 = Batch("batch2", "LONG-BENCH", 100, eta=tomorrow)
+    product = Product(sku="LONG-BENCH", batches=[batch1, batch2])
+    for i, qty in enumerate([5, 5, 5, 30, 40]):
+        product.allocate(OrderLine(f"order{i}", "LONG-BENCH", qty))
+    product.events.clear()
+
+    product.change_batch_quantity("batch1", 60)
+
+    [event] = product.events
+    assert [e.qty for e in event.allocated] == [30]
+    assert batch1.available_quantity == 5
+
+
+def test_lines_that_cannot_be_reallocated_are_deallocated():
+    batch = Batch("batch1", "LONELY-LAMP", 50, eta=None)
+    product = Product(sku="LONELY-LAMP", batches=[batch])
+    product.allocate(OrderLine("order1", "LONELY-LAMP", 20))
+    product.allocate(OrderLine("order2", "LONELY-LAMP", 20))
+    product.events.clear()
+
+    product.change_batch_quantity("batch1", 30)
+
+    reallocated, out_of_stock = product.events
+    assert reallocated.allocated == []
+    assert len(reallocated.deallocated) == 1
+    assert out_of_stock == events.OutOfStock(sku="LONELY-LAMP")
+    assert batch.available_quantity == 10
@@ -0,0 +1,63 @@
+from allocation.adapters.product_cache import ProductCache
+from allocation.domain.model import Product
+
+
+def make_product(sku, version_number=1):
+    return Product(sku, batches=[], version_number=version_number)
+
+
+def test_take_returns_a_product_at_the_current_version():
+    cache = ProductCache()
+    product = make_product('LAMP', version_number=3)
+    cache.put(product)
+
+    assert cache.take('LAMP', 3) is product
+    assert cache.stats.hits == 1
+
+
+def test_take_removes_the_product_so_no_two_units_of_work_share_it():
+    cache = ProductCache()
+    cache.put(make_product('LAMP'))
+
+    cache.take('LAMP', 1)
+
+    assert cache.take('LAMP', 1) is None
+    assert cache.stats.misses == 1
+
+
+def test_stale_products_are_dropped():
+    cache = ProductCache()
+    cache.put(make_product('LAMP', version_number=3))
+
+    assert cache.take('LAMP', 4) is None
+    assert cache.stats.stale == 1
+    assert len(cache) == 0
+    assert cache.size == 0
+
+
+def test_evicts_least_recently_used_over_budget():
+    cache = ProductCache(max_bytes=20, sizeof=lambda product: 10)
+    cache.put(make_product('LAMP'))
+    cache.put(make_product('CHAIR'))
+    cache.put(make_product('LAMP'))  # put back after use
+    cache.put(make_product('TABLE'))
+
+    assert cache.take('CHAIR', 1) is None
+    assert cache.take('LAMP', 1) is not None
+    assert cache.stats.evictions == 1
+
+
+def test_does_not_keep_products_bigger_than_the_budget():
+    cache = ProductCache(max_bytes=5, sizeof=lambda product: 10)
+    cache.put(make_product('LAMP'))
+
+    assert len(cache) == 0
+
+
+def test_hit_ratio():
+    cache = ProductCache()
+    cache.put(make_product('LAMP'))
+    cache.take('LAMP', 1)
+    cache.take('LAMP', 1)
+
+    assert cache.stats.hit_ratio == 0.5
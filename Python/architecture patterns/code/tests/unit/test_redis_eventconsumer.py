@@ -0,0 +1,184 @@
+# pylint: disable=no-self-use
+import json
+import threading
+from allocation.domain import commands
+from allocation.entrypoints.redis_eventconsumer import StreamConsumer
+from tests.fake_redis import FakeRedis
+
+
+class RecordingBus:
+
+    def __init__(self, fail_for=()):
+        self.handled = []
+        self.threads = {}
+        self.fail_for = fail_for
+
+    def handle(self, cmd):
+        if cmd.ref in self.fail_for:
+            raise Exception('boom')
+        self.handled.append(cmd)
+        self.threads.setdefault(cmd.ref, set()).add(threading.get_ident())
+
+
+SKUS = {'b1': 'LAMP', 'b2': 'LAMP', 'b3': 'CHAIR'}
+
+
+def skus_for_batches(batchrefs):
+    return {ref: SKUS[ref] for ref in batchrefs if ref in SKUS}
+
+
+def make_consumer(bus, redis_client, workers=4, name='test', **kwargs):
+    consumer = StreamConsumer(
+        bus, redis_client, consumer=name, batch_size=10, workers=workers,
+        skus_for_batches=skus_for_batches, **kwargs,
+    )
+    consumer.ensure_group()
+    return consumer
+
+
+def add(redis_client, batchref, qty):
+    redis_client.xadd('change_batch_quantity', dict(
+        data=json.dumps(dict(batchref=batchref, qty=qty))
+    ))
+
+
+class TestStreamConsumer:
+
+    def test_keeps_only_last_quantity_per_batchref(self):
+        redis_client = FakeRedis()
+        bus = RecordingBus()
+        for qty in (10, 5, 7):
+            add(redis_client, 'b1', qty)
+        add(redis_client, 'b3', 3)
+
+        assert make_consumer(bus, redis_client).poll() == 4
+
+        assert sorted(bus.handled, key=lambda c: c.ref) == [
+            commands.ChangeBatchQuantity('b1', 7),
+            commands.ChangeBatchQuantity('b3', 3),
+        ]
+
+    def test_batches_for_the_same_sku_run_on_the_same_worker(self):
+        redis_client = FakeRedis()
+        bus = RecordingBus()
+        for ref in ('b1', 'b2', 'b3'):
+            add(redis_client, ref, 1)
+        consumer = make_consumer(bus, redis_client)
+
+        consumer.poll()
+
+        assert bus.threads['b1'] == bus.threads['b2']
+
+    def test_reads_a_batch_per_round_trip_and_acks_once(self):
+        redis_client = FakeRedis()
+        for i in range(10):
+            add(redis_client, 'b{}'.format(i % 3 + 1), i)
+        consumer = make_consumer(RecordingBus(), redis_client)
+
+        consumer.poll()
+
+        assert redis_client.round_trips == 2
+        assert not redis_client.groups[('change_batch_quantity', 'allocation')]['pending']
+
+    def test_failed_commands_stay_pending(self):
+        redis_client = FakeRedis()
+        add(redis_client, 'b1', 1)
+        add(redis_client, 'b3', 1)
+        consumer = make_consumer(RecordingBus(fail_for={'b1'}), redis_client)
+
+        assert consumer.poll() == 1
+
+        assert redis_client.groups[('change_batch_quantity', 'allocation')]['pending'] == {b'1-0'}
+
+    def test_recover_retries_this_consumers_pending_entries_on_startup(self):
+        redis_client = FakeRedis()
+        add(redis_client, 'b1', 1)
+        add(redis_client, 'b3', 1)
+        make_consumer(RecordingBus(fail_for={'b1'}), redis_client).poll()
+        bus = RecordingBus()
+
+        assert make_consumer(bus, redis_client).recover() == 1
+
+        assert bus.handled == [commands.ChangeBatchQuantity('b1', 1)]
+        assert not redis_client.groups[('change_batch_quantity', 'allocation')]['pending']
+
+    def test_entries_left_idle_are_claimed_by_another_consumer(self):
+        redis_client = FakeRedis()
+        add(redis_client, 'b1', 1)
+        make_consumer(RecordingBus(fail_for={'b1'}), redis_client, name='crashed').poll()
+        bus = RecordingBus()
+        consumer = make_consumer(bus, redis_client, min_idle_ms=1000, claim_interval=0)
+
+        assert consumer.poll() == 0
+        redis_client.now_ms += 1000
+        assert consumer.poll() == 1
+
+        assert bus.handled == [commands.ChangeBatchQuantity('b1', 1)]
+        assert not redis_client.groups[('change_batch_quantity', 'allocation')]['pending']
+
+    def test_looks_up_the_skus_for_a_batch_in_one_call(self):
+        redis_client = FakeRedis()
+        for ref in ('b1', 'b2', 'b3'):
+            add(redis_client, ref, 1)
+        lookups = []
+        consumer = StreamConsumer(
+            RecordingBus(), redis_client, consumer='test', batch_size=10,
+            skus_for_batches=lambda refs: lookups.append(sorted(refs)) or skus_for_batches(refs),
+        )
+        consumer.ensure_group()
+
+        consumer.poll()
+
+        assert lookups == [['b1', 'b2', 'b3']]
+
+    def test_old_entries_redelivered_after_a_newer_one_was_applied_are_only_acked(self):
+        redis_client = FakeRedis()
+        add(redis_client, 'b1', 1)
+        make_consumer(RecordingBus(fail_for={'b1'}), redis_client, name='crashed').poll()
+        add(redis_client, 'b1', 2)
+        bus = RecordingBus()
+        consumer = make_consumer(bus, redis_client, min_idle_ms=1000, claim_interval=0)
+
+        assert consumer.poll() == 1
+        redis_client.now_ms += 1000
+        assert consumer.poll() == 1
+
+        assert bus.handled == [commands.ChangeBatchQuantity('b1', 2)]
+        assert not redis_client.groups[('change_batch_quantity', 'allocation')]['pending']
+
+    def test_undecodable_entries_are_dead_lettered(self):
+        redis_client = FakeRedis()
+        redis_client.xadd('change_batch_quantity', dict(data='not json'))
+        redis_client.xadd('change_batch_quantity', dict(data=json.dumps(dict(batchref='b1'))))
+        add(redis_client, 'b3', 1)
+        bus = RecordingBus()
+
+        assert make_consumer(bus, redis_client).poll() == 3
+
+        assert bus.handled == [commands.ChangeBatchQuantity('b3', 1)]
+        dead = redis_client.streams['change_batch_quantity:dead-letter']
+        assert [fields[b'id'] for _, fields in dead] == [b'1-0', b'2-0']
+        assert not redis_client.groups[('change_batch_quantity', 'allocation')]['pending']
+
+    def test_unknown_batchrefs_are_dead_lettered(self):
+        redis_client = FakeRedis()
+        add(redis_client, 'no-such-batch', 1)
+        bus = RecordingBus()
+
+        assert make_consumer(bus, redis_client).poll() == 1
+
+        assert bus.handled == []
+        [(_, fields)] = redis_client.streams['change_batch_quantity:dead-letter']
+        assert fields[b'reason'] == b'unknown batchref'
+
+    def test_entries_failing_max_deliveries_times_are_dead_lettered(self):
+        redis_client = FakeRedis()
+        add(redis_client, 'b1', 1)
+        consumer = make_consumer(RecordingBus(fail_for={'b1'}), redis_client, max_deliveries=2)
+
+        assert consumer.poll() == 0
+        assert consumer.recover() == 1
+
+        [(_, fields)] = redis_client.streams['change_batch_quantity:dead-letter']
+        assert json.loads(fields[b'data']) == dict(batchref='b1', qty=1)
+        assert not redis_client.groups[('change_batch_quantity', 'allocation')]['pending']
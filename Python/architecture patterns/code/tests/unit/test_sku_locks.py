@@ -0,0 +1,155 @@
+# pylint: disable=no-self-use
+import contextlib
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from allocation.domain import commands, events
+from allocation.service_layer import messagebus
+from allocation.service_layer.sku_locks import SkuLocking, StripedLocks
+
+
+class SlowHandler:
+
+    def __init__(self):
+        self.handled = []
+        self.in_flight = Counter()
+        self.most_in_flight = Counter()
+        self._lock = threading.Lock()
+
+    def __call__(self, cmd):
+        key = getattr(cmd, 'sku', getattr(cmd, 'ref', None))
+        with self._lock:
+            self.in_flight[key] += 1
+            self.most_in_flight[key] = max(self.most_in_flight[key], self.in_flight[key])
+        time.sleep(0.01)
+        with self._lock:
+            self.in_flight[key] -= 1
+            self.handled.append(cmd)
+
+
+class RecordingLocks(StripedLocks):
+
+    def __init__(self):
+        super().__init__()
+        self.held = []
+        self.holding_now = False
+
+    @contextlib.contextmanager
+    def holding(self, skus):
+        self.held.append(set(skus))
+        with super().holding(skus):
+            self.holding_now = True
+            try:
+                yield
+            finally:
+                self.holding_now = False
+
+
+class StubUnitOfWork:
+
+    def __init__(self):
+        self.new_events = []
+
+    def collect_new_events(self):
+        while self.new_events:
+            yield self.new_events.pop(0)
+
+
+def run_concurrently(handler, messages):
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(handler, messages))
+
+
+def no_batches(_):
+    return None
+
+
+class TestSkuLocking:
+
+    def test_commands_for_one_sku_run_one_at_a_time(self):
+        handler = SlowHandler()
+        locked = SkuLocking(no_batches).wrap(commands.Allocate, handler)
+
+        run_concurrently(locked, [commands.Allocate(f'o{i}', 'HOT-LAMP', 1) for i in range(16)])
+
+        assert len(handler.handled) == 16
+        assert handler.most_in_flight['HOT-LAMP'] == 1
+
+    def test_batch_quantity_changes_lock_the_batchs_sku(self):
+        locks = RecordingLocks()
+        locking = SkuLocking({'b1': 'HOT-LAMP'}.get, locks)
+
+        locking.wrap(commands.ChangeBatchQuantity, SlowHandler())(
+            commands.ChangeBatchQuantity('b1', 10)
+        )
+
+        assert locks.held == [{'HOT-LAMP'}]
+
+    def test_allocate_many_locks_every_sku(self):
+        locks = RecordingLocks()
+        locking = SkuLocking(no_batches, locks)
+
+        locking.wrap(commands.AllocateMany, SlowHandler())(commands.AllocateMany([
+            commands.Allocate('o1', 'LAMP', 1), commands.Allocate('o1', 'RUG', 1),
+        ]))
+
+        assert locks.held == [{'LAMP', 'RUG'}]
+
+    def test_commands_needing_too_many_stripes_take_none(self):
+        locks = RecordingLocks()
+        locking = SkuLocking(no_batches, locks, max_stripes=2)
+        handler = SlowHandler()
+
+        locking.wrap(commands.AllocateMany, handler)(commands.AllocateMany([
+            commands.Allocate('o1', f'SKU-{i}', 1) for i in range(20)
+        ]))
+
+        assert locks.held == []
+        assert len(handler.handled) == 1
+
+    def test_events_are_dispatched_after_the_lock_is_released(self):
+        locks = RecordingLocks()
+        uow = StubUnitOfWork()
+        held_while_handling_event = []
+
+        def allocate(cmd):
+            uow.new_events.append(events.Allocated(cmd.orderid, cmd.sku, cmd.qty, 'b1'))
+
+        bus = messagebus.MessageBus(
+            uow=uow,
+            event_handlers={events.Allocated: [
+                lambda _: held_while_handling_event.append(locks.holding_now),
+            ]},
+            command_handlers=SkuLocking(no_batches, locks).wrap_handlers({
+                commands.Allocate: allocate,
+            }),
+        )
+
+        bus.handle(commands.Allocate('o1', 'LAMP', 1))
+
+        assert locks.held == [{'LAMP'}]
+        assert held_while_handling_event == [False]
+
+    def test_commands_without_a_sku_are_not_wrapped(self):
+        handler = SlowHandler()
+        assert SkuLocking(no_batches).wrap(commands.Command, handler) is handler
+
+
+class TestStripedLocks:
+
+    def test_takes_each_stripe_once_in_order(self):
+        locks = StripedLocks(stripes=4)
+        stripes = locks.stripes_for([f'sku-{i}' for i in range(20)])
+        assert stripes == sorted(set(stripes))
+
+    def test_overlapping_sets_of_skus_do_not_deadlock(self):
+        locks = StripedLocks(stripes=8)
+        skus = [f'sku-{i}' for i in range(8)]
+
+        def hold(i):
+            with locks.holding(skus[i:] + skus[:i]):
+                time.sleep(0.001)
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            list(executor.map(hold, list(range(8)) * 10))
@@ -0,0 +1,47 @@
+import os
+import subprocess
+import sys
+from pathlib import Path
+from allocation.adapters.notifications import EmailNotifications
+
+SRC = Path(__file__).parents[2] / 'src'
+# about 1.5x the ~0.34s the import takes here, most of it flask and
+# sqlalchemy, so a heavy new import fails this; slower boxes can set their own
+IMPORT_TIME_BUDGET_MS = int(os.environ.get('IMPORT_TIME_BUDGET_MS', 500))
+DEFERRED_MODULES = {'redis', 'smtplib'}
+
+
+def import_times(module):
+    """Cumulative import time in microseconds of every module importing `module` pulled in."""
+    env = dict(
+        os.environ, PYTHONPATH=str(SRC),
+        # nothing may be contacted at import, so point everything nowhere
+        DB_HOST='db.invalid', REDIS_HOST='redis.invalid', EMAIL_HOST='mail.invalid',
+    )
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        env=env, stderr=subprocess.PIPE, universal_newlines=True, check=True,
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line.split('|')
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+def test_importing_the_flask_app_connects_to_nothing_and_defers_adapters():
+    times = import_times('allocation.entrypoints.flask_app')
+    assert DEFERRED_MODULES.isdisjoint(times)
+
+
+def test_importing_the_flask_app_stays_within_budget():
+    times = import_times('allocation.entrypoints.flask_app')
+    elapsed_ms = times['allocation.entrypoints.flask_app'] / 1000
+    assert elapsed_ms < IMPORT_TIME_BUDGET_MS, f'import took {elapsed_ms:.0f}ms'
+
+
+def test_email_notifications_connect_on_first_send():
+    notifications = EmailNotifications('mail.invalid', 25)
+    assert notifications._server is None  # pylint: disable=protected-access
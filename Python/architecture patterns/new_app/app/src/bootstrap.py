@@ -16,6 +16,7 @@ def bootstrap(start_orm: bool = True,
 
     if start_orm:
         print('vai gerar a base de dados: ', config.get_postgres_uri())
+        config.create_schema(config.get_postgres_engine())
         orm.start_mappers()
 
     dependencies = {'uow': uow, 'send_mail': notifications, 'publish': publish}
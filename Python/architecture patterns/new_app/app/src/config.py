@@ -1,3 +1,4 @@
+import functools
 import os
 
 from sqlalchemy import create_engine
@@ -20,17 +21,19 @@ def get_postgres_uri(local: bool = False):
     return f"postgresql://{user}:{password}@{host}:{port}/{db_name}"
 
 
+@functools.lru_cache(maxsize=None)
 def get_postgres_engine():
-    engine = create_engine(get_postgres_uri(), isolation_level="REPEATABLE READ", )
-    metadata.create_all(engine)  # eh esse comando que gera a base de dados
-    return engine
+    return create_engine(get_postgres_uri(), isolation_level="REPEATABLE READ", )
 
 
+@functools.lru_cache(maxsize=None)
 def get_sqlite_engine():
     print("diretorio sqlite: ", BASE_DIR)
-    engine = create_engine('sqlite:///' + os.path.join(BASE_DIR, 'db.sqlite3'))
-    metadata.create_all(engine)
-    return engine
+    return create_engine('sqlite:///' + os.path.join(BASE_DIR, 'db.sqlite3'))
+
+
+def create_schema(engine):
+    metadata.create_all(engine)  # eh esse comando que gera a base de dados
 
 
 def get_api_url(local: bool = False):
@@ -41,7 +41,21 @@ class AbstractUnitOfWork(abc.ABC):
         raise NotImplementedError
 
 
-DEFAULT_SESSION_FACTORY = sessionmaker(bind=config.get_postgres_engine())
+class LazySessionFactory:
+    """
+    A sessionmaker for config.get_postgres_engine() that only asks for the
+    engine the first time a session is needed, not when this module is imported
+    """
+    def __init__(self):
+        self._sessionmaker = None
+
+    def __call__(self, **kwargs):
+        if self._sessionmaker is None:
+            self._sessionmaker = sessionmaker(bind=config.get_postgres_engine())
+        return self._sessionmaker(**kwargs)
+
+
+DEFAULT_SESSION_FACTORY = LazySessionFactory()
 
 
 class ProductSqlAlchemyUnitOfWork(AbstractUnitOfWork):
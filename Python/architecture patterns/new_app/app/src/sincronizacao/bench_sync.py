@@ -0,0 +1,132 @@
+"""
+Hashes a generated tree of small files (100k by default) serially, in a
+process pool, and again with the hash cache cold and warm, then measures
+the peak memory of working out the actions to sync that tree somewhere
+empty, hashing versus streaming, and how long an incremental sync of
+it takes once there's a manifest, with and without a journal of the few
+files that changed. Then compares hashing every file against
+size-first pruning on a tree of larger files, half of them already in the
+destination, and copying that tree one file at a time with shutil against
+the CopyEngine:
+
+    python bench_sync.py [number of files] [number of large files]
+"""
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+from sync import (
+    CopyEngine, CopyStats, determine_actions, read_paths_and_fingerprints,
+    read_paths_and_hashes, stream_actions, sync_incremental,
+)
+
+FILES_PER_FOLDER = 100
+FILE_SIZE = 1024
+LARGE_FILE_SIZES = (128 * 1024, 512 * 1024)
+
+
+def make_tree(root, files):
+    old = 10**18  # old enough for every hash to be cached
+    for i in range(files):
+        folder = root / f'folder{i // FILES_PER_FOLDER}'
+        if i % FILES_PER_FOLDER == 0:
+            folder.mkdir()
+        path = folder / f'file{i}'
+        path.write_bytes(os.urandom(FILE_SIZE))
+        os.utime(path, ns=(old, old))
+
+
+def make_half_synced_trees(source, dest, files):
+    rng = random.Random(0)
+    for i in range(files):
+        content = os.urandom(rng.randint(*LARGE_FILE_SIZES))
+        (source / f'file{i}').write_bytes(content)
+        if i % 2:
+            (dest / f'file{i}').write_bytes(content)
+
+
+def timed(label, files, reader=read_paths_and_hashes, **kwargs):
+    started = time.perf_counter()
+    reader(*kwargs.pop('roots'), **kwargs)
+    elapsed = time.perf_counter() - started
+    print(f'{label:<16}{elapsed:>8.2f}s{files / elapsed:>12.0f} files/s')
+
+
+def read_both(source, dest, **kwargs):
+    return read_paths_and_hashes(source, **kwargs), read_paths_and_hashes(dest, **kwargs)
+
+
+def peak_memory(label, actions):
+    tracemalloc.start()
+    count = sum(1 for _ in actions())
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f'{label:<16}{peak / 2**20:>8.1f} MiB peak for {count} actions')
+
+
+def main():
+    files = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    large_files = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    root = Path(tempfile.mkdtemp())
+    os.environ['SYNC_INDEX_DIR'] = tempfile.mkdtemp()
+    try:
+        make_tree(root, files)
+        print(f'{files} files of {FILE_SIZE} bytes')
+        timed('serial', files, roots=[root], use_cache=False, workers=1)
+        timed('process pool', files, roots=[root], use_cache=False)
+        timed('cache, cold', files, roots=[root])
+        timed('cache, warm', files, roots=[root])
+        empty = Path(tempfile.mkdtemp())
+        peak_memory('hashed', lambda: determine_actions(
+            *read_paths_and_fingerprints(root, empty, use_cache=False), root, empty,
+        ))
+        peak_memory('streaming', lambda: stream_actions(root, empty))
+        timed('first sync', files, sync_incremental, roots=[root, empty])
+        timed('no changes', files, sync_incremental, roots=[root, empty])
+        changed = {
+            f'folder{i // FILES_PER_FOLDER}/file{i}' for i in range(0, files, max(1, files // 10))
+        }
+        for relpath in changed:
+            (root / relpath).write_bytes(os.urandom(FILE_SIZE + 1))
+        timed('10 changes', files, sync_incremental, roots=[root, empty])
+        for relpath in changed:
+            (root / relpath).write_bytes(os.urandom(FILE_SIZE + 2))
+        timed('10, journaled', files, sync_incremental, roots=[root, empty], changed=changed)
+        shutil.rmtree(empty)
+        shutil.rmtree(root)
+
+        source, dest = root / 'source', root / 'dest'
+        source.mkdir(parents=True)
+        dest.mkdir()
+        make_half_synced_trees(source, dest, large_files)
+        print(f'{large_files} files of {LARGE_FILE_SIZES[0]}-{LARGE_FILE_SIZES[1]} bytes,'
+              ' half of them synced')
+        total = large_files * 3 // 2
+        timed('hash everything', total, read_both, roots=[source, dest], use_cache=False)
+        timed('size first', total, read_paths_and_fingerprints,
+              roots=[source, dest], use_cache=False)
+
+        copies = [('copy', path, root / 'shutil' / path.name) for path in source.iterdir()]
+        (root / 'shutil').mkdir()
+        started = time.perf_counter()
+        for _, src, dst in copies:
+            shutil.copyfile(src, dst)
+        stats = CopyStats(
+            len(copies), sum(src.stat().st_size for _, src, _ in copies),
+            time.perf_counter() - started,
+        )
+        print(f'{"shutil":<16}{stats}')
+        copies = [(action, src, root / 'engine' / src.name) for action, src, _ in copies]
+        print(f'{"copy engine":<16}{CopyEngine().apply(copies)}')
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+        shutil.rmtree(os.environ['SYNC_INDEX_DIR'], ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
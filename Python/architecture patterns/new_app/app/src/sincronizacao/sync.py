@@ -1,9 +1,30 @@
+import contextlib
+import errno
 import hashlib
+import logging
+import mmap
 import os
 import shutil
+import sqlite3
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass
 from pathlib import Path
 
+logger = logging.getLogger(__name__)
+
 BLOCKSIZE = 65536
+# below this, starting a process pool costs more than the hashing
+PARALLEL_THRESHOLD = 64
+# a file modified this recently could change again without its mtime
+# changing, so its hash isn't cached
+RACY_WINDOW_NS = 2 * 10**9
+# stands in for the mtime of such a file in the manifest, so it compares as
+# changed, and is looked at again, until a run sees it settled
+RACY_MTIME_NS = -1
+# errors meaning "this filesystem can't do that", not "the copy failed"
+UNSUPPORTED = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP}
 
 class FakeFileSystem(list):
     def copy(self, src, dest):
@@ -15,30 +36,581 @@ class FakeFileSystem(list):
     def delete(self, dest):
         self.append(('DELETE', dest))
 
-def sync1( source, dest):
+class FileSystem:
+    """The real thing FakeFileSystem stands in for."""
+
+    def copy(self, src, dest):
+        Path(dest).parent.mkdir(parents=True, exist_ok=True)
+        copy_file(src, dest)
+
+    def move(self, src, dest):
+        Path(dest).parent.mkdir(parents=True, exist_ok=True)
+        shutil.move(str(src), str(dest))
+
+    def delete(self, dest):
+        os.remove(dest)
+
+def sync1(source, dest, use_cache=True, workers=None):
     #imperative shell step1, gather inputs
-    source_hashes = read_paths_and_hashes(source)
-    dest_hashes = read_paths_and_hashes(dest)
+    source_hashes, dest_hashes = read_paths_and_fingerprints(source, dest, use_cache, workers)
 
     #step 2: call functional core
     actions = determine_actions(source_hashes, dest_hashes, source, dest)
 
     #imperative shell step 3, apply outputs
-    for action, *paths in actions:
-        if action == 'copy':
-            shutil.copyfile(*paths)
-        if action == 'move':
-            shutil.move(*paths)
-        if action == 'delete':
-            os.remove(paths[0])
-
-def read_paths_and_hashes(root):
-    hashes = {}
-    for folder, _, files in os.walk(root):
-        for fn in files:
-            hashes[hash_file(Path(folder) / fn)] = fn
+    return CopyEngine().apply(actions)
+
+def sync_streaming(source, dest, filesystem=None, use_cache=True):
+    """
+    Applies stream_actions one at a time as they come, to a FileSystem or
+    anything else with copy/move/delete, eg a FakeFileSystem.
+    """
+    if filesystem is None:
+        filesystem = FileSystem()
+    for action, *paths in stream_actions(source, dest, use_cache):
+        getattr(filesystem, action)(*paths)
+
+def stream_actions(source, dest, use_cache=True):
+    """
+    Walks both trees in sorted path order and merges them like a
+    merge-join: a path only in source is copied, a path only in dest is
+    deleted, and a path in both is copied over if the contents differ.
+    Only the directories being walked are held in memory, never a list of
+    every file, at the price of not noticing renames: a renamed file is
+    copied to its new path and deleted from the old one.
+
+    With use_cache, two files of the same size whose hashes are both in
+    their root's HashCache are compared by those without being read, and
+    files found to be the same are added to the caches for next time.
+    """
+    source, dest = Path(source), Path(dest)
+    with contextlib.ExitStack() as stack:
+        indexes = [
+            stack.enter_context(contextlib.closing(StreamingIndex(HashCache(root))))
+            for root in (source, dest)
+        ] if use_cache else None
+        src_files, dst_files = walk_sorted(source), walk_sorted(dest)
+        src, dst = next(src_files, None), next(dst_files, None)
+        while src or dst:
+            if dst is None or (src and src[0] < dst[0]):
+                yield 'copy', source.joinpath(*src[0]), dest.joinpath(*src[0])
+                src = next(src_files, None)
+            elif src is None or dst[0] < src[0]:
+                yield 'delete', dest.joinpath(*dst[0])
+                dst = next(dst_files, None)
+            else:
+                if not same_content(src, dst, indexes):
+                    yield 'copy', source.joinpath(*src[0]), dest.joinpath(*src[0])
+                src, dst = next(src_files, None), next(dst_files, None)
+
+def walk_sorted(root, parts=()):
+    #(path components, path, stat) in the same order as sorting the
+    #component tuples, which is what lets stream_actions merge two walks
+    with os.scandir(root) as entries:
+        entries = sorted(entries, key=lambda entry: entry.name)
+    for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+            yield from walk_sorted(entry.path, parts + (entry.name,))
+        elif entry.is_file():
+            yield parts + (entry.name,), entry.path, entry.stat()
+
+def same_content(src, dst, indexes=None):
+    #settled by the cached hashes if both sides have one, otherwise reads
+    #both a block at a time and stops at the first difference
+    (src_parts, src_path, src_stat), (dst_parts, dst_path, dst_stat) = src, dst
+    if src_stat.st_size != dst_stat.st_size:
+        return False
+    files = [
+        ('/'.join(src_parts), (src_stat.st_size, src_stat.st_mtime_ns, src_stat.st_ino)),
+        ('/'.join(dst_parts), (dst_stat.st_size, dst_stat.st_mtime_ns, dst_stat.st_ino)),
+    ]
+    if indexes:
+        cached = [index.sha(relpath, key) for index, (relpath, key) in zip(indexes, files)]
+        if all(cached):
+            return cached[0] == cached[1]
+    sha = hashlib.sha1()
+    with open(src_path, 'rb') as fsrc, open(dst_path, 'rb') as fdst:
+        while True:
+            src_block, dst_block = fsrc.read(BLOCKSIZE), fdst.read(BLOCKSIZE)
+            if src_block != dst_block:
+                return False
+            if not src_block:
+                break
+            sha.update(src_block)
+    if indexes:
+        for index, (relpath, key) in zip(indexes, files):
+            index.learn(relpath, key, sha.hexdigest())
+    return True
+
+def read_paths_and_hashes(root, use_cache=True, workers=None):
+    """
+    {sha1: relative path} for every file under root. With use_cache only
+    files that are new or changed since the last run get hashed, spread
+    over `workers` processes.
+    """
+    root = Path(root)
+    cache = HashCache(root) if use_cache else None
+    known = cache.load() if cache else {}
+    started_ns = time.time_ns()
+
+    hashes, fresh, stats = {}, {}, {}
+    for relpath, path, stat in walk_files(root):
+        key = (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+        cached = known.get(relpath)
+        if cached and cached[:3] == key:
+            hashes[cached[3]] = relpath
+        else:
+            fresh[relpath] = path
+        stats[relpath] = key
+
+    fresh_hashes = dict(zip(fresh, hash_files(list(fresh.values()), workers)))
+    for relpath, sha in fresh_hashes.items():
+        hashes[sha] = relpath
+
+    if cache:
+        save_hashes(cache, known, stats, fresh_hashes, started_ns)
     return hashes
 
+def read_paths_and_fingerprints(source, dest, use_cache=True, workers=None):
+    """
+    read_paths_and_hashes for both roots at once, reading only what it has
+    to. A file with no file of the same size on the other side can't be
+    copied or moved from/to anything there, so it isn't read at all; the
+    rest get a partial hash of their first and last blocks first, and only
+    files whose partial hash still matches something on the other side are
+    hashed in full. Files that never get a full hash are keyed by a
+    fingerprint only they have, which matches nothing.
+    """
+    roots = [Path(source), Path(dest)]
+    caches = [HashCache(root) if use_cache else None for root in roots]
+    known = [cache.load() if cache else {} for cache in caches]
+    started_ns = time.time_ns()
+
+    scans = [{relpath: (path, stat) for relpath, path, stat in walk_files(root)} for root in roots]
+    sizes = [{stat.st_size for _, stat in scan.values()} for scan in scans]
+    fingerprints = [{}, {}]
+    stats = [{}, {}]
+    uncached = [[], []]
+    unchanged = [[], []]
+    #sizes on each side that will be compared by full hash
+    resolved_sizes = [set(), set()]
+    for side, scan in enumerate(scans):
+        for relpath, (path, stat) in scan.items():
+            key = (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+            stats[side][relpath] = key
+            cached = known[side].get(relpath)
+            counterpart = scans[1 - side].get(relpath)
+            if stat.st_size not in sizes[1 - side]:
+                fingerprints[side][('size', side, relpath)] = relpath
+            elif cached and cached[:3] == key:
+                fingerprints[side][cached[3]] = relpath
+                resolved_sizes[side].add(stat.st_size)
+            elif counterpart and counterpart[1].st_size == stat.st_size:
+                #most likely the same file, which a partial hash can't prove
+                unchanged[side].append((relpath, path))
+                resolved_sizes[side].add(stat.st_size)
+            else:
+                uncached[side].append((relpath, path, stat.st_size))
+
+    partials = [
+        dict(zip(
+            (relpath for relpath, _, _ in candidates),
+            map_files(partial_hash, [(path, size) for _, path, size in candidates], workers),
+        ))
+        for candidates in uncached
+    ]
+    partial_keys = [
+        {(size, partials[side][relpath]) for relpath, _, size in uncached[side]}
+        for side in (0, 1)
+    ]
+
+    hashed = [{}, {}]
+    for side, candidates in enumerate(uncached):
+        other = 1 - side
+        needs_full_hash = unchanged[side]
+        for relpath, path, size in candidates:
+            partial, complete = partials[side][relpath]
+            if complete:
+                # small enough that the partial hash read the whole file
+                hashed[side][relpath] = partial
+            elif (size, (partial, complete)) in partial_keys[other] or size in resolved_sizes[other]:
+                needs_full_hash.append((relpath, path))
+            else:
+                fingerprints[side][('partial', side, relpath)] = relpath
+        hashed[side].update(zip(
+            (relpath for relpath, _ in needs_full_hash),
+            hash_files([path for _, path in needs_full_hash], workers),
+        ))
+        for relpath, sha in hashed[side].items():
+            fingerprints[side][sha] = relpath
+
+    for side, cache in enumerate(caches):
+        if cache:
+            save_hashes(cache, known[side], stats[side], hashed[side], started_ns)
+    return fingerprints[0], fingerprints[1]
+
+def save_hashes(cache, known, stats, hashed, started_ns):
+    cache.save(
+        {
+            relpath: stats[relpath] + (sha,)
+            for relpath, sha in hashed.items()
+            if stats[relpath][1] < started_ns - RACY_WINDOW_NS
+        },
+        removed=known.keys() - stats.keys(),
+    )
+
+def walk_files(root, prefix=''):
+    #(relative path, path, stat) for every file; plain strings and scandir
+    #because building Path objects costs more than the stat calls here
+    with os.scandir(root) as entries:
+        for entry in entries:
+            relpath = prefix + entry.name
+            if entry.is_dir(follow_symlinks=False):
+                yield from walk_files(entry.path, relpath + '/')
+            elif entry.is_file():
+                yield relpath, entry.path, entry.stat()
+
+def hash_files(paths, workers=None):
+    return map_files(hash_file, [(path,) for path in paths], workers)
+
+def map_files(function, args, workers=None):
+    if len(args) < PARALLEL_THRESHOLD or workers == 1:
+        return [function(*arg) for arg in args]
+    workers = workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(workers) as pool:
+        chunksize = max(1, len(args) // (workers * 4))
+        return list(pool.map(function, *zip(*args), chunksize=chunksize))
+
+
+def index_path(root, index_dir=None):
+    """
+    Where the index for root is kept: outside it, so a sync never writes
+    to its source, in index_dir, $SYNC_INDEX_DIR or the user's cache
+    folder, named after root's absolute path.
+    """
+    if index_dir is None:
+        index_dir = os.environ.get('SYNC_INDEX_DIR') or Path(
+            os.environ.get('XDG_CACHE_HOME') or Path.home() / '.cache'
+        ) / 'sincronizacao'
+    name = hashlib.sha1(os.fsencode(Path(root).resolve())).hexdigest()
+    return Path(index_dir) / f'{name}.sqlite'
+
+def connect_index(path, table):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    connection = sqlite3.connect(str(path))
+    connection.execute(
+        f'CREATE TABLE IF NOT EXISTS {table} (path TEXT PRIMARY KEY,'
+        ' size INTEGER, mtime_ns INTEGER, inode INTEGER, sha1 TEXT)'
+    )
+    return connection
+
+class HashCache:
+    """
+    Hashes from earlier runs, kept in a SQLite file at index_path(root) and
+    keyed by (path, size, mtime_ns, inode): if none of those changed, the
+    content didn't either and the file needn't be read again. An index
+    that can't be read or written is only a cache: the sync goes on
+    without it.
+    """
+
+    def __init__(self, root, index_dir=None):
+        self.path = index_path(root, index_dir)
+
+    def _connect(self):
+        return connect_index(self.path, 'hashes')
+
+    def load(self):
+        if not self.path.exists():
+            return {}
+        try:
+            connection = self._connect()
+            try:
+                return {
+                    path: (size, mtime_ns, inode, sha)
+                    for path, size, mtime_ns, inode, sha in connection.execute(
+                        'SELECT path, size, mtime_ns, inode, sha1 FROM hashes'
+                    )
+                }
+            finally:
+                connection.close()
+        except (sqlite3.Error, OSError) as e:
+            logger.warning('Could not read hash index %s, hashing everything: %s', self.path, e)
+            return {}
+
+    def save(self, entries, removed=()):
+        if not entries and not removed:
+            return
+        try:
+            connection = self._connect()
+            try:
+                with connection:
+                    connection.executemany(
+                        'DELETE FROM hashes WHERE path = ?', [(path,) for path in removed],
+                    )
+                    connection.executemany(
+                        'INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?)',
+                        [(path,) + entry for path, entry in entries.items()],
+                    )
+            finally:
+                connection.close()
+        except (sqlite3.Error, OSError) as e:
+            logger.warning('Could not write hash index %s: %s', self.path, e)
+
+class StreamingIndex:
+    """
+    A HashCache read and written a file at a time, for stream_actions,
+    which keeps nothing in memory about the files it has walked past. New
+    hashes are saved every `batch` files and on close.
+    """
+
+    def __init__(self, cache, batch=1000):
+        self.cache = cache
+        self.batch = batch
+        self.learned = {}
+        self.started_ns = time.time_ns()
+        self.connection = None
+        if cache.path.exists():
+            try:
+                self.connection = connect_index(cache.path, 'hashes')
+            except (sqlite3.Error, OSError) as e:
+                logger.warning('Could not read hash index %s: %s', cache.path, e)
+
+    def sha(self, relpath, key):
+        if self.connection is None:
+            return None
+        try:
+            #fetchall so the read lock is let go before the next save
+            rows = self.connection.execute(
+                'SELECT size, mtime_ns, inode, sha1 FROM hashes WHERE path = ?', (relpath,)
+            ).fetchall()
+        except sqlite3.Error:
+            return None
+        return rows[0][3] if rows and tuple(rows[0][:3]) == key else None
+
+    def learn(self, relpath, key, sha):
+        if key[1] < self.started_ns - RACY_WINDOW_NS:
+            self.learned[relpath] = key + (sha,)
+            if len(self.learned) >= self.batch:
+                self.flush()
+
+    def flush(self):
+        self.cache.save(self.learned)
+        self.learned = {}
+
+    def close(self):
+        self.flush()
+        if self.connection is not None:
+            self.connection.close()
+
+class Manifest:
+    """
+    What the source looked like after the last successful sync, path ->
+    (size, mtime_ns, inode, sha1), kept in the hash cache's file. The sha1
+    is only there when something already had to hash the file. One that
+    can't be written means every run is a full sync.
+    """
+
+    def __init__(self, root, index_dir=None):
+        self.path = index_path(root, index_dir)
+
+    def _connect(self):
+        return connect_index(self.path, 'manifest')
+
+    def exists(self):
+        if not self.path.exists():
+            return False
+        try:
+            connection = self._connect()
+            try:
+                return connection.execute('SELECT 1 FROM manifest LIMIT 1').fetchone() is not None
+            finally:
+                connection.close()
+        except (sqlite3.Error, OSError) as e:
+            logger.warning('Could not read manifest %s, syncing everything: %s', self.path, e)
+            return False
+
+    def load(self, paths=None):
+        """Every entry, or with `paths` only those at or under them."""
+        query = 'SELECT path, size, mtime_ns, inode, sha1 FROM manifest'
+        connection = self._connect()
+        try:
+            if paths is None:
+                rows = list(connection.execute(query))
+            else:
+                rows = []
+                for path in paths:
+                    path = path.strip('/')
+                    rows += connection.execute(query + ' WHERE path = ?', (path,))
+                    # '0' sorts right after '/', so this is everything under path/
+                    low, high = (path + '/', path + '0') if path else ('', '\U0010ffff')
+                    rows += connection.execute(query + ' WHERE path > ? AND path < ?', (low, high))
+        finally:
+            connection.close()
+        return {path: tuple(entry) for path, *entry in rows}
+
+    def racy(self):
+        """The paths stored as RACY_MTIME_NS, which every run has to look at."""
+        connection = self._connect()
+        try:
+            rows = connection.execute(
+                'SELECT path FROM manifest WHERE mtime_ns = ?', (RACY_MTIME_NS,),
+            )
+            return {path for path, in rows}
+        finally:
+            connection.close()
+
+    def update(self, entries, removed=(), replace=False):
+        try:
+            connection = self._connect()
+            try:
+                with connection:
+                    if replace:
+                        connection.execute('DELETE FROM manifest')
+                    connection.executemany(
+                        'DELETE FROM manifest WHERE path = ?', [(path,) for path in removed],
+                    )
+                    connection.executemany(
+                        'INSERT OR REPLACE INTO manifest VALUES (?, ?, ?, ?, ?)',
+                        [(path,) + tuple(entry) for path, entry in entries.items()],
+                    )
+            finally:
+                connection.close()
+        except (sqlite3.Error, OSError) as e:
+            logger.warning('Could not write manifest %s: %s', self.path, e)
+
+def sync_incremental(source, dest, changed=None, workers=None):
+    """
+    Syncs only what changed in source since the last run, going by the
+    manifest that run left behind. With `changed`, the paths (files or
+    folders, relative to source) something like watcher.Watcher saw
+    change, not even the rest of source is looked at; without it every
+    file is stat'ed but only changed ones are read. A path that is gone
+    while a new one has its inode, size and mtime, or its content, is a
+    rename and is moved in dest instead of copied. Assumes nothing else
+    writes to dest; the first run, with no manifest yet, is a full sync.
+    Replaying a run that failed part way is safe: a rename whose old path
+    is already gone from dest is copied instead, and a delete of a path
+    that is already gone is skipped.
+    """
+    source, dest = Path(source), Path(dest)
+    started_ns = time.time_ns()
+    manifest = Manifest(source)
+    if not manifest.exists():
+        stats = sync1(source, dest, workers=workers)
+        known = HashCache(source).load()
+        entries = {}
+        for relpath, _, stat in walk_files(source):
+            key = (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+            cached = known.get(relpath)
+            entries[relpath] = key + (cached[3] if cached and cached[:3] == key else None,)
+        manifest.update(settled(entries, started_ns), replace=True)
+        return stats
+
+    if changed is not None:
+        changed = set(changed) | manifest.racy()
+    previous = manifest.load(changed)
+    current, candidates = stat_candidates(source, previous, changed)
+    added, edited, removed = {}, {}, {}
+    for relpath in candidates:
+        key, old = current.get(relpath), previous.get(relpath)
+        if key is None:
+            if old is not None:
+                removed[relpath] = old
+        elif old is None:
+            added[relpath] = key
+        elif old[:3] != key:
+            edited[relpath] = key
+
+    renamed = find_renames(source, added, removed, workers)
+    #an earlier run that failed before updating the manifest may have moved
+    #or deleted these already
+    moved = {new for new, (old, _) in renamed.items() if (dest / old).exists()}
+    actions = [('move', dest / renamed[new][0], dest / new) for new in sorted(moved)]
+    actions += [
+        ('delete', dest / old)
+        for old in sorted(removed.keys() - {old for old, _ in renamed.values()})
+        if (dest / old).exists()
+    ]
+    actions += [
+        ('copy', source / relpath, dest / relpath)
+        for relpath in sorted(added.keys() - moved | edited.keys())
+    ]
+    stats = CopyEngine().apply(actions)
+
+    entries = {relpath: key + (None,) for relpath, key in {**added, **edited}.items()}
+    entries.update({new: added[new] + (sha,) for new, (_, sha) in renamed.items()})
+    manifest.update(settled(entries, started_ns), removed)
+    return stats
+
+def settled(entries, started_ns):
+    """
+    entries, with the mtime of those modified within RACY_WINDOW_NS of
+    started_ns replaced by RACY_MTIME_NS, and their hash dropped: either
+    could still change without the mtime doing so.
+    """
+    return {
+        relpath: entry if entry[1] < started_ns - RACY_WINDOW_NS
+        else (entry[0], RACY_MTIME_NS, entry[2], None)
+        for relpath, entry in entries.items()
+    }
+
+def stat_candidates(source, previous, changed=None):
+    """
+    Current (size, mtime_ns, inode) of the paths that may have changed,
+    and those paths: everything when `changed` is None, otherwise just
+    those paths, with folders standing for everything in or once in them.
+    """
+    if changed is None:
+        current = {
+            relpath: (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+            for relpath, _, stat in walk_files(source)
+        }
+        return current, current.keys() | previous.keys()
+
+    current, candidates = {}, set()
+    for relpath in changed:
+        relpath = relpath.strip('/')
+        path = source / relpath
+        if path.is_dir():
+            for child, _, stat in walk_files(path, relpath + '/' if relpath else ''):
+                current[child] = (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+        elif path.is_file():
+            stat = path.stat()
+            current[relpath] = (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+        candidates.add(relpath)
+        prefix = relpath + '/' if relpath else ''
+        candidates.update(old for old in previous if old.startswith(prefix))
+    candidates.update(current)
+    return current, candidates
+
+def find_renames(source, added, removed, workers=None):
+    """
+    {new path: (old path, sha1)} for the added paths that are removed ones
+    under a new name: same inode, size and mtime, or failing that the same
+    content, hashing only added files that have a removed one of their size
+    with a known hash.
+    """
+    renamed = {}
+    by_inode = {old[:3]: relpath for relpath, old in removed.items()}
+    for relpath, key in added.items():
+        old = by_inode.pop(key, None)
+        if old is not None:
+            renamed[relpath] = (old, removed[old][3])
+
+    taken = {old for old, _ in renamed.values()}
+    by_sha = {
+        (old[0], old[3]): relpath
+        for relpath, old in removed.items()
+        if old[3] is not None and relpath not in taken
+    }
+    sizes = {size for size, _ in by_sha}
+    unmatched = [relpath for relpath in added if relpath not in renamed and added[relpath][0] in sizes]
+    for relpath, sha in zip(unmatched, hash_files([source / relpath for relpath in unmatched], workers)):
+        old = by_sha.pop((added[relpath][0], sha), None)
+        if old is not None:
+            renamed[relpath] = (old, sha)
+    return renamed
+
 def sync2(reader, filesystem, source_root, dest_root):
     #imperative shell step1, gather inputs
     src_hashes = reader(source_root)
@@ -71,47 +643,196 @@ def determine_actions(src_hashes, dst_hashes, src_folder, dst_folder):
             newdestpath = Path(dst_folder) / filename
             yield 'move', olddestpath, newdestpath
 
+    src_filenames = set(src_hashes.values())
     for sha, filename in dst_hashes.items():
-        if sha not in src_hashes:
+        #a file whose content changed has just been copied over, keep it
+        if sha not in src_hashes and filename not in src_filenames:
             yield 'delete', dst_folder / filename
 
 
-def sync(source, dest):
-    #walk the source folder and build a dict of filenames and their hashes
-    source_hashes = {}
-    for folder, _, files in os.walk(source):
-        for fn in files:
-            source_hashes[hash_file(Path(folder) / fn)] = fn
-
-    seen = set() #keep track of the files we've found n the target
+def sync(source, dest, use_cache=True, workers=None):
+    #walk both folders and build dicts of filenames and their hashes, only
+    #reading the files that could be copies or moves of each other
+    source_hashes, dest_hashes = read_paths_and_fingerprints(
+        source, dest, use_cache, workers,
+    )
 
-    #walk the target folder and get the filenames and hashes
-    for folder, _, files in os.walk(dest):
-        for fn in files:
-            dest_path = Path(folder) / fn
-            dest_hash = hash_file(dest_path)
-            seen.add(dest_hash)
+    for dest_hash, fn in dest_hashes.items():
+        dest_path = Path(dest) / fn
 
-            #if there's a file in target that's not in source, delete it
-            if dest_hash not in source_hashes:
-                dest_path.remove()
+        #if there's a file in target that's not in source, delete it
+        if dest_hash not in source_hashes:
+            dest_path.unlink()
 
-            #if there's a file in target that has a different path in source,
-            #move it to the correct path
-            elif dest_hash in source_hashes and fn != source_hashes[dest_hash]:
-                shutil.move(dest_path, Path(folder) / source_hashes[dest_hash])
+        #if there's a file in target that has a different path in source,
+        #move it to the correct path
+        elif fn != source_hashes[dest_hash]:
+            new_path = Path(dest) / source_hashes[dest_hash]
+            new_path.parent.mkdir(parents=True, exist_ok=True)
+            shutil.move(str(dest_path), str(new_path))
 
     # for every file that appears in source but not target, copy the file to
     # the target
     for src_hash, fn in source_hashes.items():
-        if src_hash not in seen:
-            shutil.copy(Path(source) / fn, Path(dest) / fn)
+        if src_hash not in dest_hashes:
+            dest_path = Path(dest) / fn
+            dest_path.parent.mkdir(parents=True, exist_ok=True)
+            shutil.copy(Path(source) / fn, dest_path)
 
 def hash_file(path):
     hasher = hashlib.sha1()
-    with path.open('rb') as file:
+    with open(path, 'rb') as file:
         buf = file.read(BLOCKSIZE)
         while buf:
             hasher.update(buf)
             buf = file.read(BLOCKSIZE)
     return hasher.hexdigest()
+
+def partial_hash(path, size):
+    """
+    sha1 of the first and last BLOCKSIZE bytes, and whether that was the
+    whole file (in which case it's the same as hash_file's).
+    """
+    hasher = hashlib.sha1()
+    with open(path, 'rb') as file:
+        if size <= 2 * BLOCKSIZE:
+            hasher.update(file.read())
+            return hasher.hexdigest(), True
+        hasher.update(file.read(BLOCKSIZE))
+        file.seek(size - BLOCKSIZE)
+        hasher.update(file.read(BLOCKSIZE))
+    return hasher.hexdigest(), False
+
+
+def copy_file(src, dst):
+    """
+    Copies src to dst inside the kernel: copy_file_range, which lets the
+    filesystem share or server-side copy the blocks, then sendfile, then an
+    mmap of src written out in one go. Returns the number of bytes copied.
+    """
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        size = os.fstat(fsrc.fileno()).st_size
+        if size == 0:
+            return 0
+        for copy in (_copy_file_range, _sendfile):
+            try:
+                return copy(fsrc.fileno(), fdst.fileno(), size)
+            except OSError as e:
+                if e.errno not in UNSUPPORTED:
+                    raise
+                fdst.seek(0)
+                fdst.truncate()
+        with mmap.mmap(fsrc.fileno(), size, access=mmap.ACCESS_READ) as mapped:
+            return fdst.write(mapped)
+
+def _copy_file_range(src_fd, dst_fd, size):
+    if not hasattr(os, 'copy_file_range'):
+        raise OSError(errno.ENOSYS, 'copy_file_range is not available')
+    copied = 0
+    while copied < size:
+        sent = os.copy_file_range(src_fd, dst_fd, size - copied)
+        if sent == 0:
+            break
+        copied += sent
+    return copied
+
+def _sendfile(src_fd, dst_fd, size):
+    if not hasattr(os, 'sendfile'):
+        raise OSError(errno.ENOSYS, 'sendfile is not available')
+    copied = 0
+    while copied < size:
+        sent = os.sendfile(dst_fd, src_fd, copied, size - copied)
+        if sent == 0:
+            break
+        copied += sent
+    return copied
+
+
+class ByteBudget:
+    """
+    Caps the bytes being copied at once. A file bigger than the whole
+    budget still goes through, just on its own.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.in_flight = 0
+        self._changed = threading.Condition()
+
+    def acquire(self, size):
+        with self._changed:
+            self._changed.wait_for(
+                lambda: self.in_flight == 0 or self.in_flight + size <= self.max_bytes
+            )
+            self.in_flight += size
+
+    def release(self, size):
+        with self._changed:
+            self.in_flight -= size
+            self._changed.notify_all()
+
+
+@dataclass
+class CopyStats:
+    files: int = 0
+    bytes: int = 0
+    seconds: float = 0.0
+
+    @property
+    def mb_per_second(self):
+        return self.bytes / 10**6 / self.seconds if self.seconds else 0.0
+
+    @property
+    def files_per_second(self):
+        return self.files / self.seconds if self.seconds else 0.0
+
+    def __str__(self):
+        return (
+            f'{self.files} files, {self.bytes / 10**6:.1f} MB in {self.seconds:.2f}s'
+            f' ({self.mb_per_second:.1f} MB/s, {self.files_per_second:.0f} files/s)'
+        )
+
+
+class CopyEngine:
+    """
+    Applies determine_actions' output. Moves go first, so a file is never
+    copied into a path a move is about to take away (or moved after being
+    overwritten), then deletes, to free the space, then copies, `workers`
+    at a time with at most max_bytes_in_flight being copied at once.
+    """
+
+    def __init__(self, workers=4, max_bytes_in_flight=256 * 2**20):
+        self.workers = workers
+        self.budget = ByteBudget(max_bytes_in_flight)
+
+    def apply(self, actions):
+        started = time.perf_counter()
+        stats = CopyStats()
+        actions = list(actions)
+        for action, *paths in actions:
+            if action == 'move':
+                Path(paths[1]).parent.mkdir(parents=True, exist_ok=True)
+                shutil.move(str(paths[0]), str(paths[1]))
+        for action, *paths in actions:
+            if action == 'delete':
+                os.remove(paths[0])
+
+        with ThreadPoolExecutor(self.workers, thread_name_prefix='copy') as pool:
+            futures = []
+            for action, *paths in actions:
+                if action == 'copy':
+                    size = os.stat(paths[0]).st_size
+                    self.budget.acquire(size)
+                    futures.append(pool.submit(self._copy, size, *paths))
+            for future in futures:
+                stats.bytes += future.result()
+                stats.files += 1
+        stats.seconds = time.perf_counter() - started
+        return stats
+
+    def _copy(self, size, src, dst):
+        try:
+            Path(dst).parent.mkdir(parents=True, exist_ok=True)
+            return copy_file(src, dst)
+        finally:
+            self.budget.release(size)
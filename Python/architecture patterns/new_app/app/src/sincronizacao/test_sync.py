@@ -1,8 +1,27 @@
+import errno
+import os
 import shutil
+import sys
 import tempfile
+import threading
 from pathlib import Path
 
-from new_app.app.src import sync, determine_actions, FakeFileSystem
+import pytest
+
+import sync as sync_module
+from sync import (
+    sync, sync1, determine_actions, FakeFileSystem, read_paths_and_hashes, index_path,
+    read_paths_and_fingerprints, BLOCKSIZE, ByteBudget, CopyEngine, copy_file,
+    stream_actions, sync_streaming, sync_incremental, Manifest,
+)
+
+
+@pytest.fixture(autouse=True)
+def index_dir(tmp_path_factory, monkeypatch):
+    # away from the roots, which are often tmp_path itself
+    index_dir = tmp_path_factory.mktemp('index')
+    monkeypatch.setenv('SYNC_INDEX_DIR', str(index_dir))
+    return index_dir
 
 
 def test_when_a_file_exists_in_the_source_but_not_the_destination():
@@ -80,4 +99,490 @@ def test_when_a_file_has_been_renamed_in_the_source2():
 
     actions = determine_actions(src_hashes, dst_hashes, Path('/src'), Path('/dst'))
 
-    assert list(actions) == [('move', Path('/dst/fn2'), Path('/dst/fn1'))]
\ No newline at end of file
+    assert list(actions) == [('move', Path('/dst/fn2'), Path('/dst/fn1'))]
+
+
+def write_old_file(path, content):
+    # well in the past, so the hash is old enough to be cached
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(content)
+    os.utime(path, ns=(10**18, 10**18))
+
+
+def test_unchanged_files_are_not_hashed_again(tmp_path):
+    path = tmp_path / 'my-file'
+    write_old_file(path, 'original')
+    first = read_paths_and_hashes(tmp_path)
+
+    # same size and mtime: only reading the file would notice the change
+    path.write_text('modified')
+    os.utime(path, ns=(10**18, 10**18))
+
+    assert read_paths_and_hashes(tmp_path) == first
+    assert read_paths_and_hashes(tmp_path, use_cache=False) != first
+
+
+def test_files_changed_since_the_last_run_are_hashed_again(tmp_path):
+    path = tmp_path / 'my-file'
+    write_old_file(path, 'original')
+    read_paths_and_hashes(tmp_path)
+
+    write_old_file(path, 'changed, and longer')
+
+    assert read_paths_and_hashes(tmp_path) == read_paths_and_hashes(tmp_path, use_cache=False)
+
+
+def test_hashes_in_a_process_pool_match_serial_hashes(tmp_path, monkeypatch):
+    for i in range(10):
+        write_old_file(tmp_path / f'dir{i % 3}' / f'file{i}', f'content {i}')
+    serial = read_paths_and_hashes(tmp_path, use_cache=False, workers=1)
+    monkeypatch.setattr(sync_module, 'PARALLEL_THRESHOLD', 0)
+
+    assert read_paths_and_hashes(tmp_path, use_cache=False, workers=2) == serial
+    assert sorted(serial.values()) == sorted(f'dir{i % 3}/file{i}' for i in range(10))
+
+
+def test_sync_handles_subfolders(tmp_path):
+    source, dest = tmp_path / 'source', tmp_path / 'dest'
+    write_old_file(source / 'sub' / 'my-file', 'I am a very useful file')
+    dest.mkdir()
+
+    sync(source, dest)
+    sync(source, dest)
+
+    assert (dest / 'sub' / 'my-file').read_text() == 'I am a very useful file'
+    copied = [p.relative_to(dest).as_posix() for p in dest.rglob('*') if p.is_file()]
+    assert copied == ['sub/my-file']
+
+
+def test_syncing_writes_nothing_to_the_source(tmp_path, index_dir):
+    source, dest = tmp_path / 'source', tmp_path / 'dest'
+    write_old_file(source / 'my-file', 'content')
+    dest.mkdir()
+
+    sync1(source, dest)
+    sync_incremental(source, dest)
+
+    assert [p.name for p in source.iterdir()] == ['my-file']
+    assert index_path(source).parent == index_dir
+    assert set(Manifest(source).load()) == {'my-file'}
+
+
+def test_sync_carries_on_without_an_index_it_cannot_write(tmp_path, monkeypatch):
+    source, dest = tmp_path / 'source', tmp_path / 'dest'
+    write_old_file(source / 'my-file', 'content')
+    dest.mkdir()
+    (tmp_path / 'not-a-folder').write_text('')
+    monkeypatch.setenv('SYNC_INDEX_DIR', str(tmp_path / 'not-a-folder' / 'index'))
+
+    sync1(source, dest)
+    write_old_file(source / 'my-file', 'edited')
+    sync_incremental(source, dest)
+    sync_incremental(source, dest)
+
+    assert (dest / 'my-file').read_text() == 'edited'
+    assert not Manifest(source).exists()
+
+
+def test_sync1_without_the_cache_keeps_no_index(tmp_path):
+    source, dest = tmp_path / 'source', tmp_path / 'dest'
+    write_old_file(source / 'my-file', 'content')
+    dest.mkdir()
+
+    sync1(source, dest, use_cache=False)
+
+    assert (dest / 'my-file').read_text() == 'content'
+    assert not index_path(source).exists()
+    assert not index_path(dest).exists()
+
+
+def record_reads(monkeypatch):
+    reads = []
+    for name in ('hash_file', 'partial_hash'):
+        function = getattr(sync_module, name)
+        def recording(path, *args, name=name, function=function):
+            reads.append((name, Path(path).name))
+            return function(path, *args)
+        monkeypatch.setattr(sync_module, name, recording)
+    return reads
+
+
+def test_files_with_no_size_match_on_the_other_side_are_not_read(tmp_path, monkeypatch):
+    source, dest = tmp_path / 'source', tmp_path / 'dest'
+    write_old_file(source / 'new-file', 'a' * 10)
+    write_old_file(dest / 'old-file', 'b' * 20)
+    reads = record_reads(monkeypatch)
+
+    source_hashes, dest_hashes = read_paths_and_fingerprints(source, dest)
+
+    assert reads == []
+    assert list(determine_actions(source_hashes, dest_hashes, source, dest)) == [
+        ('copy', source / 'new-file', dest / 'new-file'),
+        ('delete', dest / 'old-file'),
+    ]
+
+
+def test_only_files_whose_partial_hashes_match_are_hashed_in_full(tmp_path, monkeypatch):
+    source, dest = tmp_path / 'source', tmp_path / 'dest'
+    size = 3 * BLOCKSIZE
+    write_old_file(source / 'renamed', 'x' * size)
+    write_old_file(dest / 'original', 'x' * size)
+    # same path and size, so hashed in full without a partial hash first
+    write_old_file(source / 'edited', 'y' * (size + 1))
+    write_old_file(dest / 'edited', 'y' * BLOCKSIZE + 'z' * BLOCKSIZE + 'y' * (BLOCKSIZE + 1))
+    write_old_file(source / 'different', 'a' * (size + 1) + 'b')
+    write_old_file(dest / 'unrelated', 'a' * (size + 1) + 'c')
+    reads = record_reads(monkeypatch)
+
+    source_hashes, dest_hashes = read_paths_and_fingerprints(source, dest, use_cache=False)
+
+    assert sorted(name for kind, name in reads if kind == 'hash_file') == [
+        'edited', 'edited', 'original', 'renamed',
+    ]
+    assert sorted(name for kind, name in reads if kind == 'partial_hash') == [
+        'different', 'original', 'renamed', 'unrelated',
+    ]
+    assert sorted(determine_actions(source_hashes, dest_hashes, source, dest)) == [
+        ('copy', source / 'different', dest / 'different'),
+        ('copy', source / 'edited', dest / 'edited'),
+        ('delete', dest / 'unrelated'),
+        ('move', dest / 'original', dest / 'renamed'),
+    ]
+
+
+def test_sync1_copies_and_moves_within_subfolders(tmp_path):
+    source, dest = tmp_path / 'source', tmp_path / 'dest'
+    write_old_file(source / 'a' / 'renamed', 'moved content')
+    write_old_file(source / 'b' / 'new', 'new content')
+    write_old_file(source / 'edited', 'new version')
+    write_old_file(dest / 'original', 'moved content')
+    write_old_file(dest / 'edited', 'old version')
+
+    sync1(source, dest)
+
+    assert (dest / 'a' / 'renamed').read_text() == 'moved content'
+    assert (dest / 'b' / 'new').read_text() == 'new content'
+    assert (dest / 'edited').read_text() == 'new version'
+    assert not (dest / 'original').exists()
+
+
+def unsupported(*args):
+    raise OSError(errno.EXDEV, 'not across filesystems')
+
+
+@pytest.mark.parametrize('unavailable', [(), ('copy_file_range',), ('copy_file_range', 'sendfile')])
+def test_copy_file_falls_back_when_the_kernel_cant_help(tmp_path, monkeypatch, unavailable):
+    content = os.urandom(3 * BLOCKSIZE + 7)
+    (tmp_path / 'src').write_bytes(content)
+    for name in unavailable:
+        if hasattr(os, name):
+            monkeypatch.setattr(os, name, unsupported)
+
+    assert copy_file(tmp_path / 'src', tmp_path / 'dst') == len(content)
+    assert (tmp_path / 'dst').read_bytes() == content
+
+
+def test_copy_file_copies_empty_files(tmp_path):
+    (tmp_path / 'src').write_bytes(b'')
+    assert copy_file(tmp_path / 'src', tmp_path / 'dst') == 0
+    assert (tmp_path / 'dst').read_bytes() == b''
+
+
+def test_byte_budget_holds_copies_back_until_there_is_room():
+    budget = ByteBudget(100)
+    budget.acquire(60)
+    acquired = threading.Event()
+    waiter = threading.Thread(target=lambda: (budget.acquire(60), acquired.set()))
+    waiter.start()
+
+    assert not acquired.wait(0.05)
+    budget.release(60)
+    assert acquired.wait(1)
+    waiter.join()
+
+
+def test_byte_budget_lets_a_file_bigger_than_the_budget_through_alone():
+    budget = ByteBudget(100)
+    budget.acquire(500)
+    assert budget.in_flight == 500
+
+
+def test_copy_engine_moves_out_of_a_path_before_copying_into_it(tmp_path):
+    source, dest = tmp_path / 'source', tmp_path / 'dest'
+    write_old_file(source / 'report', 'new report')
+    write_old_file(source / 'archive' / 'report', 'old report')
+    write_old_file(dest / 'report', 'old report')
+    actions = [
+        ('copy', source / 'report', dest / 'report'),
+        ('move', dest / 'report', dest / 'archive' / 'report'),
+    ]
+
+    stats = CopyEngine(workers=2).apply(actions)
+
+    assert (dest / 'report').read_text() == 'new report'
+    assert (dest / 'archive' / 'report').read_text() == 'old report'
+    assert (stats.files, stats.bytes) == (1, len('new report'))
+    assert 'files/s' in str(stats)
+
+
+def test_sync1_reports_what_it_copied(tmp_path):
+    source, dest = tmp_path / 'source', tmp_path / 'dest'
+    for i in range(5):
+        write_old_file(source / f'file{i}', 'x' * (i + 1))
+    dest.mkdir()
+
+    stats = sync1(source, dest)
+
+    assert (stats.files, stats.bytes) == (5, 15)
+    assert sorted(p.name for p in dest.iterdir()) == [
+        f'file{i}' for i in range(5)
+    ]
+
+
+def test_streaming_sync_merges_both_trees_in_path_order(tmp_path):
+    source, dest = tmp_path / 'source', tmp_path / 'dest'
+    write_old_file(source / 'a' / 'same', 'same content')
+    write_old_file(dest / 'a' / 'same', 'same content')
+    write_old_file(source / 'a' / 'edited', 'new version')
+    write_old_file(dest / 'a' / 'edited', 'old version')
+    write_old_file(source / 'a-new', 'new file')
+    write_old_file(dest / 'b' / 'gone', 'deleted file')
+    filesystem = FakeFileSystem()
+
+    sync_streaming(source, dest, filesystem)
+
+    assert filesystem == [
+        ('COPY', source / 'a' / 'edited', dest / 'a' / 'edited'),
+        ('COPY', source / 'a-new', dest / 'a-new'),
+        ('DELETE', dest / 'b' / 'gone'),
+    ]
+
+
+def test_streaming_sync_keeps_files_with_the_same_content_apart(tmp_path):
+    source, dest = tmp_path / 'source', tmp_path / 'dest'
+    write_old_file(source / 'one' / 'copy', 'duplicated')
+    write_old_file(source / 'two' / 'copy', 'duplicated')
+    dest.mkdir()
+
+    sync_streaming(source, dest)
+
+    assert (dest / 'one' / 'copy').read_text() == 'duplicated'
+    assert (dest / 'two' / 'copy').read_text() == 'duplicated'
+    assert list(stream_actions(source, dest)) == []
+
+
+def test_streaming_sync_yields_actions_before_finishing_the_walk(tmp_path, monkeypatch):
+    source, dest = tmp_path / 'source', tmp_path / 'dest'
+    for folder in ('a', 'b'):
+        write_old_file(source / folder / 'file', folder)
+    dest.mkdir()
+    scanned = []
+    scandir = os.scandir
+    monkeypatch.setattr(os, 'scandir', lambda path: scanned.append(Path(path)) or scandir(path))
+
+    actions = stream_actions(source, dest)
+
+    assert next(actions) == ('copy', source / 'a' / 'file', dest / 'a' / 'file')
+    assert source / 'b' not in scanned
+
+
+def test_streaming_sync_compares_cached_hashes_instead_of_reading_the_files(
+        tmp_path, monkeypatch
+):
+    source, dest = tmp_path / 'source', tmp_path / 'dest'
+    write_old_file(source / 'same', 'same content')
+    write_old_file(dest / 'same', 'same content')
+    write_old_file(source / 'edited', 'new version')
+    write_old_file(dest / 'edited', 'old version')
+    assert list(stream_actions(source, dest)) == [
+        ('copy', source / 'edited', dest / 'edited'),
+    ]
+    opened = []
+    monkeypatch.setattr(
+        sync_module, 'open',
+        lambda path, *args: opened.append(Path(path).name) or open(path, *args),
+        raising=False,
+    )
+
+    assert list(stream_actions(source, dest)) == [
+        ('copy', source / 'edited', dest / 'edited'),
+    ]
+    assert opened == ['edited', 'edited']
+
+
+def test_incremental_sync_writes_a_manifest_and_then_reads_nothing_unchanged(tmp_path, monkeypatch):
+    source, dest = tmp_path / 'source', tmp_path / 'dest'
+    write_old_file(source / 'sub' / 'file', 'content')
+    dest.mkdir()
+
+    first = sync_incremental(source, dest)
+    reads = record_reads(monkeypatch)
+    second = sync_incremental(source, dest)
+
+    assert (first.files, second.files) == (1, 0)
+    assert reads == []
+    assert set(Manifest(source).load()) == {'sub/file'}
+    assert (dest / 'sub' / 'file').read_text() == 'content'
+
+
+def test_incremental_sync_copies_changes_and_moves_renames(tmp_path):
+    source, dest = tmp_path / 'source', tmp_path / 'dest'
+    write_old_file(source / 'renamed-before', 'renamed content')
+    write_old_file(source / 'edited', 'old version')
+    write_old_file(source / 'deleted', 'deleted content')
+    dest.mkdir()
+    sync_incremental(source, dest)
+
+    (source / 'folder').mkdir()
+    os.rename(source / 'renamed-before', source / 'folder' / 'renamed-after')
+    write_old_file(source / 'edited', 'new, longer version')
+    (source / 'deleted').unlink()
+    write_old_file(source / 'added', 'added content')
+    stats = sync_incremental(source, dest)
+
+    assert stats.files == 2
+    assert sorted(p.relative_to(dest).as_posix() for p in dest.rglob('*') if p.is_file()) == [
+        'added', 'edited', 'folder/renamed-after',
+    ]
+    assert (dest / 'edited').read_text() == 'new, longer version'
+    assert set(Manifest(source).load()) == {'added', 'edited', 'folder/renamed-after'}
+
+
+def test_incremental_sync_moves_a_copy_of_a_hashed_file_instead_of_copying_it(tmp_path):
+    source, dest = tmp_path / 'source', tmp_path / 'dest'
+    write_old_file(source / 'original', 'x' * 100)
+    dest.mkdir()
+    read_paths_and_hashes(source)  # gets its hash into the cache, and so the manifest
+    sync_incremental(source, dest)
+
+    shutil.copy(source / 'original', source / 'copied')
+    (source / 'original').unlink()
+    stats = sync_incremental(source, dest)
+
+    assert stats.files == 0
+    assert (dest / 'copied').read_text() == 'x' * 100
+    assert not (dest / 'original').exists()
+
+
+def test_incremental_sync_only_looks_at_the_changed_paths_it_is_given(tmp_path):
+    source, dest = tmp_path / 'source', tmp_path / 'dest'
+    write_old_file(source / 'one', 'one')
+    write_old_file(source / 'folder' / 'two', 'two')
+    dest.mkdir()
+    sync_incremental(source, dest)
+
+    write_old_file(source / 'one', 'one, edited')
+    write_old_file(source / 'folder' / 'two', 'two, edited')
+    write_old_file(source / 'folder' / 'three', 'three')
+    sync_incremental(source, dest, changed={'folder'})
+
+    assert (dest / 'one').read_text() == 'one'
+    assert (dest / 'folder' / 'two').read_text() == 'two, edited'
+    assert (dest / 'folder' / 'three').read_text() == 'three'
+
+
+def test_incremental_sync_looks_again_at_files_written_just_before_it_ran(tmp_path):
+    source, dest = tmp_path / 'source', tmp_path / 'dest'
+    source.mkdir()
+    dest.mkdir()
+    (source / 'file').write_text('first')
+    sync_incremental(source, dest)
+
+    # rewritten within the same mtime tick, so size and mtime are unchanged
+    mtime_ns = (source / 'file').stat().st_mtime_ns
+    (source / 'file').write_text('again')
+    os.utime(source / 'file', ns=(mtime_ns, mtime_ns))
+    sync_incremental(source, dest, changed=set())
+
+    assert (dest / 'file').read_text() == 'again'
+
+
+def test_incremental_sync_can_be_run_again_after_failing_part_way(tmp_path, monkeypatch):
+    source, dest = tmp_path / 'source', tmp_path / 'dest'
+    write_old_file(source / 'renamed-before', 'renamed content')
+    write_old_file(source / 'deleted', 'deleted content')
+    dest.mkdir()
+    sync_incremental(source, dest)
+
+    os.rename(source / 'renamed-before', source / 'renamed-after')
+    (source / 'deleted').unlink()
+    write_old_file(source / 'added', 'added content')
+    def failing_copy(src, dst):
+        raise OSError(errno.ENOSPC, 'No space left on device')
+    with monkeypatch.context() as patched:
+        patched.setattr(sync_module, 'copy_file', failing_copy)
+        with pytest.raises(OSError):
+            sync_incremental(source, dest)
+    assert not (dest / 'renamed-before').exists()
+
+    sync_incremental(source, dest)
+
+    assert sorted(p.name for p in dest.iterdir()) == ['added', 'renamed-after']
+    assert (dest / 'renamed-after').read_text() == 'renamed content'
+
+
+@pytest.mark.skipif(not sys.platform.startswith('linux'), reason='inotify is Linux only')
+def test_watcher_journals_changes_including_in_new_folders(tmp_path):
+    from watcher import Watcher  # pylint: disable=import-outside-toplevel
+    write_old_file(tmp_path / 'existing', 'existing')
+
+    with Watcher(tmp_path) as watcher:
+        (tmp_path / 'existing').write_text('edited')
+        (tmp_path / 'new').mkdir()
+        assert watcher.changes(timeout=1) == {'existing', 'new'}
+
+        (tmp_path / 'new' / 'file').write_text('created')
+        os.rename(tmp_path / 'existing', tmp_path / 'new' / 'moved')
+        assert watcher.changes(timeout=1) == {'existing', 'new/file', 'new/moved'}
+        assert watcher.changes() == set()
+
+
+@pytest.mark.skipif(not sys.platform.startswith('linux'), reason='inotify is Linux only')
+def test_watcher_follows_folders_moved_within_and_out_of_the_root(tmp_path):
+    from watcher import Watcher  # pylint: disable=import-outside-toplevel
+    root, outside = tmp_path / 'root', tmp_path / 'outside'
+    write_old_file(root / 'before' / 'file', 'file')
+    write_old_file(root / 'leaving' / 'file', 'file')
+    outside.mkdir()
+
+    with Watcher(root) as watcher:
+        os.rename(root / 'before', root / 'after')
+        os.rename(root / 'leaving', outside / 'left')
+        assert watcher.changes(timeout=1) == {'before', 'after', 'leaving'}
+
+        (root / 'after' / 'file').write_text('edited')
+        (outside / 'left' / 'file').write_text('edited')
+        assert watcher.changes(timeout=1) == {'after/file'}
+        assert watcher.changes() == set()
+
+
+@pytest.mark.skipif(not sys.platform.startswith('linux'), reason='inotify is Linux only')
+def test_watch_keeps_dest_in_sync(tmp_path):
+    from watcher import watch  # pylint: disable=import-outside-toplevel
+    source, dest = tmp_path / 'source', tmp_path / 'dest'
+    write_old_file(source / 'existing', 'existing')
+    dest.mkdir()
+    stop = threading.Event()
+    watching = threading.Thread(target=watch, args=(source, dest, 0.05, stop))
+    watching.start()
+    def wait_for(condition):
+        for _ in range(100):
+            if condition():
+                return
+            stop.wait(0.05)
+
+    try:
+        write_old_file(source / 'folder' / 'new', 'new')
+        wait_for((dest / 'folder' / 'new').exists)
+        os.rename(source / 'folder', tmp_path / 'moved-out')
+        (tmp_path / 'moved-out' / 'new').write_text('edited outside')
+        wait_for(lambda: not (dest / 'folder' / 'new').exists())
+        write_old_file(source / 'last', 'last')
+        wait_for((dest / 'last').exists)
+    finally:
+        stop.set()
+        watching.join()
+
+    assert (dest / 'existing').read_text() == 'existing'
+    assert not (dest / 'folder' / 'new').exists()
+    assert (dest / 'last').read_text() == 'last'
@@ -0,0 +1,141 @@
+"""
+Keeps a journal of what changed under a folder between syncs, using
+inotify, so sync_incremental only has to look at those paths. Linux only.
+"""
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import threading
+from pathlib import Path
+
+from sync import sync_incremental
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+WATCHED = (
+    IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO
+    | IN_CREATE | IN_DELETE | IN_ONLYDIR
+)
+EVENT = struct.Struct('iIII')
+
+
+class Watcher:
+    """
+    changes() returns the paths, relative to root, of every file or
+    folder created, changed, moved or deleted since the last call, or None
+    when the kernel dropped events and only a full scan will do.
+    """
+
+    def __init__(self, root):
+        self.root = Path(root)
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self._fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self._folders = {}
+        self._journal = set()
+        self._overflowed = False
+        self._watch_tree('')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        os.close(self._fd)
+
+    def changes(self, timeout=0.0):
+        poller = select.poll()
+        poller.register(self._fd, select.POLLIN)
+        if poller.poll(timeout * 1000):
+            self._read_events()
+        journal, self._journal = self._journal, set()
+        if self._overflowed:
+            self._overflowed = False
+            return None
+        return journal
+
+    def _read_events(self):
+        while True:
+            try:
+                data = os.read(self._fd, 64 * 1024)
+            except BlockingIOError:
+                return
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = EVENT.unpack_from(data, offset)
+                offset += EVENT.size
+                name = data[offset:offset + length].rstrip(b'\0').decode(errors='surrogateescape')
+                offset += length
+                self._handle(wd, mask, name)
+
+    def _handle(self, wd, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            self._overflowed = True
+            return
+        if mask & IN_IGNORED:
+            self._folders.pop(wd, None)
+            return
+        folder = self._folders.get(wd)
+        if folder is None or not name:
+            return
+        relpath = folder + name
+        self._journal.add(relpath)
+        if mask & IN_ISDIR and mask & IN_MOVED_FROM:
+            #whether it left the root or was renamed in it, its watches
+            #still carry the old path; IN_MOVED_TO watches it again
+            self._unwatch_tree(relpath + '/')
+        if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+            self._watch_tree(relpath + '/')
+
+    def _watch_tree(self, prefix):
+        #anything created in a new folder before the watch was added is
+        #covered by the folder itself being in the journal
+        for folder, subfolders, _ in os.walk(self.root / prefix):
+            relative = Path(folder).relative_to(self.root).as_posix()
+            relative = '' if relative == '.' else relative + '/'
+            wd = self._libc.inotify_add_watch(self._fd, os.fsencode(folder), WATCHED)
+            if wd < 0:
+                # gone already, its parent's journal entry covers it
+                subfolders.clear()
+                continue
+            self._folders[wd] = relative
+
+    def _unwatch_tree(self, prefix):
+        for wd, folder in list(self._folders.items()):
+            if folder.startswith(prefix):
+                self._libc.inotify_rm_watch(self._fd, wd)
+                del self._folders[wd]
+
+
+def watch(source, dest, interval=1.0, stop=None):
+    """
+    Keeps dest in sync with source, syncing whatever the watcher saw change
+    every `interval` seconds. The watch starts before the first, full,
+    sync so nothing that happens during it is missed.
+    """
+    stop = stop or threading.Event()
+    with Watcher(source) as watcher:
+        sync_incremental(source, dest)
+        while not stop.is_set():
+            changed = watcher.changes(timeout=interval)
+            if changed is None:
+                sync_incremental(source, dest)
+            elif changed:
+                sync_incremental(source, dest, changed)